@@ -0,0 +1,79 @@
+"""ベンチマーク用の合成コーパスと質問の生成"""
+import os
+import random
+from typing import List
+
+
+# コーパスの規模ごとのファイル数
+CORPUS_SIZES = {
+    "small": 20,
+    "medium": 200,
+    "large": 1000,
+}
+
+_TOPICS = [
+    ("リスト内包表記", "list_comprehension", "IndexError"),
+    ("辞書の操作", "dict_update", "KeyError"),
+    ("例外処理", "try_except", "ValueError"),
+    ("ファイル入出力", "read_csv", "FileNotFoundError"),
+    ("クラスと継承", "BaseModel", "AttributeError"),
+    ("NumPyの配列演算", "np_broadcast", "ValueError"),
+    ("pandasのデータ集計", "groupby_agg", "KeyError"),
+    ("再帰関数", "fibonacci", "RecursionError"),
+    ("勾配降下法", "gradient_descent", "ZeroDivisionError"),
+    ("モデルの学習ループ", "train_epoch", "RuntimeError"),
+]
+
+_SENTENCES = [
+    "{topic}は演習{exercise}で扱う重要な概念です。",
+    "{function}関数を使うと処理を簡潔に書くことができます。",
+    "{error}が発生した場合は、入力の値と型を確認してください。",
+    "まずは小さなデータで{topic}の動作を確かめてから、本番のデータに適用しましょう。",
+    "{function}の戻り値を print で表示すると、途中経過を確認できます。",
+    "課題{exercise}では{topic}を用いて前処理を実装します。",
+    "{error}のメッセージには、問題が起きた行番号が含まれています。",
+]
+
+_QUESTIONS = [
+    "{topic}の使い方を教えてください",
+    "{error}が出て{function}が動きません",
+    "演習{exercise}の{topic}がよく分かりません",
+    "{function}の戻り値はどう確認すればいいですか？",
+]
+
+
+def generate_corpus(directory: str, size: str = "small", seed: int = 0) -> int:
+    """演習資料に似た合成テキストを directory に書き出し、ファイル数を返す"""
+    rng = random.Random(seed)
+    num_files = CORPUS_SIZES[size]
+    os.makedirs(directory, exist_ok=True)
+
+    for i in range(num_files):
+        topic, function, error = _TOPICS[i % len(_TOPICS)]
+        paragraphs = []
+        for _ in range(rng.randint(4, 12)):
+            sentences = [
+                rng.choice(_SENTENCES).format(
+                    topic=topic, function=function, error=error, exercise=f"{i % 12 + 1}-{rng.randint(1, 5)}"
+                )
+                for _ in range(rng.randint(3, 8))
+            ]
+            paragraphs.append("".join(sentences))
+
+        path = os.path.join(directory, f"exercise_{i:04d}.md")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"# 演習{i % 12 + 1}: {topic}\n\n" + "\n\n".join(paragraphs) + "\n")
+
+    return num_files
+
+
+def generate_queries(count: int, seed: int = 0) -> List[str]:
+    """コーパスの話題に沿った質問を生成"""
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        topic, function, error = rng.choice(_TOPICS)
+        queries.append(rng.choice(_QUESTIONS).format(
+            topic=topic, function=function, error=error, exercise=f"{rng.randint(1, 12)}-{rng.randint(1, 5)}"
+        ))
+    return queries
@@ -0,0 +1,154 @@
+"""外部APIを使わずにレイテンシだけを再現する LLM・埋め込みの代替実装"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterator, List
+
+from langchain.embeddings.base import Embeddings
+from langchain.schema import BaseMessage
+
+from src.knowledge_base.embeddings import HashedNgramEmbeddings
+from src.llm.client import LLMClient
+from src.llm.prompts import HINT_BATCH_PROMPT
+from src.llm.tokenizer import approximate_count
+
+
+class StageTimer:
+    """処理段階（埋め込み・検索・LLMなど）ごとの所要時間を集計する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals: Dict[str, float] = defaultdict(float)
+        self.counts: Dict[str, int] = defaultdict(int)
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.totals[stage] += seconds
+            self.counts[stage] += 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self.totals.clear()
+            self.counts.clear()
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                stage: {"seconds": self.totals[stage], "calls": self.counts[stage]}
+                for stage in sorted(self.totals)
+            }
+
+    def wrap(self, obj, method_name: str, stage: str) -> None:
+        """オブジェクトのメソッドを所要時間を記録するものに置き換える"""
+        method: Callable = getattr(obj, method_name)
+
+        if asyncio.iscoroutinefunction(method):
+            async def timed_async(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await method(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+            setattr(obj, method_name, timed_async)
+            return
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        setattr(obj, method_name, timed)
+
+
+class FakeEmbeddings(Embeddings):
+    """決定的なベクトルを返し、API呼び出し相当の待ち時間を入れる埋め込み
+
+    ベクトルはローカルのハッシュ n-gram 埋め込みで計算するため、
+    似た文章は似たベクトルになり、検索結果も意味を持つ
+    """
+
+    def __init__(self,
+                 timer: StageTimer,
+                 latency: float = 0.05,
+                 per_text_latency: float = 0.0005,
+                 dimension: int = 256):
+        self.timer = timer
+        self.latency = latency
+        self.per_text_latency = per_text_latency
+        self.dimension = dimension
+        self._embeddings = HashedNgramEmbeddings(dimension=dimension)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        start = time.perf_counter()
+        time.sleep(self.latency + self.per_text_latency * len(texts))
+        vectors = self._embeddings.embed_documents(texts)
+        self.timer.record("embedding", time.perf_counter() - start)
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class FakeLLMClient(LLMClient):
+    """決定的な応答を返し、生成トークン数に応じた待ち時間を入れるLLMクライアント
+
+    プロンプトの組み立ては本物の LLMClient の処理を使う。
+    トークン数はエンコーダーの取得（ネットワーク）に依存しないよう文字数から概算する
+    """
+
+    def __init__(self,
+                 timer: StageTimer,
+                 latency: float = 0.3,
+                 per_token_latency: float = 0.01,
+                 response_tokens: int = 60):
+        self.streaming = False
+        self.timer = timer
+        self.latency = latency
+        self.per_token_latency = per_token_latency
+        self.response_tokens = response_tokens
+
+    def generate(self, messages: List[BaseMessage]) -> str:
+        start = time.perf_counter()
+        time.sleep(self.latency + self.per_token_latency * self.response_tokens)
+        response = self._response(messages)
+        self.timer.record("llm", time.perf_counter() - start)
+        return response
+
+    async def agenerate(self, messages: List[BaseMessage]) -> str:
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency + self.per_token_latency * self.response_tokens)
+        response = self._response(messages)
+        self.timer.record("llm", time.perf_counter() - start)
+        return response
+
+    def stream(self, messages: List[BaseMessage]) -> Iterator[str]:
+        start = time.perf_counter()
+        time.sleep(self.latency)
+        for token in self._response(messages).split(" "):
+            time.sleep(self.per_token_latency)
+            yield token + " "
+        self.timer.record("llm", time.perf_counter() - start)
+
+    def count_tokens(self, text: str) -> int:
+        return approximate_count(text)
+
+    def count_tokens_many(self, texts: List[str]) -> List[int]:
+        return [approximate_count(text) for text in texts]
+
+    def _response(self, messages: List[BaseMessage]) -> str:
+        """最後のメッセージから決まる応答（ヒントの一括生成にはJSONで応答）"""
+        prompt = messages[-1].content if messages else ""
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        words = [digest[i % len(digest):i % len(digest) + 4] for i in range(self.response_tokens)]
+
+        if HINT_BATCH_PROMPT.strip() in prompt:
+            third = max(len(words) // 3, 1)
+            return json.dumps({
+                "hints": {str(level): " ".join(words[(level - 1) * third:level * third]) for level in (1, 2, 3)},
+                "keywords": words[:5]
+            }, ensure_ascii=False)
+        return " ".join(words)
@@ -0,0 +1,246 @@
+"""エンドツーエンドのレイテンシを計測するベンチマーク
+
+外部APIの代わりに待ち時間を再現する LLM・埋め込みを使い、
+合成コーパスに対するインデックス化・質問応答・ヒント生成を計測して JSON で出力する。
+
+使用例:
+    python -m benchmarks.run --corpus small medium --queries 50 --concurrency 4 --output report.json
+"""
+import argparse
+import json
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from src.knowledge_base.retriever import KnowledgeRetriever
+from src.knowledge_base.vector_store import VectorStore
+from src.response_engine.hint_generator import HintGenerator
+from src.response_engine.qa_engine import QAEngine
+from src.utils.config import settings
+from src.utils.stats import percentile
+
+from .corpus import CORPUS_SIZES, generate_corpus, generate_queries
+from .fakes import FakeEmbeddings, FakeLLMClient, StageTimer
+
+
+SCENARIOS = ["index_documents", "qa_answer", "qa_answer_with_history", "hint_generate"]
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    """レイテンシの統計（秒）"""
+    return {
+        "count": len(latencies),
+        "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies, default=0.0),
+    }
+
+
+def reset_peak_rss() -> bool:
+    """最大常駐メモリの記録をリセット（Linux のみ。リセットできた場合は True）"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb() -> float:
+    """最大常駐メモリ（MB）
+
+    Linux では reset_peak_rss() 以降の最大値（VmHWM）、
+    それ以外ではプロセス開始以降の最大値を返す
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト単位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+@contextmanager
+def override_settings(**overrides):
+    """計測中だけ設定を上書きする"""
+    originals = {key: getattr(settings, key) for key in overrides}
+    for key, value in overrides.items():
+        setattr(settings, key, value)
+    try:
+        yield
+    finally:
+        for key, value in originals.items():
+            setattr(settings, key, value)
+
+
+def run_operations(operations: List[Callable[[], Any]], concurrency: int) -> Dict[str, Any]:
+    """操作を並列に実行し、レイテンシとスループットを計測"""
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def timed(operation: Callable[[], Any]) -> None:
+        start = time.perf_counter()
+        operation()
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(timed, operation) for operation in operations]:
+            future.result()
+    wall = time.perf_counter() - start
+
+    return {
+        "latency": latency_summary(latencies),
+        "throughput_per_second": len(latencies) / wall if wall > 0 else 0.0,
+        "wall_seconds": wall,
+    }
+
+
+def stage_breakdown(timer: StageTimer, operations: int) -> Dict[str, Dict[str, float]]:
+    """処理段階ごとの合計時間と1操作あたりの時間
+
+    retrieval には語彙検索だけで決まるかの判定（lexical_result）と、
+    検索時のクエリの埋め込み時間も含まれる（段階は入れ子になりうる）
+    """
+    breakdown = timer.snapshot()
+    for stage in breakdown.values():
+        stage["seconds_per_operation"] = stage["seconds"] / operations if operations else 0.0
+    return breakdown
+
+
+def benchmark_corpus(size: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """1つの規模のコーパスに対して全シナリオを計測"""
+    timer = StageTimer()
+    results: Dict[str, Any] = {}
+    per_scenario_rss = False
+
+    with tempfile.TemporaryDirectory() as corpus_dir, tempfile.TemporaryDirectory() as store_dir:
+        num_files = generate_corpus(corpus_dir, size=size, seed=args.seed)
+        queries = generate_queries(args.queries, seed=args.seed)
+
+        embeddings = FakeEmbeddings(
+            timer,
+            latency=args.embedding_latency,
+            per_text_latency=args.embedding_text_latency,
+        )
+
+        with override_settings(
+            vector_store_path=store_dir,
+            vector_store_type=args.store,
+            embedding_dimension=embeddings.dimension,
+            answer_cache_enabled=False,
+            persist_mode="deferred",
+        ):
+            retriever = KnowledgeRetriever(vector_store=VectorStore(embeddings=embeddings))
+            timer.wrap(retriever, "retrieve_result", "retrieval")
+            timer.wrap(retriever, "lexical_result", "retrieval")
+
+            def llm_client() -> FakeLLMClient:
+                return FakeLLMClient(
+                    timer,
+                    latency=args.llm_latency,
+                    per_token_latency=args.llm_token_latency,
+                    response_tokens=args.response_tokens,
+                )
+
+            # インデックス化
+            timer.reset()
+            per_scenario_rss = reset_peak_rss()
+            start = time.perf_counter()
+            chunks = retriever.index_documents(corpus_dir)
+            retriever.vector_store.flush()
+            seconds = time.perf_counter() - start
+            results["index_documents"] = {
+                "files": num_files,
+                "chunks": chunks,
+                "seconds": seconds,
+                "chunks_per_second": chunks / seconds if seconds > 0 else 0.0,
+                "stages": stage_breakdown(timer, 1),
+                "peak_rss_mb": peak_rss_mb(),
+            }
+
+            # セッション（スレッド）ごとにエンジンを持たせる
+            local = threading.local()
+
+            def qa_engine() -> QAEngine:
+                if not hasattr(local, "qa_engine"):
+                    local.qa_engine = QAEngine(retriever=retriever, llm_client=llm_client())
+                return local.qa_engine
+
+            def hint_generator() -> HintGenerator:
+                if not hasattr(local, "hint_generator"):
+                    local.hint_generator = HintGenerator(retriever=retriever, llm_client=llm_client())
+                return local.hint_generator
+
+            scenario_operations = {
+                "qa_answer": [lambda q=q: qa_engine().answer(q) for q in queries],
+                "qa_answer_with_history": [lambda q=q: qa_engine().answer_with_history(q) for q in queries],
+                "hint_generate": [lambda q=q: hint_generator().generate_hint(q) for q in queries],
+            }
+
+            for name, operations in scenario_operations.items():
+                if name not in args.scenarios:
+                    continue
+                timer.reset()
+                reset_peak_rss()
+                result = run_operations(operations, args.concurrency)
+                result["stages"] = stage_breakdown(timer, len(operations))
+                result["peak_rss_mb"] = peak_rss_mb()
+                results[name] = result
+
+    # リセットできない環境では各シナリオの peak_rss_mb はプロセス全体の最大値になる
+    results["peak_rss_per_scenario"] = per_scenario_rss
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="演習サポートCopilotのレイテンシベンチマーク")
+    parser.add_argument("--corpus", nargs="+", choices=list(CORPUS_SIZES), default=["small"])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--store", choices=["faiss", "chroma"], default="faiss")
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--llm-token-latency", type=float, default=0.01)
+    parser.add_argument("--response-tokens", type=int, default=60)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--embedding-text-latency", type=float, default=0.0005)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="レポートの出力先（省略時は標準出力）")
+    args = parser.parse_args(argv)
+
+    report = {
+        "config": vars(args),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "corpora": {size: benchmark_corpus(size, args) for size in args.corpus},
+    }
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+        print(f"Benchmark report written to {args.output}")
+    else:
+        print(output)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""検索結果からトークン数の上限に収まるコンテキストを組み立てる"""
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from langchain.schema import Document
+
+from ..llm import tokenizer
+
+
+# start_index のない（古いインデックスの）チャンク同士を重複とみなす最小の文字数
+_MIN_TEXT_OVERLAP = 20
+
+
+@dataclass
+class ContextPiece:
+    """コンテキストに含める1つの断片（隣接するチャンクを結合したもの）"""
+    source: str
+    page: Optional[int]
+    text: str
+    start: Optional[int] = None
+
+    @property
+    def end(self) -> Optional[int]:
+        return None if self.start is None else self.start + len(self.text)
+
+    def header(self, number: int) -> str:
+        return f"[文書{number} - {self.source}]"
+
+    def format(self, number: int) -> str:
+        return f"{self.header(number)}\n{self.text.strip()}"
+
+
+def merge_chunks(documents: List[Document]) -> List[ContextPiece]:
+    """同じ文書の重複・隣接するチャンクを結合する
+
+    順序は各断片に含まれるチャンクのうち最も順位の高いものに従う
+    """
+    pieces: List[ContextPiece] = []
+
+    for doc in documents:
+        source = doc.metadata.get('source', 'Unknown')
+        page = doc.metadata.get('page')
+        start = doc.metadata.get('start_index')
+        text = doc.page_content
+
+        for piece in pieces:
+            if piece.source == source and piece.page == page and _merge_into(piece, text, start):
+                break
+        else:
+            pieces.append(ContextPiece(source=source, page=page, text=text, start=start))
+
+    return pieces
+
+
+def _merge_into(piece: ContextPiece, text: str, start: Optional[int]) -> bool:
+    """チャンクが断片と重複・隣接していれば結合して True を返す"""
+    if text in piece.text:
+        return True
+
+    if start is not None and piece.start is not None:
+        end = start + len(text)
+        if start > piece.end or end < piece.start:
+            return False
+        if start >= piece.start:
+            piece.text = piece.text + text[piece.end - start:]
+        else:
+            piece.text = text + piece.text[end - piece.start:]
+            piece.start = start
+        return True
+
+    if piece.text in text:
+        piece.text = text
+        return True
+
+    # 位置情報がない場合は chunk_overlap による前後の重なりを探す
+    overlap = _text_overlap(piece.text, text)
+    if overlap:
+        piece.text = piece.text + text[overlap:]
+        return True
+    overlap = _text_overlap(text, piece.text)
+    if overlap:
+        piece.text = text + piece.text[overlap:]
+        return True
+    return False
+
+
+def _text_overlap(head: str, tail: str) -> int:
+    """head の末尾と tail の先頭が一致する最長の文字数"""
+    for size in range(min(len(head), len(tail)), _MIN_TEXT_OVERLAP - 1, -1):
+        if head.endswith(tail[:size]):
+            return size
+    return 0
+
+
+def build_context(documents: List[Document],
+                  max_tokens: Optional[int] = None,
+                  count_tokens: Optional[Callable[[str], int]] = None) -> str:
+    """順位の高い断片から、トークン数の上限に収まるだけコンテキストに詰める
+
+    max_tokens を指定しない場合は全ての断片を含める。
+    上限を超える断片は飛ばし、より短い下位の断片で残りの枠を埋める。
+    count_tokens を省略した場合はキャッシュ付きのローカルなカウントを使う。
+    """
+    pieces = merge_chunks(documents)
+    if max_tokens is None:
+        return "\n\n".join(piece.format(i + 1) for i, piece in enumerate(pieces))
+
+    count_tokens = count_tokens or tokenizer.count_tokens
+
+    parts: List[str] = []
+    used = 0
+
+    for piece in pieces:
+        formatted = piece.format(len(parts) + 1)
+        tokens = count_tokens(formatted)
+
+        if used + tokens > max_tokens:
+            if parts:
+                continue
+            # 最上位の断片だけは上限に合わせて切り詰めて含める
+            formatted = _truncate(piece, max_tokens, tokens, count_tokens)
+            if not formatted:
+                continue
+            tokens = count_tokens(formatted)
+
+        parts.append(formatted)
+        used += tokens
+
+    return "\n\n".join(parts)
+
+
+def _truncate(piece: ContextPiece,
+              max_tokens: int,
+              tokens: int,
+              count_tokens: Callable[[str], int]) -> str:
+    """断片の本文を上限のトークン数に収まるまで切り詰める"""
+    text = piece.text.strip()
+    length = int(len(text) * max_tokens / max(tokens, 1))
+
+    while length > 0:
+        formatted = f"{piece.header(1)}\n{text[:length]}"
+        if count_tokens(formatted) <= max_tokens:
+            return formatted
+        length = int(length * 0.9)
+    return ""
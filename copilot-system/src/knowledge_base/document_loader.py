@@ -1,65 +1,150 @@
 import os
-from typing import List, Dict, Any
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional, Tuple
 from pathlib import Path
 
 from langchain.document_loaders import PyPDFLoader, TextLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
 
+from ..utils import metrics
 from ..utils.config import settings
 
 
+# (ファイルパス, チャンク, エラーメッセージ)
+LoadedFile = Tuple[str, List[Document], Optional[str]]
+
+
+def _load_file_worker(file_path: str, chunk_size: int, chunk_overlap: int) -> LoadedFile:
+    """ワーカープロセスでファイルを読み込み、分割する"""
+    try:
+        loader = DocumentLoader(chunk_size=chunk_size, chunk_overlap=chunk_overlap, workers=1)
+        return file_path, loader.load_file(file_path), None
+    except Exception as e:
+        return file_path, [], str(e)
+
+
 class DocumentLoader:
     """演習資料を読み込み、処理するクラス"""
     
-    def __init__(self):
+    def __init__(self,
+                 chunk_size: Optional[int] = None,
+                 chunk_overlap: Optional[int] = None,
+                 workers: Optional[int] = None):
+        self.chunk_size = chunk_size if chunk_size is not None else settings.chunk_size
+        self.chunk_overlap = chunk_overlap if chunk_overlap is not None else settings.chunk_overlap
+        # 並列読み込みのワーカー数（0の場合はCPU数）
+        workers = workers if workers is not None else settings.ingest_workers
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.errors: Dict[str, str] = {}  # 直近の読み込みで失敗したファイル
+        
         self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=settings.chunk_size,
-            chunk_overlap=settings.chunk_overlap,
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
             length_function=len,
-            separators=["\n\n", "\n", "。", "、", " ", ""]
+            separators=["\n\n", "\n", "。", "、", " ", ""],
+            add_start_index=True
         )
         
     def load_documents(self, directory: str = None) -> List[Document]:
         """指定ディレクトリから全ての文書を読み込む"""
+        return list(self.iter_documents(directory))
+    
+    def iter_documents(self, directory: str = None) -> Iterator[Document]:
+        """指定ディレクトリの文書をチャンク単位で逐次返す
+        
+        全体をリストに溜めないため、コーパスの大きさに関わらずメモリ使用量が一定に保たれる
+        """
+        for file_path, docs, error in self.iter_loaded(self.iter_files(directory)):
+            if error is None:
+                yield from docs
+    
+    def iter_loaded(self, file_paths: Iterable[str]) -> Iterator[LoadedFile]:
+        """ファイルを読み込み、分割した結果を入力と同じ順序で返す
+        
+        ワーカー数が2以上の場合はプロセスプールで並列に処理する。
+        失敗したファイルはエラーメッセージ付きで返し、errors に記録する。
+        """
+        self.errors = {}
+        
+        for file_path, docs, error in self._load_files(file_paths):
+            if error is None:
+                print(f"Loaded: {file_path}")
+                metrics.increment("documents_loaded")
+                metrics.increment("chunks_loaded", len(docs))
+            else:
+                self.errors[file_path] = error
+                print(f"Error loading {file_path}: {error}")
+                metrics.increment("document_load_errors")
+            yield file_path, docs, error
+    
+    def _load_files(self, file_paths: Iterable[str]) -> Iterator[LoadedFile]:
+        """ファイルを順に（または並列に）読み込む"""
+        if self.workers <= 1:
+            for file_path in file_paths:
+                try:
+                    yield file_path, self.load_file(file_path), None
+                except Exception as e:
+                    yield file_path, [], str(e)
+            return
+        
+        # 処理中のファイル数を制限し、結果は投入順に返す
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for file_path in file_paths:
+                pending.append(executor.submit(
+                    _load_file_worker, file_path, self.chunk_size, self.chunk_overlap
+                ))
+                if len(pending) >= self.workers * 2:
+                    yield pending.popleft().result()
+            
+            while pending:
+                yield pending.popleft().result()
+    
+    def iter_files(self, directory: str = None) -> Iterator[str]:
+        """指定ディレクトリ内のサポート対象ファイルを順に返す"""
         if directory is None:
             directory = settings.exercises_dir
-            
-        documents = []
         
         # ディレクトリが存在しない場合は作成
         Path(directory).mkdir(parents=True, exist_ok=True)
         
-        # サポートするファイル拡張子
-        supported_extensions = {
+        # ディレクトリ内のファイルを走査（順序を固定する）
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                if self.is_supported(file_path):
+                    yield file_path
+    
+    def is_supported(self, file_path: str) -> bool:
+        """サポートするファイル形式か判定"""
+        _, ext = os.path.splitext(file_path)
+        return ext.lower() in self._loaders()
+    
+    def load_file(self, file_path: str) -> List[Document]:
+        """単一のファイルを読み込み、チャンクに分割する"""
+        _, ext = os.path.splitext(file_path)
+        loader_func = self._loaders()[ext.lower()]
+        return loader_func(file_path)
+    
+    def _loaders(self) -> Dict[str, Callable[[str], List[Document]]]:
+        """サポートするファイル拡張子と読み込み関数"""
+        return {
             '.pdf': self._load_pdf,
             '.txt': self._load_text,
             '.md': self._load_text,
             '.py': self._load_text
         }
-        
-        # ディレクトリ内のファイルを走査
-        for root, _, files in os.walk(directory):
-            for file in files:
-                file_path = os.path.join(root, file)
-                _, ext = os.path.splitext(file_path)
-                
-                if ext.lower() in supported_extensions:
-                    loader_func = supported_extensions[ext.lower()]
-                    try:
-                        docs = loader_func(file_path)
-                        documents.extend(docs)
-                        print(f"Loaded: {file_path}")
-                    except Exception as e:
-                        print(f"Error loading {file_path}: {str(e)}")
-                        
-        return documents
     
     def _load_pdf(self, file_path: str) -> List[Document]:
-        """PDFファイルを読み込む"""
+        """PDFファイルを読み込む（ページごとに分割し、全ページを同時に保持しない）"""
         loader = PyPDFLoader(file_path)
-        documents = loader.load()
-        return self.text_splitter.split_documents(documents)
+        documents = []
+        for page in loader.lazy_load():
+            documents.extend(self.text_splitter.split_documents([page]))
+        return documents
     
     def _load_text(self, file_path: str) -> List[Document]:
         """テキストファイルを読み込む"""
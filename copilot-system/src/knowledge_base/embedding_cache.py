@@ -0,0 +1,186 @@
+"""埋め込みベクトルのディスクキャッシュ"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import List, Optional
+
+from langchain.embeddings.base import Embeddings
+
+from ..utils import metrics
+
+
+def text_hash(text: str) -> str:
+    """テキストのハッシュを計算"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """(埋め込みモデル, テキストハッシュ) をキーにしたSQLiteキャッシュ
+
+    件数が max_entries を超えると、最後に参照された時刻が古いものから削除する
+    """
+    
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)"
+        )
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """テキストごとのベクトルを取得（未登録の場合はNone）"""
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        
+        with self._lock:
+            # SQLiteの変数上限を超えないよう分割して問い合わせる
+            for start in range(0, len(hashes), 500):
+                batch = list(set(hashes[start:start + 500]))
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings "
+                    f"WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *batch]
+                ).fetchall()
+                found.update({row[0]: row[1] for row in rows})
+            
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, h) for h in found]
+                )
+                self._conn.commit()
+        
+        return [self._decode(found[h]) if h in found else None for h in hashes]
+    
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]) -> None:
+        """テキストとベクトルを登録"""
+        if not texts:
+            return
+        
+        now = time.time()
+        rows = [
+            (model, text_hash(text), self._encode(vector), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+            self._count += len(rows)
+            if self._count > self.max_entries:
+                self._evict()
+    
+    def delete_many(self, model: str, texts: List[str]) -> None:
+        """テキストのエントリを削除"""
+        if not texts:
+            return
+        
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM embeddings WHERE model = ? AND text_hash = ?",
+                [(model, text_hash(text)) for text in texts]
+            )
+            self._conn.commit()
+            self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    
+    def clear(self) -> None:
+        """全てのエントリを削除"""
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+            self._count = 0
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    
+    def _evict(self) -> None:
+        """古いエントリを削除して上限の9割まで減らす"""
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = self._count - int(self.max_entries * 0.9)
+        if excess <= 0:
+            return
+        
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN ("
+            "SELECT rowid FROM embeddings ORDER BY last_access LIMIT ?)",
+            (excess,)
+        )
+        self._conn.commit()
+        self._count -= excess
+    
+    @staticmethod
+    def _encode(vector: List[float]) -> bytes:
+        return array('f', vector).tobytes()
+    
+    @staticmethod
+    def _decode(blob: bytes) -> List[float]:
+        vector = array('f')
+        vector.frombytes(blob)
+        return vector.tolist()
+
+
+class CachedEmbeddings(Embeddings):
+    """埋め込み関数の前段にキャッシュを挟むラッパー"""
+    
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """文書を埋め込む（キャッシュにないものだけAPIを呼び出す）"""
+        vectors = self.cache.get_many(self.model, texts)
+        
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(texts[i], []).append(i)
+        
+        misses = sum(len(indices) for indices in missing.values())
+        metrics.increment("embedding_cache_hits", len(texts) - misses)
+        metrics.increment("embedding_cache_misses", misses)
+        
+        if missing:
+            missing_texts = list(missing)
+            new_vectors = self.embeddings.embed_documents(missing_texts)
+            self.cache.put_many(self.model, missing_texts, new_vectors)
+            for text, vector in zip(missing_texts, new_vectors):
+                for i in missing[text]:
+                    vectors[i] = vector
+        
+        return vectors
+    
+    def embed_query(self, text: str) -> List[float]:
+        """クエリを埋め込む"""
+        vector = self.cache.get_many(self.model, [text])[0]
+        metrics.increment("embedding_cache_hits" if vector is not None else "embedding_cache_misses")
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put_many(self.model, [text], [vector])
+        return vector
@@ -0,0 +1,130 @@
+"""設定に応じた埋め込みプロバイダーの作成"""
+import unicodedata
+from typing import List, Optional
+
+import numpy as np
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.embeddings.base import Embeddings
+
+from .embedding_cache import EmbeddingCache, CachedEmbeddings
+from ..utils.config import settings
+
+
+# OpenAIの埋め込みモデルごとのベクトル次元
+OPENAI_EMBEDDING_DIMENSIONS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+}
+
+# n-gram のハッシュ計算に使う定数（64bitで桁あふれさせて使う）
+_HASH_BASE = np.uint64(0x100000001B3)
+_HASH_MIX_1 = np.uint64(0xFF51AFD7ED558CCD)
+_HASH_MIX_2 = np.uint64(0xC4CEB9FE1A85EC53)
+_SHIFT_33 = np.uint64(33)
+_SHIFT_63 = np.uint64(63)
+
+
+class HashedNgramEmbeddings(Embeddings):
+    """文字 n-gram を特徴量ハッシュで固定次元に写像するローカルな埋め込み
+
+    外部APIを使わずCPUだけで計算でき、同じテキストには常に同じベクトルを返す。
+    n-gram ごとに符号付きで加算し、L2正規化したベクトルを返す。
+    """
+
+    def __init__(self, dimension: int = 1024, ngram_min: int = 2, ngram_max: int = 3):
+        self.dimension = dimension
+        self.ngram_range = range(ngram_min, ngram_max + 1)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """複数のテキストをまとめて埋め込む"""
+        return self.embed_matrix(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        """クエリを埋め込む"""
+        return self.embed_matrix([text])[0].tolist()
+
+    def embed_matrix(self, texts: List[str]) -> np.ndarray:
+        """テキストごとのベクトルを (件数, 次元) の配列で返す"""
+        hashes = [self._text_hashes(text) for text in texts]
+        rows = np.repeat(np.arange(len(texts)), [len(h) for h in hashes])
+        hashes = np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64)
+
+        buckets = (hashes % np.uint64(self.dimension)).astype(np.int64)
+        signs = np.where((hashes >> _SHIFT_63) == 1, -1.0, 1.0)
+        matrix = np.bincount(
+            rows * self.dimension + buckets,
+            weights=signs,
+            minlength=len(texts) * self.dimension
+        ).reshape(len(texts), self.dimension)
+
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms > 0, norms, 1.0)
+
+    def _text_hashes(self, text: str) -> np.ndarray:
+        """テキストに含まれる全ての n-gram のハッシュ値"""
+        text = f" {unicodedata.normalize('NFKC', text).lower()} "
+        codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        return np.concatenate([_ngram_hashes(codes, n) for n in self.ngram_range])
+
+
+def _ngram_hashes(codes: np.ndarray, n: int) -> np.ndarray:
+    """文字コード列の長さ n の部分列ごとのハッシュ値（ベクトル化した多項式ハッシュ）"""
+    count = len(codes) - n + 1
+    if count <= 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    hashes = np.full(count, np.uint64(n), dtype=np.uint64)
+    for offset in range(n):
+        hashes = hashes * _HASH_BASE + codes[offset:offset + count]
+
+    # 下位ビットに偏らないよう撹拌する
+    hashes ^= hashes >> _SHIFT_33
+    hashes *= _HASH_MIX_1
+    hashes ^= hashes >> _SHIFT_33
+    hashes *= _HASH_MIX_2
+    hashes ^= hashes >> _SHIFT_33
+    return hashes
+
+
+def embedding_dimension() -> Optional[int]:
+    """設定された埋め込みのベクトル次元（不明な場合はNone）"""
+    if settings.embedding_dimension > 0:
+        return settings.embedding_dimension
+    if settings.embedding_provider == "local":
+        return settings.local_embedding_dimension
+    return OPENAI_EMBEDDING_DIMENSIONS.get(settings.embedding_model)
+
+
+def create_embeddings() -> Embeddings:
+    """設定（embedding_provider）に応じた埋め込み関数を作成
+
+    openai: OpenAIの埋め込みAPI（設定に応じてディスクキャッシュを挟む）
+    local: ネットワーク不要のハッシュ n-gram 埋め込み
+    """
+    if settings.embedding_provider == "local":
+        # プロセス内で計算する方がキャッシュを引くより速いため、キャッシュは挟まない
+        return HashedNgramEmbeddings(
+            dimension=embedding_dimension(),
+            ngram_min=settings.local_embedding_ngram_min,
+            ngram_max=settings.local_embedding_ngram_max
+        )
+
+    if settings.embedding_provider != "openai":
+        raise ValueError(f"未対応の埋め込みプロバイダーです: {settings.embedding_provider}")
+
+    embeddings = OpenAIEmbeddings(
+        openai_api_key=settings.openai_api_key,
+        model=settings.embedding_model,
+        # レート制限などのリトライはクライアントだけで行う（呼び出し側では重ねない）
+        max_retries=settings.api_max_retries
+    )
+
+    if not settings.embedding_cache_enabled:
+        return embeddings
+
+    cache = EmbeddingCache(
+        settings.embedding_cache_path,
+        max_entries=settings.embedding_cache_max_entries
+    )
+    return CachedEmbeddings(embeddings, cache, model=settings.embedding_model)
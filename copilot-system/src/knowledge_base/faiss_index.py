@@ -0,0 +1,177 @@
+"""FAISSインデックスの種類の切り替えと読み込み"""
+import os
+import pickle
+from typing import Any, Optional
+
+import numpy as np
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.vectorstores import FAISS
+
+from ..utils.config import settings
+
+
+def _import_faiss():
+    import faiss
+    return faiss
+
+
+def factory_string(index_type: str, dimension: int, ntotal: int) -> Optional[str]:
+    """index_factory に渡す文字列を作成
+    
+    学習に十分な件数がない場合は None（フラットインデックスのまま）を返す
+    """
+    if index_type == "hnsw":
+        return f"HNSW{settings.faiss_hnsw_m}"
+    
+    if index_type in ("ivf", "pq"):
+        nlist = target_nlist(ntotal)
+        if nlist < 1:
+            return None
+        if index_type == "ivf":
+            return f"IVF{nlist},Flat"
+        
+        # PQのコードブック（256セントロイド）の学習にも件数が必要
+        if dimension % settings.faiss_pq_m != 0 or ntotal < 256:
+            return None
+        # polysemous 検索は使わないため、学習に時間のかかる polysemous training は行わない（np）
+        return f"IVF{nlist},PQ{settings.faiss_pq_m}np"
+    
+    return None
+
+
+def target_nlist(ntotal: int) -> int:
+    """件数に見合うIVFのクラスタ数"""
+    # k-means の学習には1クラスタあたり39件程度のベクトルが必要
+    return min(settings.faiss_nlist, ntotal // 39)
+
+
+def needs_training(index: Any, index_type: str) -> bool:
+    """設定された種類での（再）学習が必要か判定
+    
+    未学習の場合に加えて、IVFを少ない件数で学習した後に件数が増え、
+    件数に見合う nlist が学習済みの nlist の faiss_retrain_factor 倍以上になった場合も再学習する
+    """
+    if index_type == "flat":
+        return False
+    
+    if not index_matches(index, index_type):
+        return factory_string(index_type, index.d, index.ntotal) is not None
+    
+    if index_type in ("ivf", "pq"):
+        trained_nlist = _extract_ivf(index).nlist
+        return target_nlist(index.ntotal) >= trained_nlist * max(2, settings.faiss_retrain_factor)
+    return False
+
+
+def _extract_ivf(index: Any) -> Optional[Any]:
+    """IVFインデックス本体を具体的な型で取り出す（IVFでなければ None）"""
+    faiss = _import_faiss()
+    
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None
+    # extract_index_ivf は IndexIVF として返すため、IndexIVFPQ などの型に戻す
+    return faiss.downcast_index(ivf)
+
+
+def is_lossy(index: Any) -> bool:
+    """格納したベクトルを正確に取り出せないインデックス（PQ）か判定"""
+    faiss = _import_faiss()
+    
+    if isinstance(index, faiss.IndexPQ):
+        return True
+    return isinstance(_extract_ivf(index), faiss.IndexIVFPQ)
+
+
+def index_matches(index: Any, index_type: str) -> bool:
+    """インデックスが設定された種類で構築済みか判定"""
+    faiss = _import_faiss()
+    
+    if index_type == "hnsw":
+        return isinstance(index, faiss.IndexHNSW)
+    
+    if index_type in ("ivf", "pq"):
+        ivf = _extract_ivf(index)
+        if ivf is None:
+            return False
+        return isinstance(ivf, faiss.IndexIVFPQ) == (index_type == "pq")
+    
+    return isinstance(index, faiss.IndexFlat)
+
+
+def reconstruct_vectors(index: Any) -> np.ndarray:
+    """インデックスに格納されたベクトルを取り出す（PQの場合は近似値）"""
+    faiss = _import_faiss()
+    
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    
+    try:
+        faiss.extract_index_ivf(index).make_direct_map()
+    except RuntimeError:
+        pass
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def build_index(vectors: np.ndarray, index_type: str) -> Any:
+    """ベクトルで学習・追加したインデックスを構築"""
+    faiss = _import_faiss()
+    
+    dimension = vectors.shape[1]
+    factory = factory_string(index_type, dimension, len(vectors)) or "Flat"
+    index = faiss.index_factory(dimension, factory, faiss.METRIC_L2)
+    
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    configure_search(index)
+    return index
+
+
+def configure_search(index: Any) -> None:
+    """検索時のパラメータ（nprobe / efSearch）を設定"""
+    faiss = _import_faiss()
+    
+    params = faiss.ParameterSpace()
+    for name, value in (("nprobe", settings.faiss_nprobe),
+                        ("efSearch", settings.faiss_hnsw_ef_search)):
+        try:
+            params.set_index_parameter(index, name, value)
+        except RuntimeError:
+            # インデックスの種類に存在しないパラメータは無視する
+            pass
+
+
+def create_empty(embeddings: Any, dimension: int) -> FAISS:
+    """文書を含まない空のFAISSストアを作成（埋め込みAPIは呼ばない）"""
+    index = build_index(np.zeros((0, dimension), dtype=np.float32), settings.faiss_index_type)
+    return FAISS(embeddings, index, InMemoryDocstore({}), {})
+
+
+def load_local(index_path: str, embeddings: Any, mmap: bool = False) -> FAISS:
+    """保存済みのFAISSインデックスを読み込む
+    
+    mmap=True の場合はメモリマップ・読み取り専用で開き、
+    複数のワーカープロセスでページキャッシュを共有する。
+    ただし faiss がメモリマップするのは IVF（ivf / pq）の転置リストだけで、
+    flat・HNSW のインデックスと index.pkl（文書本文）は従来どおり全体をメモリに読み込む
+    """
+    if not mmap:
+        store = FAISS.load_local(index_path, embeddings)
+        configure_search(store.index)
+        return store
+    
+    faiss = _import_faiss()
+    index = faiss.read_index(
+        os.path.join(index_path, "index.faiss"),
+        faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    )
+    if _extract_ivf(index) is None:
+        print("FAISS_MMAP has no effect on non-IVF indexes; the index was loaded into memory")
+    configure_search(index)
+    
+    with open(os.path.join(index_path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
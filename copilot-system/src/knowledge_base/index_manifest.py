@@ -0,0 +1,104 @@
+"""インデックス済みファイルを記録するマニフェスト"""
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Any, List, Optional
+
+
+def file_hash(file_path: str) -> str:
+    """ファイル内容のハッシュを計算"""
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def chunk_ids(source: str, contents: List[str]) -> List[str]:
+    """ファイル名とチャンク内容から決定的なチャンクIDを生成
+
+    同一ファイル内で内容が重複するチャンクには出現回数を付与して区別する
+    """
+    ids = []
+    seen: Dict[str, int] = {}
+    for content in contents:
+        digest = hashlib.sha256(f"{source}\n{content}".encode('utf-8')).hexdigest()
+        count = seen.get(digest, 0)
+        seen[digest] = count + 1
+        ids.append(digest if count == 0 else f"{digest}-{count}")
+    return ids
+
+
+class IndexManifest:
+    """ファイルパス・更新時刻・内容ハッシュ・チャンクIDを永続化するクラス"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        # 遅延永続化のタイマーから保存される場合があるため、更新と保存を排他制御する
+        self._lock = threading.Lock()
+        self.load()
+    
+    def load(self) -> None:
+        """マニフェストを読み込む"""
+        if not os.path.exists(self.path):
+            self.entries = {}
+            return
+        
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f).get("files", {})
+        except (OSError, ValueError) as e:
+            # 壊れたマニフェストは無視して全件を再インデックスする
+            print(f"Error loading manifest {self.path}: {str(e)}")
+            self.entries = {}
+    
+    def save(self) -> None:
+        """マニフェストを保存（一時ファイル経由で置き換える）"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with self._lock:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"files": self.entries}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+    
+    def get(self, file_path: str) -> Optional[Dict[str, Any]]:
+        """ファイルのエントリを取得"""
+        return self.entries.get(file_path)
+    
+    def update(self,
+               file_path: str,
+               mtime: float,
+               size: int,
+               content_hash: str,
+               ids: List[str]) -> None:
+        """ファイルのエントリを更新"""
+        with self._lock:
+            self.entries[file_path] = {
+                "mtime": mtime,
+                "size": size,
+                "hash": content_hash,
+                "chunk_ids": ids
+            }
+    
+    def remove(self, file_path: str) -> List[str]:
+        """ファイルのエントリを削除し、登録されていたチャンクIDを返す"""
+        with self._lock:
+            entry = self.entries.pop(file_path, None)
+        return entry["chunk_ids"] if entry else []
+    
+    def files_under(self, directory: str) -> List[str]:
+        """指定ディレクトリ配下の登録済みファイルを取得"""
+        prefix = os.path.join(os.path.abspath(directory), "")
+        return [path for path in self.entries if path.startswith(prefix)]
+    
+    def is_unchanged(self, file_path: str, mtime: float, size: int) -> bool:
+        """更新時刻とサイズが前回と同じか判定"""
+        entry = self.entries.get(file_path)
+        return bool(entry) and entry["mtime"] == mtime and entry["size"] == size
+    
+    def clear(self) -> None:
+        """全てのエントリを削除"""
+        with self._lock:
+            self.entries = {}
@@ -0,0 +1,243 @@
+"""日本語に対応した語彙検索（BM25）用の転置インデックス"""
+import hashlib
+import math
+import os
+import pickle
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from langchain.schema import Document
+
+
+# 英数字の識別子（エラー名・関数名など）と番号（演習3-2 など）
+_IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+(?:[.\-]\d+)*")
+# 漢字・カタカナの連続（ひらがなは助詞や送り仮名が多いため対象外）
+_CJK_PATTERN = re.compile(r"[一-鿿㐀-䶿々]+|[゠-ヿー]+")
+_CAMEL_PATTERN = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+
+def tokenize(text: str) -> List[str]:
+    """語彙検索用にテキストをトークンに分割
+    
+    英数字は識別子単位（CamelCase・snake_case は構成語も追加）、
+    漢字・カタカナは文字バイグラムに分割する
+    """
+    text = unicodedata.normalize("NFKC", text)
+    tokens = []
+    
+    for word in _IDENTIFIER_PATTERN.findall(text):
+        tokens.append(word.lower())
+        parts = [part.lower() for part in _CAMEL_PATTERN.findall(word.replace("_", " "))]
+        if len(parts) > 1:
+            tokens.extend(parts)
+    
+    for run in _CJK_PATTERN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    
+    return tokens
+
+
+def document_key(doc: Document) -> str:
+    """検索結果を突き合わせるための文書キー（出典と内容から生成）"""
+    source = doc.metadata.get("source", "")
+    return hashlib.sha256(f"{source}\n{doc.page_content}".encode("utf-8")).hexdigest()
+
+
+class LexicalIndex:
+    """BM25でスコアリングする転置インデックス
+    
+    保存時は前回の保存以降の追加・削除だけを変更ログに追記し、
+    ログがインデックス本体より大きくなったときに全体を書き直す
+    """
+    
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[str, int]] = defaultdict(dict)
+        self.doc_lengths: Dict[str, int] = {}
+        self.documents: Dict[str, Document] = {}
+        self.total_length = 0
+        self._lock = threading.RLock()
+        # 未保存の変更（("add", ids, documents) または ("remove", ids)）
+        self._pending: List[tuple] = []
+        # 変更ログに追記済みの文書数（全体を書き直すかの判定に使う）
+        self._logged = 0
+        # 次の保存で全体を書き直すか（全削除後・ログが壊れていた場合）
+        self._needs_compaction = False
+    
+    def __len__(self) -> int:
+        return len(self.documents)
+    
+    def add(self, ids: List[str], documents: List[Document]) -> None:
+        """文書を追加（同じIDがあれば置き換える）"""
+        with self._lock:
+            self._pending.append(("add", list(ids), list(documents)))
+            self._add(ids, documents)
+    
+    def _add(self, ids: List[str], documents: List[Document]) -> None:
+        with self._lock:
+            self._remove([doc_id for doc_id in ids if doc_id in self.documents])
+            for doc_id, doc in zip(ids, documents):
+                counts = Counter(tokenize(doc.page_content))
+                for term, count in counts.items():
+                    self.postings[term][doc_id] = count
+                length = sum(counts.values())
+                self.doc_lengths[doc_id] = length
+                self.total_length += length
+                self.documents[doc_id] = doc
+    
+    def remove(self, ids: Iterable[str]) -> None:
+        """文書を削除"""
+        with self._lock:
+            ids = list(ids)
+            self._pending.append(("remove", ids))
+            self._remove(ids)
+    
+    def _remove(self, ids: Iterable[str]) -> None:
+        with self._lock:
+            for doc_id in ids:
+                doc = self.documents.pop(doc_id, None)
+                if doc is None:
+                    continue
+                for term in set(tokenize(doc.page_content)):
+                    posting = self.postings.get(term)
+                    if posting is not None:
+                        posting.pop(doc_id, None)
+                        if not posting:
+                            del self.postings[term]
+                self.total_length -= self.doc_lengths.pop(doc_id, 0)
+    
+    def clear(self) -> None:
+        """全ての文書を削除"""
+        with self._lock:
+            self._pending = []
+            self._needs_compaction = True
+            self.postings = defaultdict(dict)
+            self.doc_lengths = {}
+            self.documents = {}
+            self.total_length = 0
+    
+    def search(self, query: str, k: int = 5) -> List[Tuple[Document, float]]:
+        """BM25スコアの高い順に文書を返す"""
+        with self._lock:
+            if not self.documents:
+                return []
+            
+            num_docs = len(self.documents)
+            avg_length = self.total_length / num_docs or 1.0
+            scores: Dict[str, float] = defaultdict(float)
+            
+            for term in set(tokenize(query)):
+                posting = self.postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (num_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+                for doc_id, tf in posting.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length)
+                    scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+            
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            return [(self.documents[doc_id], score) for doc_id, score in ranked]
+    
+    def save(self, path: str) -> None:
+        """インデックスを保存
+        
+        前回の保存以降の変更だけを変更ログ（path + ".log"）に追記する。
+        初回・全削除後・ログが本体より大きくなった場合は、全体を一時ファイル経由で書き直す
+        """
+        with self._lock:
+            if not self._pending and not self._needs_compaction and os.path.exists(path):
+                return
+            
+            pending_docs = sum(len(op[1]) for op in self._pending)
+            compact = (
+                self._needs_compaction
+                or not os.path.exists(path)
+                or self._logged + pending_docs > len(self.documents)
+            )
+            
+            if compact:
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    pickle.dump((dict(self.postings), self.doc_lengths, self.documents), f)
+                os.replace(tmp_path, path)
+                if os.path.exists(self._log_path(path)):
+                    os.remove(self._log_path(path))
+                self._logged = 0
+                self._needs_compaction = False
+            else:
+                with open(self._log_path(path), "ab") as f:
+                    for op in self._pending:
+                        pickle.dump(op, f)
+                self._logged += pending_docs
+            
+            self._pending = []
+    
+    @classmethod
+    def load(cls, path: str) -> Optional["LexicalIndex"]:
+        """保存済みのインデックスを読み込み、変更ログを適用する（存在しない場合はNone）"""
+        if not os.path.exists(path):
+            return None
+        
+        index = cls()
+        try:
+            with open(path, "rb") as f:
+                postings, doc_lengths, documents = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, ValueError) as e:
+            print(f"Error loading lexical index {path}: {str(e)}")
+            return None
+        
+        index.postings = defaultdict(dict, postings)
+        index.doc_lengths = doc_lengths
+        index.documents = documents
+        index.total_length = sum(doc_lengths.values())
+        index._replay_log(cls._log_path(path))
+        return index
+    
+    def _replay_log(self, log_path: str) -> None:
+        """変更ログの内容を順に適用（書き込み途中で終わった末尾の記録は無視する）"""
+        if not os.path.exists(log_path):
+            return
+        
+        with open(log_path, "rb") as f:
+            while True:
+                try:
+                    op = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, AttributeError) as e:
+                    # 以降の追記が読めなくならないよう、次の保存で全体を書き直す
+                    print(f"Ignoring truncated lexical index log {log_path}: {str(e)}")
+                    self._needs_compaction = True
+                    break
+                
+                if op[0] == "add":
+                    self._add(op[1], op[2])
+                else:
+                    self._remove(op[1])
+                self._logged += len(op[1])
+    
+    @staticmethod
+    def _log_path(path: str) -> str:
+        return f"{path}.log"
+
+
+def reciprocal_rank_fusion(rankings: List[List[Document]], k: int = 60) -> List[Tuple[Document, float]]:
+    """複数のランキングを Reciprocal Rank Fusion で統合"""
+    scores: Dict[str, float] = defaultdict(float)
+    documents: Dict[str, Document] = {}
+    
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = document_key(doc)
+            scores[key] += 1.0 / (k + rank + 1)
+            documents.setdefault(key, doc)
+    
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    return [(documents[key], score) for key, score in ranked]
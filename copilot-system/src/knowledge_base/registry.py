@@ -0,0 +1,54 @@
+"""プロセス全体で共有するベクトルストア・リトリーバーのレジストリ"""
+import threading
+from typing import Dict, Tuple
+
+from .vector_store import VectorStore
+from ..utils.config import settings
+
+
+_lock = threading.Lock()
+_vector_stores: Dict[Tuple[str, str], VectorStore] = {}
+_retrievers: Dict[Tuple[str, str], "KnowledgeRetriever"] = {}
+
+
+def _store_key() -> Tuple[str, str]:
+    """現在の設定に対応するレジストリのキーを取得"""
+    return (settings.vector_store_type, settings.vector_store_path)
+
+
+def get_shared_vector_store() -> VectorStore:
+    """設定ごとに1つだけ生成されるVectorStoreを取得"""
+    key = _store_key()
+    store = _vector_stores.get(key)
+    if store is not None:
+        return store
+    
+    with _lock:
+        # ロック取得までに他のスレッドが生成している場合はそれを使う
+        if key not in _vector_stores:
+            _vector_stores[key] = VectorStore()
+        return _vector_stores[key]
+
+
+def get_shared_retriever() -> "KnowledgeRetriever":
+    """共有VectorStoreを使うKnowledgeRetrieverを取得"""
+    # retriever モジュールがこのモジュールを参照するため、ここで読み込む
+    from .retriever import KnowledgeRetriever
+    
+    key = _store_key()
+    retriever = _retrievers.get(key)
+    if retriever is not None:
+        return retriever
+    
+    vector_store = get_shared_vector_store()
+    with _lock:
+        if key not in _retrievers:
+            _retrievers[key] = KnowledgeRetriever(vector_store=vector_store)
+        return _retrievers[key]
+
+
+def reset_registry() -> None:
+    """レジストリをクリア（主にテスト用）"""
+    with _lock:
+        _vector_stores.clear()
+        _retrievers.clear()
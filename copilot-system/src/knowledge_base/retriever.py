@@ -1,26 +1,205 @@
-from typing import List, Optional, Dict, Any
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
 from langchain.schema import Document
 
 from .document_loader import DocumentLoader
 from .vector_store import VectorStore
+from .registry import get_shared_vector_store
+from .index_manifest import IndexManifest, chunk_ids, file_hash
+from .lexical_index import reciprocal_rank_fusion
+from .context_builder import build_context
+from ..utils import metrics
+from ..utils.config import settings
+
+
+# マニフェストの読み書きとストアの更新を直列化するロック
+_index_lock = threading.Lock()
+
+
+@dataclass
+class RetrievalResult:
+    """1回の検索結果を保持するクラス
+
+    コンテキスト生成・参照文書一覧・評価など、同じリクエスト内の
+    複数の処理で共有し、検索を1回で済ませるために使用する。
+    
+    scores の意味は mode によって異なる:
+    dense はベクトル距離（小さいほど類似）、lexical は BM25 スコア、
+    hybrid は Reciprocal Rank Fusion のスコア（いずれも大きいほど関連）。
+    """
+    query: str
+    documents: List[Document] = field(default_factory=list)
+    scores: List[float] = field(default_factory=list)
+    mode: str = "dense"
+
+    def __bool__(self) -> bool:
+        return bool(self.documents)
+
+    @property
+    def context(self) -> str:
+        """検索結果からコンテキストを生成"""
+        return self.build_context()
+
+    def build_context(self,
+                      limit: Optional[int] = None,
+                      max_tokens: Optional[int] = None,
+                      count_tokens: Optional[Callable[[str], int]] = None) -> str:
+        """上位 limit 件の文書を結合してコンテキストを作成
+        
+        重複・隣接するチャンクは結合し、max_tokens を指定した場合は
+        順位の高いものからトークン数の上限に収まるだけ含める
+        """
+        documents = self.documents if limit is None else self.documents[:limit]
+        return build_context(documents, max_tokens=max_tokens, count_tokens=count_tokens)
+
+    def top(self, k: int) -> List[Document]:
+        """上位 k 件の文書を取得"""
+        return self.documents[:k]
+
+    def sources(self, k: Optional[int] = None, preview_length: int = 200) -> List[Dict[str, Any]]:
+        """参照文書の一覧（プレビューとメタデータ）を作成"""
+        documents = self.documents if k is None else self.documents[:k]
+        return [
+            {
+                "content": doc.page_content[:preview_length] + "...",
+                "metadata": doc.metadata
+            } for doc in documents
+        ]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """JSONに変換できる要約（検索方式と、文書ごとの出典・チャンクID・スコア）"""
+        scores = self.scores or [None] * len(self.documents)
+        return {
+            "query": self.query,
+            "mode": self.mode,
+            "sources": [
+                {
+                    "source": doc.metadata.get("source"),
+                    "chunk_id": doc.metadata.get("chunk_id"),
+                    "score": score
+                }
+                for doc, score in zip(self.documents, scores)
+            ]
+        }
 
 
 class KnowledgeRetriever:
     """知識ベースから情報を検索するクラス"""
     
-    def __init__(self):
+    def __init__(self, vector_store: Optional[VectorStore] = None):
         self.document_loader = DocumentLoader()
-        self.vector_store = VectorStore()
+        # 指定がなければプロセス全体で共有するベクトルストアを使用
+        self.vector_store = vector_store if vector_store is not None else get_shared_vector_store()
         
     def index_documents(self, directory: Optional[str] = None) -> int:
-        """ディレクトリ内の文書をインデックス化"""
-        documents = self.document_loader.load_documents(directory)
+        """ディレクトリ内の文書を差分インデックス化
+        
+        マニフェストと比較し、新規・変更されたファイルのチャンクだけを埋め込み、
+        削除されたファイルのチャンクはベクトルストアから取り除く。
+        新たに追加したチャンク数を返す。
+        """
+        if directory is None:
+            directory = settings.exercises_dir
+        
+        with _index_lock, metrics.span("retriever.index_documents") as span:
+            manifest_exists = os.path.exists(self.manifest_path())
+            manifest = IndexManifest(self.manifest_path())
+            if not manifest_exists and not self.vector_store.is_empty():
+                # マニフェスト導入前に作られたストアのチャンクにはIDがなく、
+                # 差分で置き換えられずに重複するため、一度だけ全て作り直す
+                print("Index has no manifest; rebuilding it from scratch")
+                self.vector_store.delete_all()
+            seen_files = set()
+            changed_files = {}
+            added = 0
+            
+            for file_path in self.document_loader.iter_files(directory):
+                file_path = os.path.abspath(file_path)
+                seen_files.add(file_path)
+                
+                stat = os.stat(file_path)
+                if manifest.is_unchanged(file_path, stat.st_mtime, stat.st_size):
+                    continue
+                
+                content_hash = file_hash(file_path)
+                entry = manifest.get(file_path)
+                if entry and entry["hash"] == content_hash:
+                    # 内容が同じ場合は更新時刻だけ記録し直す
+                    manifest.update(file_path, stat.st_mtime, stat.st_size,
+                                    content_hash, entry["chunk_ids"])
+                    continue
+                
+                changed_files[file_path] = (stat, content_hash, entry)
+            
+            # 新規・変更されたファイルだけを（設定に応じて並列に）読み込み、
+            # 一定数のチャンクがたまるごとに埋め込んでストアへ書き込む
+            window: List[Document] = []
+            window_files = []
+            for file_path, documents, error in self.document_loader.iter_loaded(changed_files):
+                if error is not None:
+                    continue
+                
+                stat, content_hash, entry = changed_files[file_path]
+                window.extend(self._diff_file_chunks(file_path, documents, entry))
+                window_files.append((file_path, stat, content_hash,
+                                     [doc.metadata["chunk_id"] for doc in documents]))
+                
+                if len(window) >= settings.index_window_size:
+                    added += self._flush_window(window, window_files, manifest)
+                    window, window_files = [], []
+            
+            added += self._flush_window(window, window_files, manifest)
+            
+            # 削除されたファイルのチャンクを取り除く
+            for file_path in manifest.files_under(directory):
+                if file_path not in seen_files:
+                    self.vector_store.delete(manifest.remove(file_path))
+                    print(f"Removed: {file_path}")
+            
+            # ストアの永続化が済んでからマニフェストを保存する
+            self.vector_store.after_persist(manifest.save)
+            span.set(files=len(changed_files), chunks=added)
+        
+        print(f"Indexed {added} document chunks")
+        return added
+    
+    def _diff_file_chunks(self,
+                          file_path: str,
+                          documents: List[Document],
+                          entry: Optional[Dict[str, Any]]) -> List[Document]:
+        """ファイルの古いチャンクを削除し、新たに追加が必要なチャンクを返す"""
+        ids = chunk_ids(file_path, [doc.page_content for doc in documents])
+        for doc, chunk_id in zip(documents, ids):
+            doc.metadata["chunk_id"] = chunk_id
+        
+        old_ids = set(entry["chunk_ids"]) if entry else set()
+        self.vector_store.delete(sorted(old_ids - set(ids)))
+        return [doc for doc, chunk_id in zip(documents, ids) if chunk_id not in old_ids]
+    
+    def _flush_window(self,
+                      window: List[Document],
+                      window_files: List[tuple],
+                      manifest: IndexManifest) -> int:
+        """ためたチャンクをストアへ書き込み、対応するファイルをマニフェストに記録"""
+        self.vector_store.add_documents(
+            window, ids=[doc.metadata["chunk_id"] for doc in window]
+        )
         
-        if documents:
-            self.vector_store.add_documents(documents)
-            print(f"Indexed {len(documents)} document chunks")
-            return len(documents)
-        return 0
+        for file_path, stat, content_hash, ids in window_files:
+            manifest.update(file_path, stat.st_mtime, stat.st_size, content_hash, ids)
+        if window_files:
+            self.vector_store.after_persist(manifest.save)
+        
+        return len(window)
+    
+    def manifest_path(self) -> str:
+        """インデックスマニフェストの保存先"""
+        return os.path.join(
+            settings.vector_store_path,
+            f"index_manifest_{settings.vector_store_type}.json"
+        )
     
     def retrieve(self, query: str, k: int = 5, filter: Optional[Dict[str, Any]] = None) -> List[Document]:
         """クエリに関連する文書を取得"""
@@ -30,21 +209,144 @@ class KnowledgeRetriever:
         """スコア付きで関連文書を取得"""
         return self.vector_store.search_with_score(query, k=k)
     
-    def get_context(self, query: str, k: int = 5) -> str:
+    def retrieve_result(self,
+                        query: str,
+                        k: int = 5,
+                        embedding: Optional[List[float]] = None,
+                        mode: Optional[str] = None) -> RetrievalResult:
+        """クエリを1回だけ検索し、共有可能な検索結果を返す
+        
+        埋め込み済みのクエリベクトルを渡した場合は再度の埋め込みを省略する。
+        語彙検索の結果が決定的な場合は埋め込み自体を行わない。
+        """
+        mode = mode or settings.retrieval_mode
+        with metrics.span("retriever.retrieve"):
+            lexical = self._lexical_candidates(query, k, mode)
+            if self._use_lexical_only(lexical, mode):
+                return self._build_result(query, lexical[:k], "lexical")
+            
+            fetch_k = k * 2 if lexical else k
+            if embedding is not None:
+                dense = self.vector_store.search_with_score_by_vector(embedding, k=fetch_k)
+            else:
+                dense = self.retrieve_with_score(query, k=fetch_k)
+            return self._combine(query, k, dense, lexical)
+    
+    async def aretrieve(self, query: str, k: int = 5) -> List[Document]:
+        """クエリに関連する文書を取得（非同期版）"""
+        results = await self.vector_store.asearch_with_score(query, k=k)
+        return [doc for doc, _ in results]
+    
+    async def aretrieve_result(self,
+                               query: str,
+                               k: int = 5,
+                               embedding: Optional[List[float]] = None,
+                               mode: Optional[str] = None) -> RetrievalResult:
+        """クエリを1回だけ検索し、共有可能な検索結果を返す（非同期版）"""
+        mode = mode or settings.retrieval_mode
+        with metrics.span("retriever.retrieve"):
+            lexical = self._lexical_candidates(query, k, mode)
+            if self._use_lexical_only(lexical, mode):
+                return self._build_result(query, lexical[:k], "lexical")
+            
+            fetch_k = k * 2 if lexical else k
+            if embedding is None:
+                embedding = await self.aembed_query(query)
+            dense = await self.vector_store.asearch_with_score_by_vector(embedding, k=fetch_k)
+            return self._combine(query, k, dense, lexical)
+    
+    def lexical_result(self, query: str, k: int = 5, mode: Optional[str] = None) -> Optional[RetrievalResult]:
+        """語彙検索の結果だけで決まる場合にその検索結果を返す（決まらない場合は None）
+        
+        埋め込みを行わないため、回答キャッシュの参照のために埋め込む前に確認しておくと、
+        語彙検索で決まる質問では埋め込みAPIの呼び出しを省略できる
+        """
+        mode = mode or settings.retrieval_mode
+        lexical = self._lexical_candidates(query, k, mode)
+        if not self._use_lexical_only(lexical, mode):
+            return None
+        return self._build_result(query, lexical[:k], "lexical")
+    
+    def _lexical_candidates(self, query: str, k: int, mode: str) -> List[tuple]:
+        """語彙検索の候補を取得（dense モードでは検索しない）"""
+        if mode == "dense":
+            return []
+        return self.vector_store.lexical_search(query, k=k * 2)
+    
+    @staticmethod
+    def _use_lexical_only(lexical: List[tuple], mode: str) -> bool:
+        """語彙検索の結果だけで回答できるかを判定
+        
+        エラー名や関数名など、1件が他を大きく引き離して一致する場合は
+        ベクトル検索（埋め込みAPIの呼び出し）を省略する。
+        キャッシュ参照のために埋め込み済みでも判定は変えず、結果を揃える
+        """
+        if mode == "lexical":
+            return True
+        if not lexical:
+            return False
+        
+        top_score = lexical[0][1]
+        if top_score < settings.lexical_min_score:
+            return False
+        if len(lexical) == 1:
+            return True
+        return top_score >= lexical[1][1] * settings.lexical_decisive_ratio
+    
+    @staticmethod
+    def _combine(query: str,
+                 k: int,
+                 dense: List[tuple],
+                 lexical: List[tuple]) -> RetrievalResult:
+        """ベクトル検索と語彙検索の結果を RRF で統合"""
+        if not lexical:
+            return KnowledgeRetriever._build_result(query, dense[:k], "dense")
+        
+        fused = reciprocal_rank_fusion(
+            [[doc for doc, _ in dense], [doc for doc, _ in lexical]],
+            k=settings.rrf_k
+        )
+        return KnowledgeRetriever._build_result(query, fused[:k], "hybrid")
+    
+    @staticmethod
+    def _build_result(query: str, results: List[tuple], mode: str) -> RetrievalResult:
+        """(文書, スコア) の一覧から検索結果を作成"""
+        metrics.increment("retrievals", mode=mode)
+        metrics.increment("chunks_retrieved", len(results))
+        return RetrievalResult(
+            query=query,
+            documents=[doc for doc, _ in results],
+            scores=[float(score) for _, score in results],
+            mode=mode
+        )
+    
+    async def aembed_query(self, query: str) -> List[float]:
+        """クエリの埋め込みベクトルを取得（非同期版）"""
+        return await self.vector_store.aembed_query(query)
+    
+    def embed_query(self, query: str) -> List[float]:
+        """クエリの埋め込みベクトルを取得"""
+        return self.vector_store.embed_query(query)
+    
+    @property
+    def index_version(self) -> int:
+        """インデックスのバージョン（内容が変わるたびに増える）"""
+        return self.vector_store.version
+    
+    def get_context(self,
+                    query: str,
+                    k: int = 5,
+                    max_tokens: Optional[int] = None,
+                    count_tokens: Optional[Callable[[str], int]] = None) -> str:
         """クエリに関連するコンテキストを生成"""
         documents = self.retrieve(query, k=k)
         
         if not documents:
             return ""
         
-        # 文書を結合してコンテキストを作成
-        context_parts = []
-        for i, doc in enumerate(documents):
-            source = doc.metadata.get('source', 'Unknown')
-            content = doc.page_content.strip()
-            context_parts.append(f"[文書{i+1} - {source}]\n{content}")
-        
-        return "\n\n".join(context_parts)
+        return RetrievalResult(query=query, documents=documents).build_context(
+            max_tokens=max_tokens, count_tokens=count_tokens
+        )
     
     def add_single_document(self, content: str, metadata: Dict[str, Any]) -> None:
         """単一の文書を追加"""
@@ -54,5 +356,9 @@ class KnowledgeRetriever:
     
     def clear_index(self) -> None:
         """インデックスをクリア"""
-        self.vector_store.delete_all()
-        print("Index cleared")
\ No newline at end of file
+        with _index_lock:
+            self.vector_store.delete_all()
+            manifest = IndexManifest(self.manifest_path())
+            manifest.clear()
+            manifest.save()
+        print("Index cleared")
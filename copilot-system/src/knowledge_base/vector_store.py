@@ -1,23 +1,87 @@
-from typing import List, Optional
+from typing import Callable, Iterator, List, Optional, Set
+import asyncio
+import atexit
 import os
+import shutil
+import sys
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
-from langchain.vectorstores import Chroma, FAISS
-from langchain.embeddings import OpenAIEmbeddings
+import numpy as np
+from langchain.vectorstores import Chroma
 from langchain.schema import Document
+from langchain.embeddings.base import Embeddings
 
+from . import faiss_index
+from .embedding_cache import EmbeddingCache
+from .embeddings import create_embeddings, embedding_dimension
+from .lexical_index import LexicalIndex
+from ..utils import metrics
 from ..utils.config import settings
+from ..utils.concurrency import get_request_limiter
+
+
+# PQ の再学習用に保存する元のベクトルのキー（EmbeddingCache のモデル名として使う）
+_ORIGINAL_VECTORS_MODEL = "faiss-original"
+
+
+class _PrecomputedEmbeddings(Embeddings):
+    """計算済みの埋め込みを Chroma に渡すためのアダプタ
+    
+    Chroma の公開 API（add_texts）は登録時に embedding_function で埋め込みを計算するため、
+    並列に計算済みのベクトルを provide() で渡しておき、その間だけそれを返す。
+    それ以外（クエリなど）は元の埋め込みに委譲する。
+    """
+    
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+        self._provided: Optional[List[List[float]]] = None
+    
+    @contextmanager
+    def provide(self, vectors: List[List[float]]) -> Iterator[None]:
+        """ブロック内の次の embed_documents で vectors を返す"""
+        self._provided = vectors
+        try:
+            yield
+        finally:
+            self._provided = None
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors, self._provided = self._provided, None
+        if vectors is not None and len(vectors) == len(texts):
+            return vectors
+        return self.embeddings.embed_documents(texts)
+    
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
 
 
 class VectorStore:
     """ベクトルストアを管理するクラス"""
     
-    def __init__(self):
-        self.embeddings = OpenAIEmbeddings(
-            openai_api_key=settings.openai_api_key
-        )
+    def __init__(self, embeddings: Optional[Embeddings] = None):
+        self.embeddings = embeddings if embeddings is not None else create_embeddings()
+        self._chroma_embeddings = _PrecomputedEmbeddings(self.embeddings)
         self.vector_store = None
+        # 複数セッションから共有されるため、書き込みはロックで直列化する
+        self._lock = threading.RLock()
+        # 内容が変わるたびに増えるバージョン（回答キャッシュの無効化に使用）
+        self.version = 0
+        # 遅延永続化の状態
+        self._dirty_chunks = 0
+        self._persist_timer: Optional[threading.Timer] = None
+        self._persist_callbacks: List[Callable[[], None]] = []
+        # ベクトル検索と並行して維持する語彙検索用インデックス
+        self.lexical_index: Optional[LexicalIndex] = None
+        # PQ インデックスの元のベクトル（必要になった時点で開く）
+        self._original_store: Optional[EmbeddingCache] = None
         self._initialize_store()
+        self._load_lexical_index()
+        atexit.register(self.flush)
     
     def _initialize_store(self):
         """ベクトルストアを初期化"""
@@ -26,70 +90,492 @@ class VectorStore:
         if settings.vector_store_type == "chroma":
             self.vector_store = Chroma(
                 persist_directory=settings.vector_store_path,
-                embedding_function=self.embeddings
+                embedding_function=self._chroma_embeddings
             )
         elif settings.vector_store_type == "faiss":
             # FAISSの場合、既存のインデックスがあれば読み込む
-            index_path = os.path.join(settings.vector_store_path, "faiss_index")
+            index_path = self._faiss_index_path()
+            backup_path = f"{index_path}.old"
+            if not os.path.exists(index_path) and os.path.exists(backup_path):
+                # 保存中に中断した場合は直前のインデックスを復元する
+                os.replace(backup_path, index_path)
             if os.path.exists(index_path):
-                self.vector_store = FAISS.load_local(
-                    index_path, 
-                    self.embeddings
+                self.vector_store = faiss_index.load_local(
+                    index_path,
+                    self.embeddings,
+                    mmap=settings.faiss_mmap
                 )
             else:
-                # 新規作成（ダミー文書で初期化）
-                dummy_doc = [Document(page_content="init", metadata={"type": "init"})]
-                self.vector_store = FAISS.from_documents(
-                    dummy_doc, 
-                    self.embeddings
-                )
+                # 新規作成（次元が分からない場合は最初の追加時に作成する）
+                self.vector_store = self._create_empty_faiss(self._embedding_dimension())
     
-    def add_documents(self, documents: List[Document]) -> None:
-        """文書をベクトルストアに追加"""
+    def add_documents(self, documents: List[Document], ids: Optional[List[str]] = None) -> None:
+        """文書をベクトルストアに追加
+        
+        埋め込みはバッチに分けて並列に計算し、レート制限時はバックオフしてリトライする。
+        一定バッチごとに永続化するため、中断後に同じIDで再実行すると
+        保存済みのチャンクは埋め込まずにスキップされる。
+        """
         if not documents:
             return
+        
+        self._check_writable()
+        if ids is None:
+            ids = [uuid.uuid4().hex for _ in documents]
+        
+        with self._lock:
+            if self.vector_store is None:
+                self._initialize_store()
+        
+        # 前回の中断までに保存済みのチャンクは除外する
+        existing = self.existing_ids(ids)
+        pending = [(doc, doc_id) for doc, doc_id in zip(documents, ids) if doc_id not in existing]
+        if existing:
+            print(f"Skipping {len(documents) - len(pending)} already indexed chunks")
+        
+        batch_size = max(1, settings.embedding_batch_size)
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        
+        metrics.increment("chunks_skipped", len(documents) - len(pending))
+        for count, (batch, vectors) in enumerate(self._embed_batches(batches), 1):
+            with self._lock:
+                self._add_embedded(
+                    [doc for doc, _ in batch], vectors, [doc_id for _, doc_id in batch]
+                )
+                metrics.increment("chunks_indexed", len(batch))
+                self.version += 1
+                # チェックポイントとして定期的に永続化
+                checkpoint = count % max(1, settings.embedding_checkpoint_batches) == 0
+                self._mark_written(len(batch), checkpoint=checkpoint)
+        
+        with self._lock:
+            if settings.vector_store_type == "faiss" and self.vector_store is not None:
+                self._train_faiss_index()
+            self._mark_written(0, checkpoint=True)
+    
+    def _embed_batches(self, batches: List[List[tuple]]) -> Iterator[tuple]:
+        """バッチごとの埋め込みを並列に計算し、投入順に返す"""
+        concurrency = max(1, settings.embedding_concurrency)
+        
+        def embed(batch: List[tuple]) -> List[List[float]]:
+            texts = [doc.page_content for doc, _ in batch]
+            with metrics.span("vector_store.embed_documents") as span:
+                span.set(texts=len(texts))
+                return self.embeddings.embed_documents(texts)
+        
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = deque()
+            for batch in batches:
+                pending.append((batch, executor.submit(embed, batch)))
+                if len(pending) >= concurrency * 2:
+                    batch, future = pending.popleft()
+                    yield batch, future.result()
             
+            while pending:
+                batch, future = pending.popleft()
+                yield batch, future.result()
+    
+    def _add_embedded(self,
+                      documents: List[Document],
+                      vectors: List[List[float]],
+                      ids: List[str]) -> None:
+        """埋め込み済みの文書をストアに追加"""
+        texts = [doc.page_content for doc in documents]
+        metadatas = [{**doc.metadata, "chunk_id": doc_id} for doc, doc_id in zip(documents, ids)]
+        
+        if self.lexical_index is not None:
+            self.lexical_index.add(ids, [
+                Document(page_content=text, metadata=metadata)
+                for text, metadata in zip(texts, metadatas)
+            ])
+        
+        if settings.vector_store_type == "chroma":
+            # add_texts は同じIDを上書き（upsert）する
+            with self._chroma_embeddings.provide(vectors):
+                self.vector_store.add_texts(texts, metadatas=metadatas, ids=ids)
+        elif settings.vector_store_type == "faiss":
+            if self.vector_store is None:
+                self.vector_store = self._create_empty_faiss(len(vectors[0]))
+            self.vector_store.add_embeddings(
+                list(zip(texts, vectors)),
+                metadatas=metadatas,
+                ids=ids
+            )
+            original_store = self._original_vectors_store()
+            if original_store is not None:
+                original_store.put_many(_ORIGINAL_VECTORS_MODEL, ids, vectors)
+    
+    def existing_ids(self, ids: List[str]) -> Set[str]:
+        """ストアに保存済みのIDを取得"""
+        if not ids or self.vector_store is None:
+            return set()
+        
+        if settings.vector_store_type == "chroma":
+            return set(self.vector_store.get(ids=ids, include=[])["ids"])
+        elif settings.vector_store_type == "faiss":
+            stored = set(self.vector_store.index_to_docstore_id.values())
+            return {doc_id for doc_id in ids if doc_id in stored}
+        return set()
+    
+    def is_empty(self) -> bool:
+        """ストアに文書が1件もないかどうか"""
         if self.vector_store is None:
-            self._initialize_store()
-            
-        self.vector_store.add_documents(documents)
+            return True
         
-        # 永続化
         if settings.vector_store_type == "chroma":
-            self.vector_store.persist()
+            return not self.vector_store.get(limit=1, include=[])["ids"]
         elif settings.vector_store_type == "faiss":
-            index_path = os.path.join(settings.vector_store_path, "faiss_index")
-            self.vector_store.save_local(index_path)
+            return self.vector_store.index.ntotal == 0
+        return True
+    
+    def delete(self, ids: List[str]) -> None:
+        """指定したIDの文書を削除"""
+        if not ids or self.vector_store is None:
+            return
+        
+        self._check_writable()
+        with self._lock:
+            if settings.vector_store_type == "chroma":
+                self.vector_store.delete(ids=ids)
+            elif settings.vector_store_type == "faiss":
+                # FAISSは存在しないIDを指定するとエラーになるため絞り込む
+                existing = self.existing_ids(ids)
+                ids = [doc_id for doc_id in ids if doc_id in existing]
+                if not ids:
+                    return
+                try:
+                    self.vector_store.delete(ids)
+                except RuntimeError:
+                    # HNSWなど個別削除に対応しないインデックスは再構築する
+                    self.rebuild_faiss_index(exclude_ids=set(ids))
+                original_store = self._original_vectors_store()
+                if original_store is not None:
+                    original_store.delete_many(_ORIGINAL_VECTORS_MODEL, ids)
+            
+            if self.lexical_index is not None:
+                self.lexical_index.remove(ids)
+            
+            self.version += 1
+            self._mark_written(len(ids), checkpoint=True)
+    
+    def persist(self) -> None:
+        """ベクトルストアを永続化"""
+        with self._lock, metrics.span("vector_store.persist", store=settings.vector_store_type):
+            if self._persist_timer is not None:
+                self._persist_timer.cancel()
+                self._persist_timer = None
+            
+            if settings.vector_store_type == "chroma":
+                self.vector_store.persist()
+            elif settings.vector_store_type == "faiss":
+                self._save_faiss()
+            
+            if self.lexical_index is not None:
+                self.lexical_index.save(self._lexical_index_path())
+            
+            self._dirty_chunks = 0
+            callbacks, self._persist_callbacks = self._persist_callbacks, []
+        
+        for callback in callbacks:
+            callback()
+    
+    def flush(self) -> None:
+        """未永続化の書き込みがあれば永続化"""
+        with self._lock:
+            if self._dirty_chunks > 0 or self._persist_callbacks:
+                self.persist()
+    
+    def after_persist(self, callback: Callable[[], None]) -> None:
+        """現在までの書き込みが永続化された後に実行する処理を登録
+        
+        未永続化の書き込みがなければ直ちに実行する
+        """
+        with self._lock:
+            if self._dirty_chunks == 0:
+                run_now = True
+            else:
+                run_now = False
+                if callback not in self._persist_callbacks:
+                    self._persist_callbacks.append(callback)
+        
+        if run_now:
+            callback()
+    
+    def _mark_written(self, count: int, checkpoint: bool = False) -> None:
+        """書き込み後の永続化を制御
+        
+        immediate モードではチェックポイントごとに永続化する。
+        deferred モードでは件数の閾値・タイマー・明示的な flush でまとめて永続化する。
+        """
+        self._dirty_chunks += count
+        if self._dirty_chunks == 0:
+            return
+        
+        if settings.persist_mode != "deferred":
+            if checkpoint:
+                self.persist()
+            return
+        
+        if self._dirty_chunks >= settings.persist_chunk_threshold:
+            self.persist()
+        elif self._persist_timer is None:
+            self._persist_timer = threading.Timer(settings.persist_interval_seconds, self.flush)
+            self._persist_timer.daemon = True
+            self._persist_timer.start()
+    
+    def rebuild_faiss_index(self, exclude_ids: Optional[Set[str]] = None) -> None:
+        """FAISSインデックスを設定された種類で再構築（学習を含む）
+        
+        exclude_ids を指定した場合は、そのIDの文書を除いて再構築する
+        """
+        exclude_ids = exclude_ids or set()
+        
+        with self._lock:
+            store = self.vector_store
+            removed = [
+                doc_id for doc_id in store.index_to_docstore_id.values()
+                if doc_id in exclude_ids
+            ]
+            kept = [
+                (position, doc_id)
+                for position, doc_id in sorted(store.index_to_docstore_id.items())
+                if doc_id not in exclude_ids
+            ]
+            
+            store.index = faiss_index.build_index(
+                self._original_vectors(kept),
+                settings.faiss_index_type
+            )
+            store.index_to_docstore_id = {i: doc_id for i, (_, doc_id) in enumerate(kept)}
+            
+            if removed:
+                store.docstore.delete(removed)
+                original_store = self._original_vectors_store()
+                if original_store is not None:
+                    original_store.delete_many(_ORIGINAL_VECTORS_MODEL, removed)
+            
+            self.version += 1
+            self._mark_written(len(kept), checkpoint=True)
+    
+    def _original_vectors(self, kept: List[tuple]) -> np.ndarray:
+        """再構築に使う元のベクトルを取得
+        
+        PQ から取り出せるのは量子化後の近似値のため、学習し直すと誤差が重なる。
+        その場合は追加時にディスクへ保存しておいた元のベクトルを使う
+        """
+        store = self.vector_store
+        if not faiss_index.is_lossy(store.index):
+            vectors = faiss_index.reconstruct_vectors(store.index)
+            return vectors[[position for position, _ in kept]]
+        
+        if not kept:
+            return np.zeros((0, store.index.d), dtype=np.float32)
+        
+        original_store = self._original_vectors_store(required=True)
+        ids = [doc_id for _, doc_id in kept]
+        vectors = original_store.get_many(_ORIGINAL_VECTORS_MODEL, ids)
+        
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # 元のベクトルを保存する前に追加されたチャンクだけは埋め込み直す
+            print(f"Re-embedding {len(missing)} chunks without stored vectors to rebuild the PQ index")
+            pending = [(store.docstore.search(ids[i]), ids[i]) for i in missing]
+            batch_size = max(1, settings.embedding_batch_size)
+            batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+            for batch, batch_vectors in self._embed_batches(batches):
+                original_store.put_many(
+                    _ORIGINAL_VECTORS_MODEL, [doc_id for _, doc_id in batch], batch_vectors
+                )
+            vectors = original_store.get_many(_ORIGINAL_VECTORS_MODEL, ids)
+        return np.array(vectors, dtype=np.float32)
+    
+    def _original_vectors_store(self, required: bool = False) -> Optional[EmbeddingCache]:
+        """PQ インデックスの元のベクトルを保持するディスク上のストア
+        
+        PQ を使わない設定では None（required=True の場合は設定によらず開く）。
+        メモリには載せず、再学習のときにだけ読み出す
+        """
+        if not required and (settings.vector_store_type != "faiss" or settings.faiss_index_type != "pq"):
+            return None
+        if self._original_store is None:
+            self._original_store = EmbeddingCache(
+                os.path.join(settings.vector_store_path, "faiss_original_vectors.sqlite3"),
+                max_entries=sys.maxsize
+            )
+        return self._original_store
+    
+    def _train_faiss_index(self) -> None:
+        """設定された種類のインデックスを学習できる件数になっていれば再構築
+        
+        件数が増えて学習時の nlist が小さすぎる場合も再学習する
+        """
+        index = self.vector_store.index
+        if not faiss_index.needs_training(index, settings.faiss_index_type):
+            return
+        
+        print(f"Training FAISS {settings.faiss_index_type} index on {index.ntotal} vectors")
+        self.rebuild_faiss_index()
+    
+    def _check_writable(self) -> None:
+        """読み取り専用で開いたインデックスへの書き込みを防ぐ"""
+        if settings.vector_store_type == "faiss" and settings.faiss_mmap:
+            raise RuntimeError("FAISSインデックスはメモリマップ（読み取り専用）で開かれています")
+    
+    def lexical_search(self, query: str, k: int = 5) -> List[tuple]:
+        """語彙検索（BM25）でスコア付きの文書を取得"""
+        if self.lexical_index is None:
+            return []
+        with metrics.span("vector_store.lexical_search"):
+            return self.lexical_index.search(query, k=k)
+    
+    def _load_lexical_index(self) -> None:
+        """語彙検索用インデックスを読み込む（なければストアの内容から作成）"""
+        if not settings.lexical_index_enabled:
+            self.lexical_index = None
+            return
+        
+        self.lexical_index = LexicalIndex.load(self._lexical_index_path())
+        if self.lexical_index is not None:
+            return
+        
+        self.lexical_index = LexicalIndex()
+        ids, documents = self._stored_documents()
+        if ids:
+            print(f"Building lexical index from {len(ids)} stored chunks")
+            self.lexical_index.add(ids, documents)
+    
+    def _stored_documents(self) -> tuple:
+        """ストアに保存済みの全文書とIDを取得"""
+        if self.vector_store is None:
+            return [], []
+        
+        if settings.vector_store_type == "chroma":
+            data = self.vector_store.get(include=["documents", "metadatas"])
+            ids = list(data["ids"])
+            documents = [
+                Document(page_content=text, metadata=metadata or {})
+                for text, metadata in zip(data["documents"], data["metadatas"])
+            ]
+            return ids, documents
+        
+        ids = list(self.vector_store.index_to_docstore_id.values())
+        return ids, [self.vector_store.docstore.search(doc_id) for doc_id in ids]
+    
+    def _lexical_index_path(self) -> str:
+        """語彙検索用インデックスの保存先"""
+        return os.path.join(
+            settings.vector_store_path,
+            f"lexical_index_{settings.vector_store_type}.pkl"
+        )
+    
+    def _embedding_dimension(self) -> Optional[int]:
+        """設定された埋め込みのベクトル次元（不明な場合はNone）"""
+        return embedding_dimension()
+    
+    def _create_empty_faiss(self, dimension: Optional[int]):
+        """空のFAISSストアを作成（次元が不明な場合はNone）"""
+        if dimension is None:
+            return None
+        return faiss_index.create_empty(self.embeddings, dimension)
+    
+    def _faiss_index_path(self) -> str:
+        """FAISSインデックスの保存先"""
+        return os.path.join(settings.vector_store_path, "faiss_index")
+    
+    def _save_faiss(self) -> None:
+        """FAISSインデックスを一時ディレクトリに保存してから置き換える
+        
+        書き込み途中で中断しても、既存のインデックスが壊れないようにする
+        """
+        index_path = self._faiss_index_path()
+        tmp_path = f"{index_path}.tmp"
+        backup_path = f"{index_path}.old"
+        
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if self.vector_store is None:
+            # 空のストア（次元未確定）は保存済みのインデックスを削除して表す
+            shutil.rmtree(index_path, ignore_errors=True)
+            return
+        self.vector_store.save_local(tmp_path)
+        
+        if os.path.exists(index_path):
+            shutil.rmtree(backup_path, ignore_errors=True)
+            os.replace(index_path, backup_path)
+        os.replace(tmp_path, index_path)
+        shutil.rmtree(backup_path, ignore_errors=True)
     
     def search(self, query: str, k: int = 5, filter: Optional[dict] = None) -> List[Document]:
         """類似文書を検索"""
         if self.vector_store is None:
             return []
-            
-        if filter:
-            return self.vector_store.similarity_search(
-                query, 
-                k=k, 
-                filter=filter
-            )
-        else:
-            return self.vector_store.similarity_search(query, k=k)
+        
+        with metrics.span("vector_store.search", store=settings.vector_store_type):
+            if filter:
+                return self.vector_store.similarity_search(
+                    query, 
+                    k=k, 
+                    filter=filter
+                )
+            else:
+                return self.vector_store.similarity_search(query, k=k)
     
     def search_with_score(self, query: str, k: int = 5) -> List[tuple]:
-        """スコア付きで類似文書を検索"""
+        """スコア付きで類似文書を検索（スコアは距離で、小さいほど類似）"""
         if self.vector_store is None:
             return []
-            
-        return self.vector_store.similarity_search_with_score(query, k=k)
+        
+        # テキスト検索もベクトル検索と同じ経路を通し、スコアの意味を揃える
+        return self.search_with_score_by_vector(self.embed_query(query), k=k)
+    
+    def search_with_score_by_vector(self, embedding: List[float], k: int = 5) -> List[tuple]:
+        """埋め込み済みのクエリベクトルでスコア付き検索（スコアは距離で、小さいほど類似）"""
+        if self.vector_store is None:
+            return []
+        
+        with metrics.span("vector_store.search_by_vector", store=settings.vector_store_type):
+            if settings.vector_store_type == "chroma":
+                # Chroma のベクトル検索 API は名前に反してコサイン距離をそのまま返す
+                # （similarity_search_with_score と同じ値）。関連度への変換は行わない
+                return self.vector_store.similarity_search_by_vector_with_relevance_scores(embedding, k=k)
+            return self.vector_store.similarity_search_with_score_by_vector(embedding, k=k)
+    
+    def embed_query(self, query: str) -> List[float]:
+        """クエリを埋め込む"""
+        with metrics.span("vector_store.embed_query"):
+            return self.embeddings.embed_query(query)
+    
+    async def aembed_query(self, query: str) -> List[float]:
+        """クエリを埋め込む（非同期版）"""
+        async with get_request_limiter():
+            with metrics.span("vector_store.embed_query"):
+                return await self.embeddings.aembed_query(query)
+    
+    async def asearch_with_score(self, query: str, k: int = 5) -> List[tuple]:
+        """スコア付きで類似文書を検索（非同期版）"""
+        embedding = await self.aembed_query(query)
+        return await self.asearch_with_score_by_vector(embedding, k=k)
+    
+    async def asearch_with_score_by_vector(self, embedding: List[float], k: int = 5) -> List[tuple]:
+        """埋め込み済みのクエリベクトルでスコア付き検索（非同期版）"""
+        # ベクトル検索はローカルで完結するため、スレッドに逃がしてループを塞がない
+        return await asyncio.to_thread(self.search_with_score_by_vector, embedding, k)
     
     def delete_all(self) -> None:
         """全ての文書を削除"""
-        if settings.vector_store_type == "chroma":
-            self.vector_store.delete_collection()
-        elif settings.vector_store_type == "faiss":
-            # FAISSの場合は再初期化
-            dummy_doc = [Document(page_content="init", metadata={"type": "init"})]
-            self.vector_store = FAISS.from_documents(
-                dummy_doc, 
-                self.embeddings
-            )
\ No newline at end of file
+        with self._lock:
+            self.version += 1
+            if self.lexical_index is not None:
+                self.lexical_index.clear()
+            if settings.vector_store_type == "chroma":
+                self.vector_store.delete_collection()
+                # 削除したコレクションを作り直す
+                self._initialize_store()
+            elif settings.vector_store_type == "faiss":
+                # FAISSの場合は空のインデックスで再初期化する
+                self.vector_store = self._create_empty_faiss(self._embedding_dimension())
+                original_store = self._original_vectors_store()
+                if original_store is not None:
+                    original_store.clear()
+            # 保存済みのインデックス（語彙検索用を含む）も空のものに置き換える
+            self._dirty_chunks += 1
+            self.persist()
\ No newline at end of file
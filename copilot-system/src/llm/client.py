@@ -1,9 +1,13 @@
-from typing import Optional, List, Dict, Any
+import time
+from typing import Optional, List, Dict, Any, Iterator
 from langchain.chat_models import ChatOpenAI
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from langchain.schema import BaseMessage, HumanMessage, SystemMessage, AIMessage
 
+from . import tokenizer
+from ..utils import metrics
 from ..utils.config import settings
+from ..utils.concurrency import get_request_limiter
 
 
 class LLMClient:
@@ -18,34 +22,84 @@ class LLMClient:
             model_name=settings.model_name,
             temperature=settings.temperature,
             max_tokens=settings.max_tokens,
+            # レート制限などのリトライはクライアントだけで行う（呼び出し側では重ねない）
+            max_retries=settings.api_max_retries,
             streaming=streaming,
             callbacks=callbacks
         )
     
     def generate(self, messages: List[BaseMessage]) -> str:
         """メッセージリストから応答を生成"""
-        response = self.llm(messages)
+        with metrics.span("llm.generate", model=settings.model_name) as span:
+            response = self.llm(messages)
+            self._record_tokens(messages, response.content, span)
         return response.content
     
+    async def agenerate(self, messages: List[BaseMessage]) -> str:
+        """メッセージリストから応答を生成（非同期版）"""
+        async with get_request_limiter():
+            with metrics.span("llm.generate", model=settings.model_name) as span:
+                response = await self.llm.ainvoke(messages)
+                self._record_tokens(messages, response.content, span)
+        return response.content
+    
+    def stream(self, messages: List[BaseMessage]) -> Iterator[str]:
+        """メッセージリストから応答をトークンごとに生成"""
+        # ジェネレーターはスパンで囲めないため、所要時間を直接記録する
+        start = time.perf_counter()
+        first_token = None
+        chunks = []
+        for chunk in self.llm.stream(messages):
+            if chunk.content:
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                    metrics.observe("llm.stream_first_token", first_token, model=settings.model_name)
+                chunks.append(chunk.content)
+                yield chunk.content
+        metrics.observe("llm.stream", time.perf_counter() - start, model=settings.model_name)
+        self._record_tokens(messages, "".join(chunks))
+    
     def generate_with_context(self, 
                             query: str, 
                             context: str, 
                             system_prompt: Optional[str] = None) -> str:
         """コンテキスト付きで応答を生成"""
-        messages = []
-        
-        if system_prompt:
-            messages.append(SystemMessage(content=system_prompt))
-        
-        # コンテキストを含むユーザーメッセージ
-        if context:
-            user_message = f"以下の参考資料を基に質問に答えてください。\n\n参考資料:\n{context}\n\n質問: {query}"
-        else:
-            user_message = query
+        return self.generate(self.build_context_messages(query, context, system_prompt))
+    
+    async def agenerate_with_context(self,
+                                     query: str,
+                                     context: str,
+                                     system_prompt: Optional[str] = None) -> str:
+        """コンテキスト付きで応答を生成（非同期版）"""
+        return await self.agenerate(self.build_context_messages(query, context, system_prompt))
+    
+    def stream_with_context(self,
+                            query: str,
+                            context: str,
+                            system_prompt: Optional[str] = None) -> Iterator[str]:
+        """コンテキスト付きで応答をトークンごとに生成"""
+        return self.stream(self.build_context_messages(query, context, system_prompt))
+    
+    def build_context_messages(self,
+                               query: str,
+                               context: str,
+                               system_prompt: Optional[str] = None) -> List[BaseMessage]:
+        """コンテキスト付きのメッセージリストを作成"""
+        with metrics.span("llm.build_prompt"):
+            messages = []
             
-        messages.append(HumanMessage(content=user_message))
+            if system_prompt:
+                messages.append(SystemMessage(content=system_prompt))
+            
+            # コンテキストを含むユーザーメッセージ
+            if context:
+                user_message = f"以下の参考資料を基に質問に答えてください。\n\n参考資料:\n{context}\n\n質問: {query}"
+            else:
+                user_message = query
+                
+            messages.append(HumanMessage(content=user_message))
         
-        return self.generate(messages)
+        return messages
     
     def create_chat_history(self, history: List[Dict[str, str]]) -> List[BaseMessage]:
         """会話履歴からメッセージリストを作成"""
@@ -64,6 +118,22 @@ class LLMClient:
                 
         return messages
     
+    def _record_tokens(self, messages: List[BaseMessage], response: str, span=None) -> None:
+        """入力・出力のトークン数を記録（計測が無効な場合は数えない）"""
+        if not metrics.enabled():
+            return
+        tokens_in = sum(self.count_tokens_many([message.content for message in messages]))
+        tokens_out = self.count_tokens(response)
+        metrics.increment("llm_requests", model=settings.model_name)
+        metrics.increment("llm_tokens_in", tokens_in, model=settings.model_name)
+        metrics.increment("llm_tokens_out", tokens_out, model=settings.model_name)
+        if span is not None:
+            span.set(tokens_in=tokens_in, tokens_out=tokens_out)
+    
     def count_tokens(self, text: str) -> int:
         """テキストのトークン数をカウント"""
-        return self.llm.get_num_tokens(text)
\ No newline at end of file
+        return tokenizer.count_tokens(text, model=settings.model_name)
+    
+    def count_tokens_many(self, texts: List[str]) -> List[int]:
+        """複数のテキストのトークン数をまとめてカウント"""
+        return tokenizer.count_tokens_many(texts, model=settings.model_name)
\ No newline at end of file
@@ -0,0 +1,107 @@
+"""キャッシュ付きのローカルなトークン数カウント"""
+import math
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import tiktoken
+
+from ..utils.config import settings
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: Optional[str] = None) -> Optional[tiktoken.Encoding]:
+    """モデルに対応するエンコーダーを取得（プロセス内で1度だけ作成）
+
+    エンコーダーの定義を取得できない場合（オフライン環境など）は None を返し、
+    トークン数は文字数からの概算になる。
+    事前に取得した定義は環境変数 TIKTOKEN_CACHE_DIR で指定できる
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model or settings.model_name)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except (OSError, ValueError) as e:
+        print(f"Could not load tiktoken encoding, using approximate token counts: {str(e)}")
+        return None
+
+
+def approximate_count(text: str) -> int:
+    """エンコーダーなしでのトークン数の概算（ASCIIは4文字で1トークン、それ以外は1文字1トークン）"""
+    ascii_chars = sum(1 for char in text if char.isascii())
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+class TokenCountCache:
+    """文字列ごとのトークン数を保持するLRUキャッシュ
+
+    システムプロンプトやヒントレベルのプロンプトなど、
+    繰り返し数える文字列のエンコードを省略するために使用する
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Tuple[str, str]) -> Optional[int]:
+        with self._lock:
+            count = self._entries.get(key)
+            if count is not None:
+                self._entries.move_to_end(key)
+            return count
+
+    def put(self, key: Tuple[str, str], count: int) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = count
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = TokenCountCache(settings.token_count_cache_size)
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """テキストのトークン数をカウント"""
+    return count_tokens_many([text], model=model)[0]
+
+
+def count_tokens_many(texts: List[str], model: Optional[str] = None) -> List[int]:
+    """複数のテキストのトークン数をまとめてカウント
+
+    キャッシュにないテキストだけを1回のバッチでエンコードする
+    """
+    model = model or settings.model_name
+    counts: List[Optional[int]] = [_cache.get((model, text)) for text in texts]
+    misses = sorted({text for text, count in zip(texts, counts) if count is None})
+
+    if misses:
+        encoding = get_encoding(model)
+        if encoding is None:
+            computed = {text: approximate_count(text) for text in misses}
+        else:
+            # ユーザー入力に特殊トークンの文字列が含まれていても通常の文字として数える
+            encoded = encoding.encode_batch(misses, disallowed_special=())
+            computed = {text: len(tokens) for text, tokens in zip(misses, encoded)}
+        for text, count in computed.items():
+            _cache.put((model, text), count)
+        counts = [computed[text] if count is None else count for text, count in zip(texts, counts)]
+
+    return counts
+
+
+def clear_cache() -> None:
+    """トークン数のキャッシュをクリア"""
+    _cache.clear()
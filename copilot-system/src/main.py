@@ -6,7 +6,7 @@ from pathlib import Path
 project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
-from src.knowledge_base.retriever import KnowledgeRetriever
+from src.knowledge_base.registry import get_shared_retriever
 from src.utils.config import settings
 
 
@@ -19,12 +19,14 @@ def initialize_system():
     Path(settings.vector_store_path).mkdir(parents=True, exist_ok=True)
     
     # 知識ベースの初期化
-    retriever = KnowledgeRetriever()
+    retriever = get_shared_retriever()
     
     # 演習資料のインデックス化
     if os.listdir(settings.exercises_dir):
         print(f"📚 {settings.exercises_dir} から演習資料を読み込んでいます...")
         count = retriever.index_documents()
+        # Webインターフェースは別プロセスで読み込むため、ここで永続化しておく
+        retriever.vector_store.flush()
         print(f"✅ {count}個のドキュメントチャンクをインデックス化しました")
     else:
         print("⚠️  演習資料が見つかりません。data/exercises/ に資料を配置してください")
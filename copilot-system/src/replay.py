@@ -0,0 +1,372 @@
+"""過去の質問データセットを再生し、設定ごとの速度と品質を比較するレポートを作成
+
+データセットは1行1件の JSON で、query（必須）と error_message・code_context（任意）を持つ。
+mode（normal / hint / hint_generator）を指定した行はその対象だけで再生し、
+指定のない行は --targets の全ての対象で再生する。
+
+使用例:
+    python -m src.replay questions.jsonl --output replay.jsonl --workers 4 --evaluate \\
+        --index data/exercises --set chunk_size=500 --set retrieval_k=3
+"""
+import argparse
+import csv
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain.schema import BaseMessage
+
+from .knowledge_base.registry import get_shared_retriever
+from .knowledge_base.retriever import KnowledgeRetriever
+from .knowledge_base.vector_store import VectorStore
+from .llm.client import LLMClient
+from .response_engine.hint_generator import HintGenerator
+from .response_engine.qa_engine import QAEngine, ResponseMode
+from .utils.config import settings
+from .utils.evaluator import ResponseEvaluator
+from .utils.state_store import BoundedStateStore
+from .utils.stats import percentile
+
+
+TARGETS = ["normal", "hint", "hint_generator"]
+
+# レポートに記録する、速度と品質に影響する設定
+REPORTED_SETTINGS = [
+    "model_name",
+    "temperature",
+    "max_tokens",
+    "embedding_provider",
+    "embedding_model",
+    "vector_store_type",
+    "chunk_size",
+    "chunk_overlap",
+    "retrieval_mode",
+    "retrieval_k",
+    "context_max_tokens",
+    "hint_generation_mode",
+    "answer_cache_enabled",
+]
+
+# 変更するとインデックスを作り直す必要がある設定（--index と併用する）
+INDEX_SETTINGS = [
+    "chunk_size",
+    "chunk_overlap",
+    "embedding_provider",
+    "embedding_model",
+    "embedding_dimension",
+]
+
+CSV_COLUMNS = [
+    "index", "target", "query", "level", "latency_seconds", "llm_calls",
+    "tokens_in", "tokens_out", "cached", "sources", "total_score", "error", "response",
+]
+
+
+class _UsageTrackingLLMClient(LLMClient):
+    """LLMの呼び出し回数と入出力のトークン数を記録するクライアント（スレッドごとに1つ使う）"""
+
+    def __init__(self):
+        super().__init__()
+        self.usage = {"llm_calls": 0, "tokens_in": 0, "tokens_out": 0}
+
+    def generate(self, messages: List[BaseMessage]) -> str:
+        response = super().generate(messages)
+        self.usage["llm_calls"] += 1
+        self.usage["tokens_in"] += sum(self.count_tokens_many([message.content for message in messages]))
+        self.usage["tokens_out"] += self.count_tokens(response)
+        return response
+
+    def take_usage(self) -> Dict[str, int]:
+        """記録した使用量を取得してリセット"""
+        usage, self.usage = self.usage, {"llm_calls": 0, "tokens_in": 0, "tokens_out": 0}
+        return usage
+
+
+class _Session:
+    """ワーカースレッドごとのエンジン
+
+    各行は独立に再生するため、会話履歴とヒントレベルは行ごとにリセットする。
+    キャッシュを使わない場合は、一括生成したヒントなどの状態を共有ストアではなく
+    セッション専用のストアに置き、これも行ごとに破棄する
+    """
+
+    def __init__(self, retriever: KnowledgeRetriever, use_cache: bool = False):
+        self.llm_client = _UsageTrackingLLMClient()
+        self.state_store = None if use_cache else BoundedStateStore()
+        self.qa_engines: Dict[str, QAEngine] = {}
+        for mode in (ResponseMode.NORMAL, ResponseMode.HINT):
+            engine = QAEngine(retriever=retriever, llm_client=self.llm_client)
+            engine.set_mode(mode)
+            self.qa_engines[mode.value] = engine
+        self.hint_generator = HintGenerator(
+            retriever=retriever, state_store=self.state_store, llm_client=self.llm_client
+        )
+
+    def reset(self) -> None:
+        """前の行の会話履歴・ヒントレベル・状態を破棄"""
+        for engine in self.qa_engines.values():
+            engine.clear_history()
+        self.hint_generator.reset_hint_level()
+        if self.state_store is not None:
+            self.state_store.clear()
+
+
+def load_dataset(path: str) -> List[Dict[str, Any]]:
+    """JSONL のデータセットを読み込む"""
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not isinstance(item, dict) or not item.get("query"):
+                raise ValueError(f"{path}:{line_number}: query がありません")
+            if item.get("mode") and item["mode"] not in TARGETS:
+                raise ValueError(f"{path}:{line_number}: 未対応の mode です: {item['mode']}")
+            items.append(item)
+    return items
+
+
+def check_index_overrides(pairs: List[str], index_dir: Optional[str]) -> None:
+    """インデックスに関わる設定を、作り直さずに上書きしようとしていないか確認
+
+    既存のインデックスはチャンク分割と埋め込みが上書き前の設定のままのため、
+    --index なしでは比較が成り立たない
+    """
+    keys = [pair.partition("=")[0] for pair in pairs]
+    stale = [key for key in INDEX_SETTINGS if key in keys]
+    if stale and index_dir is None:
+        raise ValueError(f"{', '.join(stale)} を変更する場合は --index でインデックスを作り直してください")
+
+
+def apply_overrides(pairs: List[str]) -> Dict[str, Any]:
+    """KEY=VALUE 形式の指定で設定を上書きし、上書きした値を返す"""
+    overrides = {}
+    for pair in pairs:
+        key, separator, value = pair.partition("=")
+        if not separator or not hasattr(settings, key):
+            raise ValueError(f"設定の指定が正しくありません: {pair}")
+
+        current = getattr(settings, key)
+        if isinstance(current, bool):
+            overrides[key] = value.lower() == "true"
+        elif isinstance(current, (int, float)):
+            overrides[key] = type(current)(value)
+        else:
+            overrides[key] = value
+
+    for key, value in overrides.items():
+        setattr(settings, key, value)
+    return overrides
+
+
+def replay_one(session: _Session, index: int, item: Dict[str, Any], target: str) -> Tuple[Dict[str, Any], str]:
+    """1件を再生し、レポートの行と評価に使う文脈を返す"""
+    row: Dict[str, Any] = {"index": index, "target": target, "query": item["query"]}
+    context = ""
+    session.llm_client.take_usage()
+
+    start = time.perf_counter()
+    try:
+        if target == "hint_generator":
+            result = session.hint_generator.generate_hint(
+                item["query"],
+                error_message=item.get("error_message"),
+                code_context=item.get("code_context")
+            )
+            row.update(response=result["hint"], level=result["level"], sources=[])
+        else:
+            result = session.qa_engines[target].answer(item["query"])
+            context = result.get("context", "")
+            row.update(response=result["response"], sources=result["retrieval"]["sources"])
+        row["cached"] = result.get("cached", False)
+    except Exception as e:
+        print(f"Error replaying item {index} ({target}): {e}")
+        row["error"] = str(e)
+    finally:
+        # 各質問は独立に再生するため、履歴（とその要約）やヒントレベルは持ち越さない
+        session.reset()
+
+    row["latency_seconds"] = time.perf_counter() - start
+    row.update(session.llm_client.take_usage())
+    return row, context
+
+
+def replay(items: List[Dict[str, Any]],
+           retriever: KnowledgeRetriever,
+           targets: List[str],
+           workers: int = 4,
+           use_cache: bool = False) -> Tuple[List[Dict[str, Any]], List[str], float]:
+    """データセットをワーカープールで再生し、入力順の行・文脈と所要時間を返す"""
+    runs = [
+        (index, item, target)
+        for index, item in enumerate(items)
+        for target in ([item["mode"]] if item.get("mode") else targets)
+    ]
+    local = threading.local()
+
+    def run(args) -> Tuple[Dict[str, Any], str]:
+        if not hasattr(local, "session"):
+            local.session = _Session(retriever, use_cache=use_cache)
+        return replay_one(local.session, *args)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(run, runs))
+    wall_seconds = time.perf_counter() - start
+
+    return [row for row, _ in results], [context for _, context in results], wall_seconds
+
+
+def evaluate_rows(rows: List[Dict[str, Any]],
+                  contexts: List[str],
+                  concurrency: Optional[int] = None) -> None:
+    """成功した行を ResponseEvaluator で一括評価し、各行に evaluation を追加"""
+    positions = [position for position, row in enumerate(rows) if "error" not in row]
+    items = [
+        {
+            "query": rows[position]["query"],
+            "response": rows[position]["response"],
+            "mode": "normal" if rows[position]["target"] == "normal" else "hint",
+            "context": contexts[position]
+        }
+        for position in positions
+    ]
+
+    for record in ResponseEvaluator().iter_evaluate_batch(items, concurrency=concurrency):
+        row = rows[positions[record["index"]]]
+        if "error" in record:
+            row["evaluation"] = {"error": record["error"]}
+        else:
+            row["evaluation"] = {"scores": record["scores"], "total_score": record["total_score"]}
+
+
+def summarize(rows: List[Dict[str, Any]], wall_seconds: float, workers: int) -> Dict[str, Any]:
+    """対象ごとのレイテンシ・トークン数・評価の集計"""
+    targets = {}
+    for target in dict.fromkeys(row["target"] for row in rows):
+        target_rows = [row for row in rows if row["target"] == target]
+        succeeded = [row for row in target_rows if "error" not in row]
+        latencies = [row["latency_seconds"] for row in succeeded]
+        scores = [
+            row["evaluation"]["total_score"] for row in succeeded
+            if "total_score" in row.get("evaluation", {})
+        ]
+
+        targets[target] = {
+            "count": len(target_rows),
+            "errors": len(target_rows) - len(succeeded),
+            "cached": sum(1 for row in succeeded if row.get("cached")),
+            "latency_seconds": {
+                "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": max(latencies, default=0.0),
+            },
+            "llm_calls": sum(row["llm_calls"] for row in target_rows),
+            "tokens_in": sum(row["tokens_in"] for row in target_rows),
+            "tokens_out": sum(row["tokens_out"] for row in target_rows),
+            "evaluated": len(scores),
+            "average_total_score": sum(scores) / len(scores) if scores else None,
+        }
+
+    return {
+        "settings": {key: getattr(settings, key) for key in REPORTED_SETTINGS},
+        "workers": workers,
+        "runs": len(rows),
+        "wall_seconds": wall_seconds,
+        "throughput_per_second": len(rows) / wall_seconds if wall_seconds > 0 else 0.0,
+        "targets": targets,
+    }
+
+
+def _csv_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """CSVの1行（参照文書は出典を ; で連結）"""
+    flat = {column: row.get(column) for column in CSV_COLUMNS}
+    flat["sources"] = ";".join(str(source["source"]) for source in row.get("sources", []))
+    flat["total_score"] = row.get("evaluation", {}).get("total_score")
+    return flat
+
+
+def write_report(rows: List[Dict[str, Any]], path: str, output_format: str = "jsonl") -> None:
+    """行ごとのレポートを JSONL または CSV で書き出す"""
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        if output_format == "csv":
+            writer = csv.DictWriter(f, fieldnames=CSV_COLUMNS)
+            writer.writeheader()
+            writer.writerows(_csv_row(row) for row in rows)
+            return
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+
+
+def _build_retriever(index_dir: Optional[str], store_dir: str) -> KnowledgeRetriever:
+    """再生に使うリトリーバー（index_dir を指定した場合は一時ストアに作り直す）"""
+    if index_dir is None:
+        return get_shared_retriever()
+
+    # 本番のインデックスを変更せず、現在のチャンク設定で一時的にインデックス化する
+    settings.vector_store_path = store_dir
+    retriever = KnowledgeRetriever(vector_store=VectorStore())
+    retriever.index_documents(index_dir)
+    retriever.vector_store.flush()
+    return retriever
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="過去の質問データセットの再生と評価")
+    parser.add_argument("dataset", help="質問データセット（JSONL）")
+    parser.add_argument("--output", required=True, help="行ごとのレポートの出力先")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    parser.add_argument("--summary", help="集計の出力先（省略時は <output>.summary.json）")
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=TARGETS)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--evaluate", action="store_true", help="ResponseEvaluator で回答を評価する")
+    parser.add_argument("--evaluation-concurrency", type=int)
+    parser.add_argument("--index", help="このディレクトリを一時ストアにインデックス化してから再生する")
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="KEY=VALUE",
+                        help="設定の上書き（例: chunk_size=500, retrieval_k=3, model_name=gpt-4）")
+    parser.add_argument("--use-cache", action="store_true",
+                        help="回答キャッシュと一括生成したヒントを行をまたいで使う（既定では無効）")
+    args = parser.parse_args(argv)
+
+    try:
+        items = load_dataset(args.dataset)
+        check_index_overrides(args.overrides, args.index)
+        apply_overrides(args.overrides)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if not args.use_cache:
+        settings.answer_cache_enabled = False
+    # 行ごとにヒントレベルをリセットするため次のレベルの先読みは使われず、
+    # 先読みの LLM 呼び出しが別の行の使用量として記録されてしまう
+    settings.hint_prefetch_enabled = False
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        retriever = _build_retriever(args.index, store_dir)
+        rows, contexts, wall_seconds = replay(
+            items, retriever, args.targets, workers=args.workers, use_cache=args.use_cache
+        )
+
+    if args.evaluate:
+        evaluate_rows(rows, contexts, concurrency=args.evaluation_concurrency)
+
+    write_report(rows, args.output, output_format=args.format)
+    summary = summarize(rows, wall_seconds, args.workers)
+    summary_path = args.summary or os.path.splitext(args.output)[0] + ".summary.json"
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    print(f"Replay report written to {args.output} ({summary_path})")
+    return summary
+
+
+if __name__ == "__main__":
+    main()
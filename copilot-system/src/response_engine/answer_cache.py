@@ -0,0 +1,174 @@
+"""類似質問に対する回答キャッシュ"""
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from ..utils.config import settings
+
+
+def prompt_version(*prompts: str) -> str:
+    """プロンプトの内容からバージョン文字列を生成"""
+    hasher = hashlib.sha256()
+    for prompt in prompts:
+        hasher.update((prompt or "").encode('utf-8'))
+        hasher.update(b"\0")
+    return hasher.hexdigest()[:12]
+
+
+class _CacheEntry:
+    """キャッシュのエントリ"""
+    __slots__ = ("namespace", "vector", "key", "value", "created_at")
+    
+    def __init__(self,
+                 namespace: str,
+                 vector: Optional[np.ndarray],
+                 key: Optional[str],
+                 value: Dict[str, Any],
+                 created_at: float):
+        self.namespace = namespace
+        self.vector = vector
+        self.key = key
+        self.value = value
+        self.created_at = created_at
+
+
+class SemanticAnswerCache:
+    """クエリ埋め込みの類似度で引き当てる回答キャッシュ
+
+    名前空間（モード・プロンプトバージョンなど）ごとに、コサイン類似度が
+    閾値以上の過去の回答を返す。埋め込みを使わない質問のために、正規化した
+    質問文のキーで完全一致を引き当てることもできる。TTLと件数上限（LRU）で
+    古いものを削除し、インデックスのバージョンが変わった場合は全件を破棄する。
+    """
+    
+    def __init__(self,
+                 similarity_threshold: float = 0.97,
+                 ttl_seconds: float = 3600,
+                 max_entries: int = 1000):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.index_version: Optional[int] = None
+        self._entries: "OrderedDict[int, _CacheEntry]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+    
+    def lookup(self,
+               namespace: str,
+               embedding: List[float],
+               index_version: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """類似する質問の回答を取得（見つからない場合はNone）"""
+        vector = self._normalize(embedding)
+        
+        with self._lock:
+            self._check_index_version(index_version)
+            self._expire()
+            
+            candidates = [
+                (entry_id, entry) for entry_id, entry in self._entries.items()
+                if entry.namespace == namespace and entry.vector is not None
+            ]
+            if not candidates:
+                return None
+            
+            matrix = np.stack([entry.vector for _, entry in candidates])
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                return None
+            
+            entry_id, entry = candidates[best]
+            self._entries.move_to_end(entry_id)
+            return copy.deepcopy(entry.value)
+    
+    def lookup_exact(self,
+                     namespace: str,
+                     key: str,
+                     index_version: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """キーが完全に一致する質問の回答を取得（見つからない場合はNone）"""
+        with self._lock:
+            self._check_index_version(index_version)
+            self._expire()
+            
+            matches = [
+                entry_id for entry_id, entry in self._entries.items()
+                if entry.namespace == namespace and entry.key == key
+            ]
+            if not matches:
+                return None
+            
+            entry_id = matches[-1]
+            self._entries.move_to_end(entry_id)
+            return copy.deepcopy(self._entries[entry_id].value)
+    
+    def store(self,
+              namespace: str,
+              embedding: Optional[List[float]],
+              value: Dict[str, Any],
+              index_version: Optional[int] = None,
+              key: Optional[str] = None) -> None:
+        """回答を登録（埋め込みがない場合は key による完全一致でのみ引き当てる）"""
+        vector = self._normalize(embedding) if embedding is not None else None
+        entry = _CacheEntry(namespace, vector, key, copy.deepcopy(value), time.time())
+        
+        with self._lock:
+            self._check_index_version(index_version)
+            self._entries[self._next_id] = entry
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self) -> None:
+        """全てのエントリを破棄"""
+        with self._lock:
+            self._entries.clear()
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def _check_index_version(self, index_version: Optional[int]) -> None:
+        """インデックスが更新されていればキャッシュを破棄"""
+        if index_version is None:
+            return
+        if self.index_version is not None and self.index_version != index_version:
+            self._entries.clear()
+        self.index_version = index_version
+    
+    def _expire(self) -> None:
+        """TTLを過ぎたエントリを削除"""
+        deadline = time.time() - self.ttl_seconds
+        expired = [entry_id for entry_id, entry in self._entries.items() if entry.created_at < deadline]
+        for entry_id in expired:
+            del self._entries[entry_id]
+    
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+
+_shared_cache: Optional[SemanticAnswerCache] = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_answer_cache() -> Optional[SemanticAnswerCache]:
+    """プロセス全体で共有する回答キャッシュを取得（無効の場合はNone）"""
+    global _shared_cache
+    
+    if not settings.answer_cache_enabled:
+        return None
+    
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = SemanticAnswerCache(
+                similarity_threshold=settings.answer_cache_similarity_threshold,
+                ttl_seconds=settings.answer_cache_ttl_seconds,
+                max_entries=settings.answer_cache_max_entries
+            )
+        return _shared_cache
@@ -1,9 +1,82 @@
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Iterator, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
+import asyncio
+import json
+import re
+import threading
+import uuid
 
 from ..llm.client import LLMClient
-from ..llm.prompts import HINT_LEVEL_PROMPTS
-from ..knowledge_base.retriever import KnowledgeRetriever
+from ..llm.prompts import HINT_BATCH_PROMPT, HINT_LEVEL_PROMPTS, SYSTEM_PROMPT_HINT_GENERATOR
+from ..knowledge_base.retriever import KnowledgeRetriever, RetrievalResult
+from ..utils import metrics
+from ..utils.config import settings
+from ..utils.state_store import BoundedStateStore, get_shared_state_store, normalize_key
+from .answer_cache import SemanticAnswerCache, get_shared_answer_cache, prompt_version
+
+
+# 次のレベルのヒントを先読みするスレッドプール（全セッションで共有）
+_prefetch_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_prefetch_executor() -> ThreadPoolExecutor:
+    """先読み用の共有スレッドプールを取得"""
+    global _prefetch_executor
+    if _prefetch_executor is None:
+        with _executor_lock:
+            if _prefetch_executor is None:
+                _prefetch_executor = ThreadPoolExecutor(
+                    max_workers=settings.hint_prefetch_workers, thread_name_prefix="hint-prefetch"
+                )
+    return _prefetch_executor
+
+
+_JSON_OBJECT_PATTERN = re.compile(r"\{.*\}", re.DOTALL)
+_KEYWORD_SEPARATOR_PATTERN = re.compile(r"[,、\n]+")
+
+
+def parse_hint_batch(text: str) -> Optional[Dict[str, Any]]:
+    """一括生成の出力からレベル別のヒントとキーワードを取り出す
+    
+    JSON以外の説明文やコードブロックで囲まれていても、最初の {...} を解釈する。
+    3レベル分のヒントがそろわない場合は None を返す
+    """
+    candidates = [text]
+    match = _JSON_OBJECT_PATTERN.search(text)
+    if match:
+        candidates.append(match.group(0))
+    
+    for candidate in candidates:
+        try:
+            data = json.loads(candidate)
+        except ValueError:
+            continue
+        if not isinstance(data, dict):
+            continue
+        
+        hints = data.get("hints")
+        if isinstance(hints, list):
+            hints = {str(i + 1): hint for i, hint in enumerate(hints)}
+        if not isinstance(hints, dict):
+            continue
+        
+        levels = {level: hints.get(str(level)) for level in (1, 2, 3)}
+        if not all(isinstance(hint, str) and hint.strip() for hint in levels.values()):
+            continue
+        
+        keywords = data.get("keywords", [])
+        if isinstance(keywords, str):
+            keywords = _KEYWORD_SEPARATOR_PATTERN.split(keywords)
+        keywords = [str(keyword).strip() for keyword in keywords if str(keyword).strip()]
+        
+        return {
+            "hints": {level: hint.strip() for level, hint in levels.items()},
+            "keywords": keywords
+        }
+    
+    return None
 
 
 class HintLevel(Enum):
@@ -16,55 +89,457 @@ class HintLevel(Enum):
 class HintGenerator:
     """段階的なヒントを生成するクラス"""
     
-    def __init__(self):
-        self.llm_client = LLMClient()
-        self.retriever = KnowledgeRetriever()
-        self.hint_history: Dict[str, int] = {}  # 質問ごとのヒントレベルを記録
+    def __init__(self,
+                 retriever: Optional[KnowledgeRetriever] = None,
+                 answer_cache: Optional[SemanticAnswerCache] = None,
+                 state_store: Optional[BoundedStateStore] = None,
+                 session_id: Optional[str] = None,
+                 llm_client: Optional[LLMClient] = None):
+        self.llm_client = llm_client if llm_client is not None else LLMClient()
+        self.retriever = retriever if retriever is not None else KnowledgeRetriever()
+        self.answer_cache = answer_cache if answer_cache is not None else get_shared_answer_cache()
+        # 質問ごとのヒントレベルはセッション単位の名前空間で共有ストアに記録する
+        self.hint_history = state_store if state_store is not None else get_shared_state_store()
+        self.session_namespace = f"hint:{session_id or uuid.uuid4().hex}"
+        # 先読み中のヒント: (正規化した質問, レベル) -> (キャッシュの名前空間, Future)
+        self._prefetches: Dict[Tuple[str, int], Tuple[str, Future]] = {}
+        self._prefetch_count = 0
+        self._prefetch_lock = threading.Lock()
     
     def generate_hint(self, 
                      query: str, 
                      error_message: Optional[str] = None,
                      code_context: Optional[str] = None) -> Dict[str, Any]:
         """段階的なヒントを生成"""
+        with metrics.span("hint.generate") as span:
+            current_level, cache_namespace, embedding, cached = self._prepare_hint(
+                query, error_message, code_context
+            )
+            span.set(level=current_level)
+            if cached is not None:
+                self._schedule_prefetch(query, current_level, error_message, code_context, embedding)
+                return self._hint_result(
+                    cached["hint"], current_level, query, cached=cached.get("cached", True)
+                )
+            
+            hint_prompt = self._hint_prompt(query, current_level, error_message, code_context, embedding)
+            
+            # ヒントの生成
+            hint_response = self.llm_client.generate_with_context(
+                query=hint_prompt,
+                context="",
+                system_prompt=SYSTEM_PROMPT_HINT_GENERATOR
+            )
+            
+            self._cache_hint(query, cache_namespace, embedding, hint_response)
+            self._schedule_prefetch(query, current_level, error_message, code_context, embedding)
+            return self._hint_result(hint_response, current_level, query)
+    
+    def stream_hint(self,
+                    query: str,
+                    error_message: Optional[str] = None,
+                    code_context: Optional[str] = None) -> Dict[str, Any]:
+        """段階的なヒントを生成（トークンを逐次返すストリーミング版）
+        
+        戻り値の "stream" を最後まで読み進めると、"hint" にヒント全体が入る
+        """
+        current_level, cache_namespace, embedding, cached = self._prepare_hint(
+            query, error_message, code_context
+        )
+        if cached is not None:
+            self._schedule_prefetch(query, current_level, error_message, code_context, embedding)
+            result = self._hint_result(
+                cached["hint"], current_level, query, cached=cached.get("cached", True)
+            )
+            result["stream"] = iter([cached["hint"]])
+            return result
+        
+        hint_prompt = self._hint_prompt(query, current_level, error_message, code_context, embedding)
+        result = self._hint_result("", current_level, query)
+        
+        def stream() -> Iterator[str]:
+            tokens = []
+            for token in self.llm_client.stream_with_context(
+                query=hint_prompt,
+                context="",
+                system_prompt=SYSTEM_PROMPT_HINT_GENERATOR
+            ):
+                tokens.append(token)
+                yield token
+            
+            result["hint"] = "".join(tokens)
+            self._cache_hint(query, cache_namespace, embedding, result["hint"])
+            self._schedule_prefetch(query, current_level, error_message, code_context, embedding)
         
+        result["stream"] = stream()
+        return result
+    
+    async def agenerate_hint(self,
+                             query: str,
+                             error_message: Optional[str] = None,
+                             code_context: Optional[str] = None) -> Dict[str, Any]:
+        """段階的なヒントを生成（非同期版）"""
+        with metrics.span("hint.generate") as span:
+            current_level = self._advance_level(query)
+            cache_namespace = self._cache_namespace(current_level, error_message, code_context)
+            span.set(level=current_level)
+            
+            prefetched = await asyncio.to_thread(
+                self._take_prefetched, query, current_level, cache_namespace
+            )
+            if prefetched is not None:
+                self._schedule_prefetch(query, current_level, error_message, code_context, None)
+                return self._hint_result(prefetched, current_level, query, cached=True)
+            
+            embedding = None
+            if self.answer_cache is not None:
+                if not self._lexically_decided(query):
+                    embedding = await self.retriever.aembed_query(query)
+                cached = self._lookup_hint(query, cache_namespace, embedding)
+                if cached is not None:
+                    self._schedule_prefetch(query, current_level, error_message, code_context, embedding)
+                    return self._hint_result(cached["hint"], current_level, query, cached=True)
+            
+            if settings.hint_generation_mode == "batch":
+                batch_hint = await asyncio.to_thread(
+                    self._batch_hint, query, current_level, error_message, code_context, embedding
+                )
+                if batch_hint is not None:
+                    return self._hint_result(
+                        batch_hint["hint"], current_level, query, cached=batch_hint["cached"]
+                    )
+            
+            knowledge_context = self._stored_context(query)
+            if knowledge_context is None:
+                retrieval = await self.retriever.aretrieve_result(query, k=settings.retrieval_k, embedding=embedding)
+                knowledge_context = self._build_context(retrieval)
+                self._store_context(query, knowledge_context)
+            
+            hint_prompt = self._build_hint_prompt(
+                query=query,
+                level=HintLevel(current_level),
+                error_message=error_message,
+                code_context=code_context,
+                knowledge_context=knowledge_context
+            )
+            
+            hint_response = await self.llm_client.agenerate_with_context(
+                query=hint_prompt,
+                context="",
+                system_prompt=SYSTEM_PROMPT_HINT_GENERATOR
+            )
+            
+            self._cache_hint(query, cache_namespace, embedding, hint_response)
+            self._schedule_prefetch(query, current_level, error_message, code_context, embedding)
+            return self._hint_result(hint_response, current_level, query)
+    
+    def _prepare_hint(self,
+                      query: str,
+                      error_message: Optional[str],
+                      code_context: Optional[str]) -> Tuple[int, str, Optional[List[float]], Optional[Dict[str, Any]]]:
+        """ヒントレベルを進め、キャッシュを確認する"""
+        with metrics.span("hint.prepare"):
+            current_level = self._advance_level(query)
+            cache_namespace = self._cache_namespace(current_level, error_message, code_context)
+            
+            # 先読みしたヒントがあればそれを返す
+            prefetched = self._take_prefetched(query, current_level, cache_namespace)
+            if prefetched is not None:
+                return current_level, cache_namespace, None, {"hint": prefetched}
+            
+            # 同じレベルで類似の質問へのヒントがキャッシュにあればそれを返す
+            # （語彙検索だけで決まる質問は埋め込みを行わず、正規化した質問文の完全一致で参照する）
+            embedding = None
+            cached = None
+            if self.answer_cache is not None:
+                if not self._lexically_decided(query):
+                    embedding = self.retriever.embed_query(query)
+                cached = self._lookup_hint(query, cache_namespace, embedding)
+            
+            # 一括生成モードでは全レベル分を1回で生成し、以降のレベルはそこから返す
+            if cached is None and settings.hint_generation_mode == "batch":
+                cached = self._batch_hint(query, current_level, error_message, code_context, embedding)
+            
+            return current_level, cache_namespace, embedding, cached
+    
+    def _advance_level(self, query: str) -> int:
+        """質問のヒントレベルを1つ進めて返す"""
         # 現在のヒントレベルを取得（初回は1）
-        current_level = self.hint_history.get(query, 0) + 1
+        key = normalize_key(query)
+        current_level = self.hint_history.get(self.session_namespace, key, 0) + 1
         current_level = min(current_level, 3)  # 最大レベルは3
         
         # ヒントレベルを更新
-        self.hint_history[query] = current_level
+        self.hint_history.set(self.session_namespace, key, current_level)
+        return current_level
+    
+    def _lexically_decided(self, query: str) -> bool:
+        """語彙検索だけで決まる質問か判定し、決まる場合はその結果をコンテキストとして記録"""
+        retrieval = self.retriever.lexical_result(query, k=settings.retrieval_k)
+        if retrieval is None:
+            return False
+        if self._stored_context(query) is None:
+            self._store_context(query, self._build_context(retrieval))
+        return True
+    
+    def _lookup_hint(self,
+                     query: str,
+                     cache_namespace: str,
+                     embedding: Optional[List[float]]) -> Optional[Dict[str, Any]]:
+        """キャッシュからヒントを取得（埋め込みがない場合は質問文の完全一致で参照）"""
+        if embedding is None:
+            cached = self.answer_cache.lookup_exact(
+                cache_namespace, normalize_key(query), index_version=self.retriever.index_version
+            )
+        else:
+            cached = self.answer_cache.lookup(
+                cache_namespace, embedding, index_version=self.retriever.index_version
+            )
+        metrics.increment("hint_cache_hits" if cached is not None else "hint_cache_misses")
+        return cached
+    
+    def _hint_prompt(self,
+                     query: str,
+                     level: int,
+                     error_message: Optional[str],
+                     code_context: Optional[str],
+                     embedding: Optional[List[float]]) -> str:
+        """関連するコンテキストを取得し、ヒント生成用のプロンプトを構築
         
-        # 関連するコンテキストを取得
-        context = self.retriever.get_context(query)
+        同じ質問の2回目以降のレベルでは、最初に検索したコンテキストを再利用する
+        """
+        context = self._stored_context(query)
+        if context is None:
+            context = self._build_context(
+                self.retriever.retrieve_result(query, k=settings.retrieval_k, embedding=embedding)
+            )
+            self._store_context(query, context)
         
-        # プロンプトの構築
-        hint_prompt = self._build_hint_prompt(
+        return self._build_hint_prompt(
             query=query,
-            level=HintLevel(current_level),
+            level=HintLevel(level),
             error_message=error_message,
             code_context=code_context,
             knowledge_context=context
         )
+    
+    def _batch_hint(self,
+                    query: str,
+                    level: int,
+                    error_message: Optional[str],
+                    code_context: Optional[str],
+                    embedding: Optional[List[float]]) -> Optional[Dict[str, Any]]:
+        """一括生成したヒントから指定レベルのものを取得（生成に失敗した場合は None）"""
+        batch = self.hint_history.get(
+            self._batch_namespace(error_message, code_context), normalize_key(query)
+        )
+        if batch is not None:
+            metrics.increment("hint_batch_hits")
+            return {"hint": batch["hints"][level], "cached": True}
+        
+        batch = self._generate_batch(query, error_message, code_context, embedding)
+        if batch is None:
+            return None
+        return {"hint": batch["hints"][level], "cached": False}
+    
+    def _generate_batch(self,
+                        query: str,
+                        error_message: Optional[str],
+                        code_context: Optional[str],
+                        embedding: Optional[List[float]]) -> Optional[Dict[str, Any]]:
+        """全レベルのヒントとキーワードを1回の呼び出しで生成し、正規化した質問ごとに記録"""
+        knowledge_context = self._stored_context(query)
+        if knowledge_context is None:
+            knowledge_context = self._build_context(
+                self.retriever.retrieve_result(query, k=settings.retrieval_k, embedding=embedding)
+            )
+            self._store_context(query, knowledge_context)
         
-        # ヒントの生成
-        system_prompt = """あなたは教育的なプログラミングアシスタントです。
-学生が自分で問題を解決できるよう、段階的なヒントを提供してください。
-直接的な答えは避け、考え方や調べ方を示してください。"""
+        prompt_parts = [f"学生の質問: {query}"]
+        for level, level_prompt in HINT_LEVEL_PROMPTS.items():
+            prompt_parts.append(f"\nレベル{level}の方針:\n{level_prompt}")
+        if error_message:
+            prompt_parts.append(f"\nエラーメッセージ:\n{error_message}")
+        if code_context:
+            prompt_parts.append(f"\nコードの文脈:\n{code_context}")
+        if knowledge_context:
+            prompt_parts.append(f"\n参考資料の概要:\n{knowledge_context}")
+        prompt_parts.append(f"\n{HINT_BATCH_PROMPT}")
         
-        hint_response = self.llm_client.generate_with_context(
-            query=hint_prompt,
+        response = self.llm_client.generate_with_context(
+            query="\n".join(prompt_parts),
             context="",
-            system_prompt=system_prompt
+            system_prompt=SYSTEM_PROMPT_HINT_GENERATOR
         )
         
+        batch = parse_hint_batch(response)
+        if batch is None:
+            # 解釈できない場合はレベルごとの生成に切り替える
+            print("Could not parse batch hint response; falling back to per-level generation")
+            return None
+        
+        self.hint_history.set(
+            self._batch_namespace(error_message, code_context), normalize_key(query), batch
+        )
+        return batch
+    
+    def _batch_namespace(self, error_message: Optional[str], code_context: Optional[str]) -> str:
+        """一括生成したヒントの名前空間（全セッションで共有し、プロンプト・インデックスごとに分ける）"""
+        version = prompt_version(
+            SYSTEM_PROMPT_HINT_GENERATOR,
+            *HINT_LEVEL_PROMPTS.values(),
+            HINT_BATCH_PROMPT,
+            error_message or "",
+            code_context or ""
+        )
+        return f"hint-batch:{version}:{self.retriever.index_version}"
+    
+    def _build_context(self, retrieval: RetrievalResult) -> str:
+        """検索結果からトークン数の上限に収まるコンテキストを作成"""
+        return retrieval.build_context(
+            max_tokens=settings.context_max_tokens or None,
+            count_tokens=self.llm_client.count_tokens
+        )
+    
+    def _stored_context(self, query: str) -> Optional[str]:
+        """質問に対して検索済みのコンテキストを取得（検索後にインデックスが更新された場合はNone）"""
+        stored = self.hint_history.get(self.session_namespace, f"context:{normalize_key(query)}")
+        if not isinstance(stored, tuple) or stored[0] != self.retriever.index_version:
+            return None
+        return stored[1]
+    
+    def _store_context(self, query: str, context: str) -> None:
+        """検索したコンテキストを、検索時のインデックスのバージョンとともに後続のレベルのために記録"""
+        self.hint_history.set(
+            self.session_namespace, f"context:{normalize_key(query)}",
+            (self.retriever.index_version, context)
+        )
+    
+    def _schedule_prefetch(self,
+                           query: str,
+                           level: int,
+                           error_message: Optional[str],
+                           code_context: Optional[str],
+                           embedding: Optional[List[float]]) -> None:
+        """次のレベルのヒントをバックグラウンドで先に生成する（opt-in）
+        
+        セッションごとの先読み回数が上限に達した場合や、
+        次のレベルがキャッシュ済みの場合は生成しない
+        """
+        if not settings.hint_prefetch_enabled or level >= 3:
+            return
+        # 一括生成モードでは次のレベルも生成済みのため先読みしない
+        if settings.hint_generation_mode == "batch":
+            return
+        
+        next_level = level + 1
+        next_namespace = self._cache_namespace(next_level, error_message, code_context)
+        if self.answer_cache is not None:
+            if self._lookup_hint(query, next_namespace, embedding) is not None:
+                return
+        
+        key = (normalize_key(query), next_level)
+        with self._prefetch_lock:
+            if key in self._prefetches:
+                return
+            if self._prefetch_count >= settings.hint_prefetch_max_per_session:
+                return
+            self._prefetch_count += 1
+            future = _get_prefetch_executor().submit(
+                self._generate_level, query, next_level, error_message, code_context,
+                next_namespace, embedding
+            )
+            self._prefetches[key] = (next_namespace, future)
+    
+    def _generate_level(self,
+                        query: str,
+                        level: int,
+                        error_message: Optional[str],
+                        code_context: Optional[str],
+                        cache_namespace: str,
+                        embedding: Optional[List[float]]) -> str:
+        """指定したレベルのヒントを生成してキャッシュに登録"""
+        with metrics.span("hint.prefetch", level=level):
+            hint_prompt = self._hint_prompt(query, level, error_message, code_context, embedding)
+            hint = self.llm_client.generate_with_context(
+                query=hint_prompt,
+                context="",
+                system_prompt=SYSTEM_PROMPT_HINT_GENERATOR
+            )
+            self._cache_hint(query, cache_namespace, embedding, hint)
+            return hint
+    
+    def _take_prefetched(self, query: str, level: int, cache_namespace: str) -> Optional[str]:
+        """先読みしたヒントを取り出す（生成中であれば完了を待つ）"""
+        key = normalize_key(query)
+        with self._prefetch_lock:
+            # 別の質問に移った場合、その先読みはもう使われないため取り消す
+            for other in [k for k in self._prefetches if k[0] != key]:
+                self._prefetches.pop(other)[1].cancel()
+            entry = self._prefetches.pop((key, level), None)
+        
+        if entry is None:
+            return None
+        
+        prefetch_namespace, future = entry
+        if prefetch_namespace != cache_namespace:
+            future.cancel()
+            return None
+        
+        try:
+            hint = future.result(timeout=settings.hint_prefetch_wait_seconds)
+            metrics.increment("hint_prefetch_hits")
+            return hint
+        except Exception as e:
+            print(f"Error prefetching hint: {e}")
+            return None
+    
+    def cancel_prefetch(self, query: Optional[str] = None) -> None:
+        """先読み中のヒントを取り消す（省略時は全て）"""
+        key = normalize_key(query) if query else None
+        with self._prefetch_lock:
+            for prefetch_key in list(self._prefetches):
+                if key is None or prefetch_key[0] == key:
+                    self._prefetches.pop(prefetch_key)[1].cancel()
+    
+    def _cache_hint(self,
+                    query: str,
+                    cache_namespace: str,
+                    embedding: Optional[List[float]],
+                    hint: str) -> None:
+        """生成したヒントをキャッシュに登録"""
+        if self.answer_cache is None:
+            return
+        self.answer_cache.store(
+            cache_namespace, embedding, {"hint": hint},
+            index_version=self.retriever.index_version, key=normalize_key(query)
+        )
+    
+    def _hint_result(self, hint: str, level: int, query: str, cached: bool = False) -> Dict[str, Any]:
+        """ヒントの応答を作成"""
+        metrics.increment("hints", level=level, cached=cached)
         return {
-            "hint": hint_response,
-            "level": current_level,
+            "hint": hint,
+            "level": level,
             "max_level": 3,
-            "next_level_available": current_level < 3,
-            "query": query
+            "next_level_available": level < 3,
+            "query": query,
+            "cached": cached
         }
     
+    def _cache_namespace(self,
+                         level: int,
+                         error_message: Optional[str],
+                         code_context: Optional[str]) -> str:
+        """回答キャッシュの名前空間（レベル・プロンプト・付加情報ごと）"""
+        version = prompt_version(
+            SYSTEM_PROMPT_HINT_GENERATOR,
+            HINT_LEVEL_PROMPTS[level],
+            error_message or "",
+            code_context or ""
+        )
+        return f"hint:{level}:{version}"
+    
     def _build_hint_prompt(self, 
                           query: str,
                           level: HintLevel,
@@ -86,7 +561,7 @@ class HintGenerator:
             prompt_parts.append(f"\nコードの文脈:\n{code_context}")
             
         if knowledge_context:
-            prompt_parts.append(f"\n参考資料の概要:\n{knowledge_context[:500]}...")
+            prompt_parts.append(f"\n参考資料の概要:\n{knowledge_context}")
         
         prompt_parts.append("\n上記の情報を基に、適切なレベルのヒントを提供してください。")
         
@@ -94,14 +569,27 @@ class HintGenerator:
     
     def reset_hint_level(self, query: Optional[str] = None):
         """ヒントレベルをリセット"""
+        self.cancel_prefetch(query)
         if query:
-            self.hint_history.pop(query, None)
+            self.hint_history.pop(self.session_namespace, normalize_key(query))
+            self.hint_history.pop(self.session_namespace, f"context:{normalize_key(query)}")
         else:
-            self.hint_history.clear()
+            self.hint_history.clear(self.session_namespace)
     
     def get_hint_keywords(self, query: str) -> Dict[str, Any]:
         """質問に関連するキーワードやコンセプトを提供"""
         
+        # 一括生成モードではヒントと一緒に生成したキーワードを使う
+        if settings.hint_generation_mode == "batch":
+            batch = self.hint_history.get(self._batch_namespace(None, None), normalize_key(query))
+            if batch is None:
+                batch = self._generate_batch(query, None, None, None)
+            if batch is not None and batch["keywords"]:
+                return {
+                    "keywords": "、".join(batch["keywords"]),
+                    "query": query
+                }
+        
         # 関連文書から重要なキーワードを抽出
         documents = self.retriever.retrieve(query, k=3)
         
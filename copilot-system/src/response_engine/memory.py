@@ -0,0 +1,209 @@
+"""トークン数の上限付きで古い会話を要約する会話履歴"""
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from ..llm.prompts import SYSTEM_PROMPT_SUMMARY
+from ..utils.config import settings
+
+
+# 要約はリクエストの処理を待たせないようにバックグラウンドで行う
+_summary_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_summary_executor() -> ThreadPoolExecutor:
+    """要約用の共有スレッドプールを取得"""
+    global _summary_executor
+    if _summary_executor is None:
+        with _executor_lock:
+            if _summary_executor is None:
+                _summary_executor = ThreadPoolExecutor(
+                    max_workers=2, thread_name_prefix="history-summary"
+                )
+    return _summary_executor
+
+
+class _Message:
+    """1件のメッセージ（長い本文は圧縮して保持する）"""
+    __slots__ = ("role", "_content", "tokens")
+
+    def __init__(self, role: str, content: str, tokens: int):
+        self.role = role
+        self.tokens = tokens
+        if len(content) > settings.history_compress_threshold:
+            self._content: Union[str, bytes] = zlib.compress(content.encode("utf-8"))
+        else:
+            self._content = content
+
+    @property
+    def content(self) -> str:
+        if isinstance(self._content, bytes):
+            return zlib.decompress(self._content).decode("utf-8")
+        return self._content
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content}
+
+
+class ConversationMemory:
+    """トークン数の上限内に収まるよう古い会話を要約にまとめる会話履歴
+
+    リストと同様に len・添字・反復で保持中のメッセージ（{"role", "content"}）を参照できる。
+    上限を超えた古いメッセージはバックグラウンドで要約に統合し、要約ができるまでは
+    そのままプロンプトに含める。要約は上限の半分までに収め、残りを直近のメッセージに使う。
+    要約は履歴をプロンプトに使うとき（context_messages）にだけ行い、
+    履歴を使わない回答で記録するだけの場合はLLMを呼ばない。
+    """
+
+    def __init__(self,
+                 llm_client,
+                 max_tokens: Optional[int] = None,
+                 summarize: Optional[bool] = None,
+                 count_tokens: Optional[Callable[[str], int]] = None):
+        self.llm_client = llm_client
+        self.max_tokens = max_tokens if max_tokens is not None else settings.history_max_tokens
+        self.summarize = summarize if summarize is not None else settings.history_summary_enabled
+        self.count_tokens = count_tokens or llm_client.count_tokens
+        self.summary = ""
+        self._summary_tokens = 0
+        self._messages: List[_Message] = []
+        self._folding: List[_Message] = []
+        self._pending: Optional[Future] = None
+        self._generation = 0
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        return iter(self.messages())
+
+    def __getitem__(self, index):
+        with self._lock:
+            if isinstance(index, slice):
+                return [message.to_dict() for message in self._messages[index]]
+            return self._messages[index].to_dict()
+
+    def append(self, message: Dict[str, str]) -> None:
+        """メッセージを追加"""
+        content = message.get("content", "")
+        tokens = self.count_tokens(content)
+        with self._lock:
+            self._messages.append(_Message(message.get("role", ""), content, tokens))
+            # 要約しない場合もメッセージ数の上限を超えた古いものは捨てる
+            overflow = len(self._messages) - settings.history_max_messages
+            if overflow > 0:
+                del self._messages[:overflow]
+
+    def clear(self) -> None:
+        """履歴と要約をクリア"""
+        with self._lock:
+            self._messages = []
+            self._folding = []
+            self.summary = ""
+            self._summary_tokens = 0
+            self._pending = None
+            # 実行中の要約の結果は破棄する
+            self._generation += 1
+
+    def messages(self) -> List[Dict[str, str]]:
+        """保持中のメッセージの一覧"""
+        with self._lock:
+            return [message.to_dict() for message in self._messages]
+
+    def context_messages(self) -> List[Dict[str, str]]:
+        """プロンプトに含める履歴（要約と、上限に収まる直近のメッセージ）
+
+        上限を超えた古いメッセージはここで要約に回し、次回以降の要約に反映する。
+        要約の作成中は、要約に回したメッセージもそのまま含める（一時的に上限を超えうる）
+        """
+        with self._lock:
+            self._fold_old_messages()
+            messages = []
+            if self.summary:
+                messages.append({"role": "system", "content": f"これまでの会話の要約:\n{self.summary}"})
+            messages.extend(message.to_dict() for message in self._folding)
+            recent = self._messages[self._recent_start(self._recent_budget()):]
+            messages.extend(message.to_dict() for message in recent)
+            return messages
+
+    def wait(self, timeout: Optional[float] = None) -> None:
+        """実行中の要約の完了を待つ"""
+        pending = self._pending
+        if pending is not None:
+            pending.result(timeout=timeout)
+
+    def _summary_max_tokens(self) -> int:
+        """要約に使えるトークン数（直近のメッセージの枠を残すため上限の半分まで）"""
+        return self.max_tokens // 2
+
+    def _recent_budget(self) -> int:
+        """直近のメッセージに使えるトークン数"""
+        return self.max_tokens - min(self._summary_tokens, self._summary_max_tokens())
+
+    def _recent_start(self, budget: int) -> int:
+        """上限のトークン数に収まる直近のメッセージの開始位置"""
+        start = len(self._messages)
+        used = 0
+        while start > 0 and used + self._messages[start - 1].tokens <= budget:
+            start -= 1
+            used += self._messages[start].tokens
+        return start
+
+    def _fold_old_messages(self) -> None:
+        """上限に収まらない古いメッセージを要約に回す"""
+        if not self.summarize or self._pending is not None:
+            return
+
+        start = self._recent_start(self._recent_budget())
+        if start == 0:
+            return
+
+        self._folding = self._messages[:start]
+        self._messages = self._messages[start:]
+        self._pending = _get_summary_executor().submit(
+            self._summarize, self.summary, list(self._folding), self._generation
+        )
+
+    def _summarize(self, summary: str, folding: List[_Message], generation: int) -> None:
+        """これまでの要約と古いメッセージを統合した要約を作成"""
+        transcript = "\n".join(f"{message.role}: {message.content}" for message in folding)
+        prompt = f"これまでの要約:\n{summary or 'なし'}\n\n新しい会話:\n{transcript}"
+
+        try:
+            new_summary = self.llm_client.generate(self.llm_client.create_chat_history([
+                {"role": "system", "content": SYSTEM_PROMPT_SUMMARY},
+                {"role": "user", "content": prompt}
+            ]))
+        except Exception as e:
+            print(f"Error summarizing conversation history: {e}")
+            with self._lock:
+                if generation == self._generation:
+                    # 要約できなかったメッセージは戻し、次に履歴を使うときに再試行する
+                    self._messages = self._folding + self._messages
+                    self._folding = []
+                    self._pending = None
+            return
+
+        new_summary, tokens = self._truncate_summary(new_summary)
+        with self._lock:
+            if generation != self._generation:
+                return
+            self.summary = new_summary
+            self._summary_tokens = tokens
+            self._folding = []
+            self._pending = None
+
+    def _truncate_summary(self, summary: str) -> Tuple[str, int]:
+        """要約を上限のトークン数に収まるまで末尾から切り詰め、トークン数とともに返す"""
+        max_tokens = self._summary_max_tokens()
+        tokens = self.count_tokens(summary)
+        length = len(summary)
+
+        while tokens > max_tokens and length > 0:
+            length = min(int(length * max_tokens / tokens), int(length * 0.9))
+            summary = summary[:length]
+            tokens = self.count_tokens(summary)
+        return summary, tokens
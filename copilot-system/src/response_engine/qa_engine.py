@@ -1,9 +1,14 @@
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Iterator
 from enum import Enum
 
-from ..knowledge_base.retriever import KnowledgeRetriever
+from ..knowledge_base.retriever import KnowledgeRetriever, RetrievalResult
 from ..llm.client import LLMClient
 from ..llm.prompts import SYSTEM_PROMPT_NORMAL, SYSTEM_PROMPT_HINT
+from ..utils import metrics
+from ..utils.config import settings
+from ..utils.state_store import normalize_key
+from .answer_cache import SemanticAnswerCache, get_shared_answer_cache, prompt_version
+from .memory import ConversationMemory
 
 
 class ResponseMode(Enum):
@@ -15,11 +20,15 @@ class ResponseMode(Enum):
 class QAEngine:
     """質問応答エンジン"""
     
-    def __init__(self):
-        self.retriever = KnowledgeRetriever()
-        self.llm_client = LLMClient()
+    def __init__(self,
+                 retriever: Optional[KnowledgeRetriever] = None,
+                 answer_cache: Optional[SemanticAnswerCache] = None,
+                 llm_client: Optional[LLMClient] = None):
+        self.retriever = retriever if retriever is not None else KnowledgeRetriever()
+        self.llm_client = llm_client if llm_client is not None else LLMClient()
+        self.answer_cache = answer_cache if answer_cache is not None else get_shared_answer_cache()
         self.mode = ResponseMode.NORMAL
-        self.conversation_history: List[Dict[str, str]] = []
+        self.conversation_history = ConversationMemory(self.llm_client)
     
     def set_mode(self, mode: ResponseMode):
         """応答モードを設定"""
@@ -27,87 +36,241 @@ class QAEngine:
     
     def answer(self, query: str, use_context: bool = True) -> Dict[str, Any]:
         """質問に回答"""
-        # コンテキストの取得
-        context = ""
-        retrieved_docs = []
+        with metrics.span("qa.answer", mode=self.mode.value):
+            system_prompt = self._system_prompt()
+            cache_namespace = self._cache_namespace(system_prompt)
+            
+            # 類似の質問への回答がキャッシュにあればそれを返す
+            # （語彙検索だけで決まる質問は埋め込みを行わず、正規化した質問文の完全一致で参照する）
+            embedding = None
+            retrieval = None
+            if use_context and self.answer_cache is not None:
+                retrieval = self.retriever.lexical_result(query, k=settings.retrieval_k)
+                if retrieval is None:
+                    embedding = self.retriever.embed_query(query)
+                cached = self._lookup_cache(query, cache_namespace, embedding)
+                if cached is not None:
+                    return cached
+            
+            # コンテキストの取得（検索は1回だけ行い、結果を共有する）
+            if retrieval is None:
+                retrieval = RetrievalResult(query=query)
+                if use_context:
+                    retrieval = self.retriever.retrieve_result(query, k=settings.retrieval_k, embedding=embedding)
+            context = self._build_context(retrieval)
+            
+            # 回答の生成
+            response = self.llm_client.generate_with_context(
+                query=query,
+                context=context,
+                system_prompt=system_prompt
+            )
+            
+            result = self._answer_result(response, retrieval, context, use_context)
+            self._record_answer(query, result, cache_namespace, embedding)
+            return result
+    
+    async def aanswer(self, query: str, use_context: bool = True) -> Dict[str, Any]:
+        """質問に回答（非同期版）"""
+        with metrics.span("qa.answer", mode=self.mode.value):
+            system_prompt = self._system_prompt()
+            cache_namespace = self._cache_namespace(system_prompt)
+            
+            embedding = None
+            retrieval = None
+            if use_context and self.answer_cache is not None:
+                retrieval = self.retriever.lexical_result(query, k=settings.retrieval_k)
+                if retrieval is None:
+                    embedding = await self.retriever.aembed_query(query)
+                cached = self._lookup_cache(query, cache_namespace, embedding)
+                if cached is not None:
+                    return cached
+            
+            if retrieval is None:
+                retrieval = RetrievalResult(query=query)
+                if use_context:
+                    retrieval = await self.retriever.aretrieve_result(query, k=settings.retrieval_k, embedding=embedding)
+            context = self._build_context(retrieval)
+            
+            response = await self.llm_client.agenerate_with_context(
+                query=query,
+                context=context,
+                system_prompt=system_prompt
+            )
+            
+            result = self._answer_result(response, retrieval, context, use_context)
+            self._record_answer(query, result, cache_namespace, embedding)
+            return result
+    
+    def stream_answer(self, query: str, use_context: bool = True) -> Dict[str, Any]:
+        """質問に回答（トークンを逐次返すストリーミング版）
         
-        if use_context:
-            context = self.retriever.get_context(query)
-            retrieved_docs = self.retriever.retrieve(query, k=3)
+        戻り値の "stream" を最後まで読み進めると、"response" に回答全体が入り、
+        会話履歴とキャッシュに記録される
+        """
+        system_prompt = self._system_prompt()
+        cache_namespace = self._cache_namespace(system_prompt)
         
-        # システムプロンプトの選択
-        system_prompt = (
-            SYSTEM_PROMPT_HINT if self.mode == ResponseMode.HINT 
-            else SYSTEM_PROMPT_NORMAL
-        )
+        # 最初のトークンまでの準備（キャッシュ参照・検索・コンテキスト作成）を計測する
+        with metrics.span("qa.prepare_stream", mode=self.mode.value):
+            embedding = None
+            retrieval = None
+            if use_context and self.answer_cache is not None:
+                retrieval = self.retriever.lexical_result(query, k=settings.retrieval_k)
+                if retrieval is None:
+                    embedding = self.retriever.embed_query(query)
+                cached = self._lookup_cache(query, cache_namespace, embedding)
+                if cached is not None:
+                    cached["stream"] = iter([cached["response"]])
+                    return cached
+            
+            if retrieval is None:
+                retrieval = RetrievalResult(query=query)
+                if use_context:
+                    retrieval = self.retriever.retrieve_result(query, k=settings.retrieval_k, embedding=embedding)
+            context = self._build_context(retrieval)
         
-        # 回答の生成
-        response = self.llm_client.generate_with_context(
-            query=query,
-            context=context,
-            system_prompt=system_prompt
-        )
+        result = self._answer_result("", retrieval, context, use_context)
         
-        # 会話履歴に追加
-        self.conversation_history.append({"role": "user", "content": query})
-        self.conversation_history.append({"role": "assistant", "content": response})
+        def stream() -> Iterator[str]:
+            tokens = []
+            for token in self.llm_client.stream_with_context(
+                query=query,
+                context=context,
+                system_prompt=system_prompt
+            ):
+                tokens.append(token)
+                yield token
+            
+            result["response"] = "".join(tokens)
+            self._record_answer(query, result, cache_namespace, embedding)
         
-        return {
-            "response": response,
-            "mode": self.mode.value,
-            "context_used": use_context,
-            "retrieved_documents": [
-                {
-                    "content": doc.page_content[:200] + "...",
-                    "metadata": doc.metadata
-                } for doc in retrieved_docs
-            ]
-        }
+        result["stream"] = stream()
+        return result
     
-    def answer_with_history(self, query: str) -> Dict[str, Any]:
-        """会話履歴を考慮して回答"""
-        # コンテキストの取得
-        context = self.retriever.get_context(query)
-        
-        # システムプロンプトを含む会話履歴の作成
-        system_prompt = (
+    def _system_prompt(self) -> str:
+        """モードに応じたシステムプロンプトを選択"""
+        return (
             SYSTEM_PROMPT_HINT if self.mode == ResponseMode.HINT 
             else SYSTEM_PROMPT_NORMAL
         )
+    
+    def _build_context(self, retrieval: RetrievalResult) -> str:
+        """検索結果からトークン数の上限に収まるコンテキストを作成"""
+        with metrics.span("qa.build_context") as span:
+            context = retrieval.build_context(
+                max_tokens=settings.context_max_tokens or None,
+                count_tokens=self.llm_client.count_tokens
+            )
+            span.set(chunks=len(retrieval.documents), context_chars=len(context))
+        return context
+    
+    def _cache_namespace(self, system_prompt: str) -> str:
+        """回答キャッシュの名前空間（モード・プロンプトごと）"""
+        return f"qa:{self.mode.value}:{prompt_version(system_prompt)}"
+    
+    def _lookup_cache(self,
+                      query: str,
+                      cache_namespace: str,
+                      embedding: Optional[List[float]]) -> Optional[Dict[str, Any]]:
+        """キャッシュから回答を取得し、見つかれば会話履歴に追加
         
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        # 過去の会話履歴を追加（最新の5つまで）
-        recent_history = self.conversation_history[-10:] if len(self.conversation_history) > 10 else self.conversation_history
-        messages.extend(recent_history)
-        
-        # 現在の質問とコンテキストを追加
-        if context:
-            user_message = f"参考資料:\n{context}\n\n質問: {query}"
+        埋め込みがない場合（語彙検索だけで決まる質問）は正規化した質問文の完全一致で参照する
+        """
+        if embedding is None:
+            cached = self.answer_cache.lookup_exact(
+                cache_namespace, normalize_key(query), index_version=self.retriever.index_version
+            )
         else:
-            user_message = query
-            
-        messages.append({"role": "user", "content": user_message})
-        
-        # メッセージリストの作成と回答生成
-        message_objects = self.llm_client.create_chat_history(messages)
-        response = self.llm_client.generate(message_objects)
+            cached = self.answer_cache.lookup(
+                cache_namespace, embedding, index_version=self.retriever.index_version
+            )
+        if cached is None:
+            metrics.increment("answer_cache_misses", mode=self.mode.value)
+            return None
         
-        # 会話履歴に追加
+        metrics.increment("answer_cache_hits", mode=self.mode.value)
         self.conversation_history.append({"role": "user", "content": query})
-        self.conversation_history.append({"role": "assistant", "content": response})
-        
+        self.conversation_history.append({"role": "assistant", "content": cached["response"]})
+        cached["cached"] = True
+        return cached
+    
+    def _answer_result(self,
+                       response: str,
+                       retrieval: RetrievalResult,
+                       context: str,
+                       use_context: bool) -> Dict[str, Any]:
+        """回答の応答を作成"""
         return {
             "response": response,
             "mode": self.mode.value,
-            "context_used": bool(context),
-            "history_length": len(self.conversation_history)
+            "context_used": use_context,
+            "context": context,
+            "retrieval": retrieval.to_dict(),
+            "retrieved_documents": retrieval.sources(k=3),
+            "cached": False
         }
     
+    def _record_answer(self,
+                       query: str,
+                       result: Dict[str, Any],
+                       cache_namespace: str,
+                       embedding: Optional[List[float]]) -> None:
+        """回答を会話履歴とキャッシュに記録"""
+        self.conversation_history.append({"role": "user", "content": query})
+        self.conversation_history.append({"role": "assistant", "content": result["response"]})
+        
+        if self.answer_cache is not None and result["context_used"]:
+            cached = {key: value for key, value in result.items() if key != "stream"}
+            self.answer_cache.store(
+                cache_namespace, embedding, cached,
+                index_version=self.retriever.index_version, key=normalize_key(query)
+            )
+    
+    def answer_with_history(self, query: str) -> Dict[str, Any]:
+        """会話履歴を考慮して回答"""
+        with metrics.span("qa.answer_with_history", mode=self.mode.value):
+            # コンテキストの取得
+            retrieval = self.retriever.retrieve_result(query, k=settings.retrieval_k)
+            context = self._build_context(retrieval)
+            
+            # システムプロンプトを含む会話履歴の作成
+            system_prompt = self._system_prompt()
+            
+            messages = [{"role": "system", "content": system_prompt}]
+            
+            # 過去の会話履歴を追加（トークン数の上限内の直近の会話と、それ以前の要約）
+            messages.extend(self.conversation_history.context_messages())
+            
+            # 現在の質問とコンテキストを追加
+            if context:
+                user_message = f"参考資料:\n{context}\n\n質問: {query}"
+            else:
+                user_message = query
+                
+            messages.append({"role": "user", "content": user_message})
+            
+            # メッセージリストの作成と回答生成
+            message_objects = self.llm_client.create_chat_history(messages)
+            response = self.llm_client.generate(message_objects)
+            
+            # 会話履歴に追加
+            self.conversation_history.append({"role": "user", "content": query})
+            self.conversation_history.append({"role": "assistant", "content": response})
+            
+            return {
+                "response": response,
+                "mode": self.mode.value,
+                "context_used": bool(context),
+                "context": context,
+                "retrieval": retrieval.to_dict(),
+                "history_length": len(self.conversation_history)
+            }
+    
     def clear_history(self):
         """会話履歴をクリア"""
-        self.conversation_history = []
+        self.conversation_history.clear()
     
     def get_history(self) -> List[Dict[str, str]]:
         """会話履歴を取得"""
-        return self.conversation_history
\ No newline at end of file
+        return self.conversation_history.messages()
\ No newline at end of file
@@ -4,7 +4,8 @@ from pathlib import Path
 
 from ..response_engine.qa_engine import QAEngine, ResponseMode
 from ..response_engine.hint_generator import HintGenerator
-from ..knowledge_base.retriever import KnowledgeRetriever
+from ..knowledge_base.registry import get_shared_retriever
+from ..utils import metrics
 
 
 # ページ設定
@@ -14,11 +15,32 @@ st.set_page_config(
     layout="wide"
 )
 
+
+@st.cache_resource
+def load_shared_retriever():
+    """全セッションで共有するリトリーバーを取得"""
+    # 設定されていればメトリクスのHTTPサーバーもプロセスに1つだけ起動する
+    metrics.start_http_server()
+    return get_shared_retriever()
+
+
+def render_stream(stream) -> str:
+    """トークンを受け取るたびに表示を更新し、全文を返す"""
+    placeholder = st.empty()
+    text = ""
+    for token in stream:
+        text += token
+        placeholder.markdown(text + "▌")
+    placeholder.markdown(text)
+    return text
+
+
 # セッション状態の初期化
 if "qa_engine" not in st.session_state:
-    st.session_state.qa_engine = QAEngine()
-    st.session_state.hint_generator = HintGenerator()
-    st.session_state.retriever = KnowledgeRetriever()
+    shared_retriever = load_shared_retriever()
+    st.session_state.qa_engine = QAEngine(retriever=shared_retriever)
+    st.session_state.hint_generator = HintGenerator(retriever=shared_retriever)
+    st.session_state.retriever = shared_retriever
     st.session_state.messages = []
     st.session_state.mode = ResponseMode.NORMAL
 
@@ -101,48 +123,46 @@ if prompt := st.chat_input("演習に関する質問を入力してください.
     
     # アシスタントの応答
     with st.chat_message("assistant"):
-        with st.spinner("考え中..."):
-            if st.session_state.mode == ResponseMode.HINT:
-                # ヒントモードの場合
-                hint_response = st.session_state.hint_generator.generate_hint(prompt)
-                response_text = hint_response["hint"]
-                hint_level = hint_response["level"]
-                
-                st.markdown(response_text)
-                st.caption(f"ヒントレベル: {hint_level}/3")
-                
-                # 次のレベルのヒントボタン
-                if hint_response["next_level_available"]:
-                    if st.button("もう少し詳しいヒントを見る"):
-                        next_hint = st.session_state.hint_generator.generate_hint(prompt)
-                        st.markdown(next_hint["hint"])
-                        st.caption(f"ヒントレベル: {next_hint['level']}/3")
-                
-                # メッセージに追加
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response_text,
-                    "hint_level": hint_level
-                })
-            else:
-                # 通常モードの場合
-                response = st.session_state.qa_engine.answer(prompt)
-                response_text = response["response"]
-                
-                st.markdown(response_text)
-                
-                # 参照した文書を表示
-                if response.get("retrieved_documents"):
-                    with st.expander("参照した文書"):
-                        for i, doc in enumerate(response["retrieved_documents"]):
-                            st.caption(f"文書 {i+1}: {doc['metadata'].get('source', 'Unknown')}")
-                            st.text(doc["content"])
-                
-                # メッセージに追加
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response_text
-                })
+        if st.session_state.mode == ResponseMode.HINT:
+            # ヒントモードの場合
+            with st.spinner("考え中..."):
+                hint_response = st.session_state.hint_generator.stream_hint(prompt)
+            response_text = render_stream(hint_response["stream"])
+            hint_level = hint_response["level"]
+            
+            st.caption(f"ヒントレベル: {hint_level}/3")
+            
+            # 次のレベルのヒントボタン
+            if hint_response["next_level_available"]:
+                if st.button("もう少し詳しいヒントを見る"):
+                    next_hint = st.session_state.hint_generator.stream_hint(prompt)
+                    render_stream(next_hint["stream"])
+                    st.caption(f"ヒントレベル: {next_hint['level']}/3")
+            
+            # メッセージに追加
+            st.session_state.messages.append({
+                "role": "assistant",
+                "content": response_text,
+                "hint_level": hint_level
+            })
+        else:
+            # 通常モードの場合
+            with st.spinner("考え中..."):
+                response = st.session_state.qa_engine.stream_answer(prompt)
+            response_text = render_stream(response["stream"])
+            
+            # 参照した文書を表示
+            if response.get("retrieved_documents"):
+                with st.expander("参照した文書"):
+                    for i, doc in enumerate(response["retrieved_documents"]):
+                        st.caption(f"文書 {i+1}: {doc['metadata'].get('source', 'Unknown')}")
+                        st.text(doc["content"])
+            
+            # メッセージに追加
+            st.session_state.messages.append({
+                "role": "assistant",
+                "content": response_text
+            })
 
 # フッター
 st.divider()
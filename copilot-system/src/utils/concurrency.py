@@ -0,0 +1,52 @@
+"""非同期処理の同時実行数を制限するユーティリティ"""
+import asyncio
+import threading
+import weakref
+from typing import Optional
+
+from .config import settings
+
+
+class AsyncLimiter:
+    """同時に実行できる非同期処理の数を制限するクラス
+
+    asyncio.Semaphore はイベントループごとに作成する必要があるため、
+    ループごとにセマフォを保持する
+    """
+    
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self._semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._lock = threading.Lock()
+    
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphore = self._semaphores.get(loop)
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(self.max_concurrency)
+                self._semaphores[loop] = semaphore
+            return semaphore
+    
+    async def __aenter__(self) -> "AsyncLimiter":
+        await self._semaphore().acquire()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self._semaphore().release()
+
+
+_request_limiter: Optional[AsyncLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_request_limiter() -> AsyncLimiter:
+    """外部API呼び出しに共通で使う同時実行数リミッターを取得"""
+    global _request_limiter
+    
+    with _limiter_lock:
+        if _request_limiter is None:
+            _request_limiter = AsyncLimiter(settings.max_concurrent_requests)
+        return _request_limiter
@@ -16,11 +16,95 @@ class Settings(BaseSettings):
     model_name: str = os.getenv("MODEL_NAME", "gpt-4-turbo-preview")
     temperature: float = float(os.getenv("TEMPERATURE", "0.7"))
     max_tokens: int = int(os.getenv("MAX_TOKENS", "2000"))
+    token_count_cache_size: int = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "4096"))
     
     # Vector Store Configuration
     vector_store_type: str = os.getenv("VECTOR_STORE_TYPE", "chroma")
     chunk_size: int = int(os.getenv("CHUNK_SIZE", "1000"))
     chunk_overlap: int = int(os.getenv("CHUNK_OVERLAP", "200"))
+    ingest_workers: int = int(os.getenv("INGEST_WORKERS", "1"))
+    index_window_size: int = int(os.getenv("INDEX_WINDOW_SIZE", "512"))
+    
+    # Retrieval Configuration
+    retrieval_mode: str = os.getenv("RETRIEVAL_MODE", "hybrid")  # dense / hybrid / lexical
+    retrieval_k: int = int(os.getenv("RETRIEVAL_K", "5"))  # 回答・ヒントの生成に使うチャンク数
+    lexical_index_enabled: bool = os.getenv("LEXICAL_INDEX_ENABLED", "true").lower() == "true"
+    rrf_k: int = int(os.getenv("RRF_K", "60"))
+    lexical_min_score: float = float(os.getenv("LEXICAL_MIN_SCORE", "2.0"))
+    lexical_decisive_ratio: float = float(os.getenv("LEXICAL_DECISIVE_RATIO", "2.0"))
+    context_max_tokens: int = int(os.getenv("CONTEXT_MAX_TOKENS", "1500"))  # 0 で上限なし
+    
+    # Conversation Memory Configuration
+    history_max_tokens: int = int(os.getenv("HISTORY_MAX_TOKENS", "1500"))
+    history_summary_enabled: bool = os.getenv("HISTORY_SUMMARY_ENABLED", "true").lower() == "true"
+    history_compress_threshold: int = int(os.getenv("HISTORY_COMPRESS_THRESHOLD", "2048"))  # 文字数
+    history_max_messages: int = int(os.getenv("HISTORY_MAX_MESSAGES", "200"))
+    
+    # FAISS Configuration
+    faiss_index_type: str = os.getenv("FAISS_INDEX_TYPE", "flat")  # flat / ivf / hnsw / pq
+    faiss_nlist: int = int(os.getenv("FAISS_NLIST", "1024"))
+    faiss_nprobe: int = int(os.getenv("FAISS_NPROBE", "16"))
+    faiss_hnsw_m: int = int(os.getenv("FAISS_HNSW_M", "32"))
+    faiss_hnsw_ef_search: int = int(os.getenv("FAISS_HNSW_EF_SEARCH", "64"))
+    faiss_pq_m: int = int(os.getenv("FAISS_PQ_M", "16"))
+    # 件数に見合う nlist が学習済みの nlist のこの倍数を超えたら再学習する
+    faiss_retrain_factor: int = int(os.getenv("FAISS_RETRAIN_FACTOR", "4"))
+    faiss_mmap: bool = os.getenv("FAISS_MMAP", "false").lower() == "true"  # 読み取り専用。メモリマップされるのは ivf / pq の転置リストのみ
+    
+    # Persistence Configuration
+    persist_mode: str = os.getenv("PERSIST_MODE", "immediate")  # immediate または deferred
+    persist_interval_seconds: float = float(os.getenv("PERSIST_INTERVAL_SECONDS", "30"))
+    persist_chunk_threshold: int = int(os.getenv("PERSIST_CHUNK_THRESHOLD", "1000"))
+    
+    # Embedding Configuration
+    embedding_provider: str = os.getenv("EMBEDDING_PROVIDER", "openai")  # openai / local
+    embedding_model: str = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+    embedding_dimension: int = int(os.getenv("EMBEDDING_DIMENSION", "0"))  # 0の場合はモデルから判定
+    embedding_cache_enabled: bool = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+    embedding_cache_max_entries: int = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+    embedding_batch_size: int = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+    embedding_concurrency: int = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+    embedding_checkpoint_batches: int = int(os.getenv("EMBEDDING_CHECKPOINT_BATCHES", "10"))
+    local_embedding_dimension: int = int(os.getenv("LOCAL_EMBEDDING_DIMENSION", "1024"))
+    local_embedding_ngram_min: int = int(os.getenv("LOCAL_EMBEDDING_NGRAM_MIN", "2"))
+    local_embedding_ngram_max: int = int(os.getenv("LOCAL_EMBEDDING_NGRAM_MAX", "3"))
+    
+    # Answer Cache Configuration
+    answer_cache_enabled: bool = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+    answer_cache_similarity_threshold: float = float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.97"))
+    answer_cache_ttl_seconds: float = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+    answer_cache_max_entries: int = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+    
+    # Hint Generation Configuration
+    hint_generation_mode: str = os.getenv("HINT_GENERATION_MODE", "per_level")  # per_level / batch
+    
+    # Hint Prefetch Configuration
+    hint_prefetch_enabled: bool = os.getenv("HINT_PREFETCH_ENABLED", "false").lower() == "true"
+    hint_prefetch_max_per_session: int = int(os.getenv("HINT_PREFETCH_MAX_PER_SESSION", "20"))
+    hint_prefetch_workers: int = int(os.getenv("HINT_PREFETCH_WORKERS", "4"))
+    hint_prefetch_wait_seconds: float = float(os.getenv("HINT_PREFETCH_WAIT_SECONDS", "30"))
+    
+    # Session State Configuration
+    state_store_max_entries: int = int(os.getenv("STATE_STORE_MAX_ENTRIES", "10000"))
+    state_store_ttl_seconds: float = float(os.getenv("STATE_STORE_TTL_SECONDS", "21600"))
+    state_store_spill_enabled: bool = os.getenv("STATE_STORE_SPILL_ENABLED", "false").lower() == "true"
+    evaluation_history_max_entries: int = int(os.getenv("EVALUATION_HISTORY_MAX_ENTRIES", "500"))
+    
+    # Batch Evaluation Configuration
+    evaluation_concurrency: int = int(os.getenv("EVALUATION_CONCURRENCY", "8"))
+    evaluation_cache_enabled: bool = os.getenv("EVALUATION_CACHE_ENABLED", "true").lower() == "true"
+    evaluation_cache_max_entries: int = int(os.getenv("EVALUATION_CACHE_MAX_ENTRIES", "10000"))
+    
+    # Concurrency Configuration
+    max_concurrent_requests: int = int(os.getenv("MAX_CONCURRENT_REQUESTS", "16"))
+    api_max_retries: int = int(os.getenv("API_MAX_RETRIES", "6"))
+    api_retry_base_delay: float = float(os.getenv("API_RETRY_BASE_DELAY", "1.0"))
+    
+    # Metrics Configuration
+    metrics_enabled: bool = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+    metrics_log_path: str = os.getenv("METRICS_LOG_PATH", "")  # JSONログの出力先（"-" で標準出力）
+    metrics_host: str = os.getenv("METRICS_HOST", "127.0.0.1")
+    metrics_port: int = int(os.getenv("METRICS_PORT", "0"))  # 0 でHTTPサーバーを起動しない
     
     # Application Settings
     app_port: int = int(os.getenv("APP_PORT", "8501"))
@@ -30,6 +114,9 @@ class Settings(BaseSettings):
     data_dir: str = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "data")
     exercises_dir: str = os.path.join(data_dir, "exercises")
     vector_store_path: str = os.path.join(data_dir, "vector_store")
+    embedding_cache_path: str = os.path.join(data_dir, "cache", "embeddings.sqlite3")
+    state_store_path: str = os.path.join(data_dir, "cache", "state.sqlite3")
+    evaluation_cache_path: str = os.path.join(data_dir, "cache", "evaluations.sqlite3")
     
     class Config:
         env_file = ".env"
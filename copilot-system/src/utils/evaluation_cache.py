@@ -0,0 +1,106 @@
+"""評価結果のディスクキャッシュ"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+class EvaluationCache:
+    """(名前空間, 評価キー) をキーにした評価結果のSQLiteキャッシュ
+
+    名前空間には評価プロンプトとモデルのバージョンを含め、どちらかが変わると別のエントリになる。
+    件数が max_entries を超えると、最後に参照された時刻が古いものから削除する。
+    データベースは最初に参照したときに開く（一括評価を使わなければファイルを作らない）
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._count = 0
+
+    def get(self, namespace: str, key: str) -> Optional[Dict[str, Any]]:
+        """評価結果を取得（未登録の場合はNone）"""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT record FROM evaluations WHERE namespace = ? AND key = ?",
+                (namespace, key)
+            ).fetchone()
+            if row is None:
+                return None
+
+            self._conn.execute(
+                "UPDATE evaluations SET last_access = ? WHERE namespace = ? AND key = ?",
+                (time.time(), namespace, key)
+            )
+            self._conn.commit()
+
+        return json.loads(row[0])
+
+    def set(self, namespace: str, key: str, record: Dict[str, Any]) -> None:
+        """評価結果を登録"""
+        encoded = json.dumps(record, ensure_ascii=False)
+
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO evaluations (namespace, key, record, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                (namespace, key, encoded, time.time())
+            )
+            self._conn.commit()
+            self._count += 1
+            if self._count > self.max_entries:
+                self._evict()
+
+    def clear(self) -> None:
+        """全てのエントリを削除"""
+        with self._lock:
+            self._connect().execute("DELETE FROM evaluations")
+            self._conn.commit()
+            self._count = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM evaluations").fetchone()[0]
+
+    def _connect(self) -> sqlite3.Connection:
+        """データベースを開く（初回のみ。ロックを取得した状態で呼ぶ）"""
+        if self._conn is not None:
+            return self._conn
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS evaluations (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                record TEXT NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_evaluations_last_access ON evaluations (last_access)"
+        )
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM evaluations").fetchone()[0]
+        return self._conn
+
+    def _evict(self) -> None:
+        """古いエントリを削除して上限の9割まで減らす"""
+        self._count = self._conn.execute("SELECT COUNT(*) FROM evaluations").fetchone()[0]
+        excess = self._count - int(self.max_entries * 0.9)
+        if excess <= 0:
+            return
+
+        self._conn.execute(
+            "DELETE FROM evaluations WHERE rowid IN ("
+            "SELECT rowid FROM evaluations ORDER BY last_access LIMIT ?)",
+            (excess,)
+        )
+        self._conn.commit()
+        self._count -= excess
@@ -1,25 +1,24 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterable, Iterator, List, Optional
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
 import json
 
 from ..llm.client import LLMClient
 from ..llm.prompts import EVALUATION_PROMPT
+from ..knowledge_base.retriever import RetrievalResult
+from ..response_engine.answer_cache import prompt_version
+from . import metrics
+from .config import settings
+from .evaluation_cache import EvaluationCache
 
 
-class ResponseEvaluator:
-    """回答品質を評価するクラス"""
-    
-    def __init__(self):
-        self.llm_client = LLMClient()
-        self.evaluation_history: List[Dict[str, Any]] = []
-    
-    def evaluate_response(self, 
-                         query: str, 
-                         response: str, 
-                         mode: str,
-                         context: str = "") -> Dict[str, Any]:
-        """回答の品質を評価"""
-        
-        evaluation_prompt = f"""以下の質問と回答を評価してください。
+SCORE_KEYS = ["accuracy", "clarity", "relevance", "educational_value", "hint_appropriateness"]
+
+EVALUATION_SYSTEM_PROMPT = "教育専門家として、回答の品質を客観的に評価してください。"
+
+# 1件の評価を依頼するプロンプト（評価キャッシュの名前空間にも含める）
+EVALUATION_REQUEST_TEMPLATE = """以下の質問と回答を評価してください。
 
 質問: {query}
 
@@ -28,23 +27,195 @@ class ResponseEvaluator:
 モード: {mode}
 
 参考にした文脈:
-{context[:500] if context else "なし"}
+{context}
 
-{EVALUATION_PROMPT}
+{criteria}
 """
+
+
+def evaluation_key(query: str, response: str, mode: str, context: str = "") -> str:
+    """評価結果のキャッシュキー（評価プロンプトに含まれる内容のハッシュ）"""
+    hasher = hashlib.sha256()
+    for part in (query, response, mode, context[:500]):
+        hasher.update(part.encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+class ResponseEvaluator:
+    """回答品質を評価するクラス"""
+    
+    def __init__(self,
+                 llm_client: Optional[LLMClient] = None,
+                 cache: Optional[EvaluationCache] = None):
+        self.llm_client = llm_client if llm_client is not None else LLMClient()
+        # 一括評価の結果は（質問・回答・モード・文脈・プロンプト）ごとにディスクに保存して再利用する
+        if cache is None and settings.evaluation_cache_enabled:
+            cache = EvaluationCache(
+                settings.evaluation_cache_path,
+                max_entries=settings.evaluation_cache_max_entries
+            )
+        self.cache = cache
+        # 詳細は直近の評価だけを保持し、集計は全件の累計で行う
+        self.evaluation_history: deque = deque(maxlen=settings.evaluation_history_max_entries)
+        self._num_evaluations = 0
+        self._score_totals = {key: 0 for key in SCORE_KEYS}
+        self._mode_counts = {"normal": 0, "hint": 0}
+        self._mode_scores = {"normal": 0, "hint": 0}
+    
+    def evaluate_response(self, 
+                         query: str, 
+                         response: str, 
+                         mode: str,
+                         context: str = "",
+                         retrieval: Optional[RetrievalResult] = None) -> Dict[str, Any]:
+        """回答の品質を評価
         
-        # 評価の実行
-        evaluation_result = self.llm_client.generate_with_context(
-            query=evaluation_prompt,
-            context="",
-            system_prompt="教育専門家として、回答の品質を客観的に評価してください。"
+        retrieval を渡した場合は、回答生成時の検索結果をそのまま文脈として使用する
+        """
+        if not context and retrieval is not None:
+            # 回答生成時と同じトークン数の上限でコンテキストを作成する
+            context = retrieval.build_context(
+                max_tokens=settings.context_max_tokens or None,
+                count_tokens=self.llm_client.count_tokens
+            )
+        
+        evaluation_record = self._evaluate(query, response, mode, context)
+        self._record(evaluation_record)
+        metrics.increment("evaluations", mode=mode)
+        
+        return evaluation_record
+    
+    def evaluate_batch(self,
+                       items: Iterable[Dict[str, Any]],
+                       output_path: Optional[str] = None,
+                       concurrency: Optional[int] = None,
+                       suggest: bool = False) -> Dict[str, Any]:
+        """複数の回答をまとめて評価し、完了したものから JSONL に書き出す
+        
+        items は query・response・mode（任意で context）を持つ辞書。
+        全件をメモリに溜めずに1行ずつ書き出し、件数と累計のサマリーを返す。
+        """
+        counts = {"evaluated": 0, "cached": 0, "errors": 0}
+        output = open(output_path, "w", encoding="utf-8") if output_path else None
+        try:
+            for record in self.iter_evaluate_batch(items, concurrency=concurrency, suggest=suggest):
+                if "error" in record:
+                    counts["errors"] += 1
+                else:
+                    counts["evaluated"] += 1
+                    counts["cached"] += int(record["cached"])
+                if output is not None:
+                    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    output.flush()
+        finally:
+            if output is not None:
+                output.close()
+        
+        return {**counts, "summary": self.get_evaluation_summary()}
+    
+    def iter_evaluate_batch(self,
+                            items: Iterable[Dict[str, Any]],
+                            concurrency: Optional[int] = None,
+                            suggest: bool = False) -> Iterator[Dict[str, Any]]:
+        """複数の回答を並列に評価し、完了した順に評価レコードを返す
+        
+        同時に実行する評価の数を concurrency に制限する。レート制限時のリトライは
+        LLMクライアントが API_MAX_RETRIES 回まで行う。
+        各レコードには入力での位置（index）が入る。失敗した評価は error を持つレコードになり、
+        集計には含めない。suggest を指定すると改善提案（improvements）も生成する。
+        """
+        concurrency = max(1, concurrency or settings.evaluation_concurrency)
+        
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = set()
+            for index, item in enumerate(items):
+                pending.add(executor.submit(self._evaluate_item, index, item, suggest))
+                # 投入済みの評価数を制限し、入力が大きくてもメモリ使用量を一定に保つ
+                if len(pending) >= concurrency * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from self._collect(done)
+            
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from self._collect(done)
+    
+    def _collect(self, futures) -> Iterator[Dict[str, Any]]:
+        """完了した評価を累計に加えて返す（累計の更新は呼び出し側のスレッドだけで行う）"""
+        for future in futures:
+            record = future.result()
+            if "error" not in record:
+                self._record(record)
+                metrics.increment("evaluations", mode=record["mode"])
+            yield record
+    
+    def _evaluate_item(self, index: int, item: Dict[str, Any], suggest: bool) -> Dict[str, Any]:
+        """1件を（キャッシュがあればそれを使って）評価"""
+        query = item.get("query", "")
+        mode = item.get("mode", "normal")
+        try:
+            response = item["response"]
+            context = item.get("context") or ""
+            key = evaluation_key(query, response, mode, context)
+            
+            record = self._cached_evaluation(key)
+            cached = record is not None
+            if record is None:
+                record = self._evaluate(query, response, mode, context)
+            
+            if suggest and "improvements" not in record:
+                record = {**record, "improvements": self.suggest_improvements(record)}
+                cached = False
+            
+            if not cached and self._cache_enabled():
+                self.cache.set(self._cache_namespace(), key, record)
+        except Exception as e:
+            print(f"Error evaluating item {index}: {e}")
+            return {"index": index, "query": query, "mode": mode, "error": str(e)}
+        
+        return {**record, "index": index, "cached": cached}
+    
+    def _cached_evaluation(self, key: str) -> Optional[Dict[str, Any]]:
+        """キャッシュ済みの評価を取得"""
+        if not self._cache_enabled():
+            return None
+        return self.cache.get(self._cache_namespace(), key)
+    
+    def _cache_enabled(self) -> bool:
+        return settings.evaluation_cache_enabled and self.cache is not None
+    
+    def _cache_namespace(self) -> str:
+        """評価キャッシュの名前空間（評価プロンプト・モデルが変わると別になる）"""
+        version = prompt_version(
+            EVALUATION_REQUEST_TEMPLATE,
+            EVALUATION_PROMPT,
+            EVALUATION_SYSTEM_PROMPT,
+            settings.model_name
+        )
+        return f"evaluation:{version}"
+    
+    def _evaluate(self, query: str, response: str, mode: str, context: str) -> Dict[str, Any]:
+        """LLMで1件を評価し、評価レコードを作成（履歴・累計には加えない）"""
+        evaluation_prompt = EVALUATION_REQUEST_TEMPLATE.format(
+            query=query,
+            response=response,
+            mode=mode,
+            context=context[:500] if context else "なし",
+            criteria=EVALUATION_PROMPT
         )
         
+        # 評価の実行
+        with metrics.span("evaluator.evaluate", mode=mode):
+            evaluation_result = self.llm_client.generate_with_context(
+                query=evaluation_prompt,
+                context="",
+                system_prompt=EVALUATION_SYSTEM_PROMPT
+            )
+        
         # 評価結果の解析
         scores = self._parse_evaluation(evaluation_result)
         
-        # 評価履歴に追加
-        evaluation_record = {
+        return {
             "query": query,
             "response": response[:200] + "...",
             "mode": mode,
@@ -52,19 +223,22 @@ class ResponseEvaluator:
             "total_score": sum(scores.values()),
             "evaluation": evaluation_result
         }
+    
+    def _record(self, evaluation_record: Dict[str, Any]) -> None:
+        """評価を履歴と累計に追加"""
         self.evaluation_history.append(evaluation_record)
+        self._num_evaluations += 1
+        for key, value in evaluation_record["scores"].items():
+            self._score_totals[key] += value
         
-        return evaluation_record
+        mode = evaluation_record["mode"]
+        if mode in self._mode_counts:
+            self._mode_counts[mode] += 1
+            self._mode_scores[mode] += evaluation_record["total_score"]
     
     def _parse_evaluation(self, evaluation_text: str) -> Dict[str, int]:
         """評価テキストからスコアを抽出"""
-        scores = {
-            "accuracy": 0,
-            "clarity": 0,
-            "relevance": 0,
-            "educational_value": 0,
-            "hint_appropriateness": 0
-        }
+        scores = {key: 0 for key in SCORE_KEYS}
         
         # 簡易的なパース（実際はより洗練された方法を使用）
         lines = evaluation_text.split('\n')
@@ -82,53 +256,32 @@ class ResponseEvaluator:
     
     def get_evaluation_summary(self) -> Dict[str, Any]:
         """評価履歴のサマリーを取得"""
-        if not self.evaluation_history:
+        if not self._num_evaluations:
             return {
                 "total_evaluations": 0,
                 "average_scores": {},
                 "mode_breakdown": {}
             }
         
-        # 平均スコアの計算
-        total_scores = {
-            "accuracy": 0,
-            "clarity": 0,
-            "relevance": 0,
-            "educational_value": 0,
-            "hint_appropriateness": 0
-        }
-        
-        mode_counts = {"normal": 0, "hint": 0}
-        mode_scores = {"normal": 0, "hint": 0}
-        
-        for record in self.evaluation_history:
-            for key, value in record["scores"].items():
-                total_scores[key] += value
-            
-            mode = record["mode"]
-            if mode in mode_counts:
-                mode_counts[mode] += 1
-                mode_scores[mode] += record["total_score"]
-        
         # 平均の計算
-        num_evaluations = len(self.evaluation_history)
+        num_evaluations = self._num_evaluations
         average_scores = {
             key: value / num_evaluations 
-            for key, value in total_scores.items()
+            for key, value in self._score_totals.items()
         }
         
         # モード別平均
         mode_averages = {}
-        for mode in mode_counts:
-            if mode_counts[mode] > 0:
-                mode_averages[mode] = mode_scores[mode] / mode_counts[mode]
+        for mode, count in self._mode_counts.items():
+            if count > 0:
+                mode_averages[mode] = self._mode_scores[mode] / count
         
         return {
             "total_evaluations": num_evaluations,
             "average_scores": average_scores,
             "total_average": sum(average_scores.values()),
             "mode_breakdown": {
-                "counts": mode_counts,
+                "counts": dict(self._mode_counts),
                 "average_scores": mode_averages
             }
         }
@@ -139,7 +292,7 @@ class ResponseEvaluator:
         
         report = {
             "summary": summary,
-            "detailed_evaluations": self.evaluation_history
+            "detailed_evaluations": list(self.evaluation_history)
         }
         
         with open(filepath, 'w', encoding='utf-8') as f:
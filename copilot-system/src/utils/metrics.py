@@ -0,0 +1,274 @@
+"""処理段階ごとの所要時間（スパン）とカウンターの計測
+
+settings.metrics_enabled が False の場合、span・increment は何もしないため
+計測コードを残したままでもオーバーヘッドはほぼない。
+"""
+import contextvars
+import json
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import settings
+
+
+# スパンの所要時間のヒストグラムの境界（秒）
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def enabled() -> bool:
+    """計測が有効かどうか"""
+    return settings.metrics_enabled
+
+
+def _label_key(labels: Dict[str, Any]) -> _LabelKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class _Histogram:
+    """所要時間の分布（件数・合計・境界ごとの件数）"""
+    __slots__ = ("count", "total", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+
+class MetricsRegistry:
+    """カウンターとスパンの所要時間を保持する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, Dict[_LabelKey, float]] = defaultdict(lambda: defaultdict(float))
+        self.durations: Dict[str, Dict[_LabelKey, _Histogram]] = defaultdict(lambda: defaultdict(_Histogram))
+
+    def increment(self, name: str, value: float, labels: Dict[str, Any]) -> None:
+        with self._lock:
+            self.counters[name][_label_key(labels)] += value
+
+    def observe(self, name: str, seconds: float, labels: Dict[str, Any]) -> None:
+        with self._lock:
+            self.durations[name][_label_key(labels)].observe(seconds)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.durations.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """JSONに変換できる形式で現在の値を取得"""
+        with self._lock:
+            return {
+                "counters": {
+                    name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                    for name, series in self.counters.items()
+                },
+                "spans": {
+                    name: [
+                        {
+                            "labels": dict(key),
+                            "count": histogram.count,
+                            "total_seconds": histogram.total,
+                            "mean_seconds": histogram.total / histogram.count if histogram.count else 0.0,
+                        }
+                        for key, histogram in series.items()
+                    ]
+                    for name, series in self.durations.items()
+                },
+            }
+
+    def prometheus_text(self) -> str:
+        """Prometheus のテキスト形式で出力"""
+        lines: List[str] = []
+        with self._lock:
+            for name in sorted(self.counters):
+                metric = f"copilot_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for key, value in self.counters[name].items():
+                    lines.append(f"{metric}{_format_labels(key)} {_format_value(value)}")
+
+            if self.durations:
+                metric = "copilot_span_duration_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                for name in sorted(self.durations):
+                    for key, histogram in self.durations[name].items():
+                        labels = (("span", name),) + key
+                        for bound, count in zip(DURATION_BUCKETS, histogram.buckets):
+                            lines.append(f"{metric}_bucket{_format_labels(labels + (('le', str(bound)),))} {count}")
+                        lines.append(f"{metric}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                        lines.append(f"{metric}_sum{_format_labels(labels)} {histogram.total}")
+                        lines.append(f"{metric}_count{_format_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def _format_labels(key: _LabelKey) -> str:
+    if not key:
+        return ""
+    escaped = [
+        '{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in key
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+
+registry = MetricsRegistry()
+
+# 実行中のスパン（スレッド・非同期タスクごと）
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+_log_lock = threading.Lock()
+
+
+class Span:
+    """1つの処理段階の所要時間を計測するスパン
+
+    終了時にヒストグラムへ記録し、設定に応じてJSONログを1行出力する
+    """
+
+    def __init__(self, name: str, labels: Dict[str, Any]):
+        self.name = name
+        self.labels = labels
+        self.attributes: Dict[str, Any] = {}
+        parent = _current_span.get()
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex[:16]
+        self.parent = parent.name if parent is not None else None
+        self._token = None
+        self._start = 0.0
+
+    def set(self, **attributes: Any) -> None:
+        """トークン数・件数などの属性を追加（JSONログに出力される）"""
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        duration = time.perf_counter() - self._start
+        _current_span.reset(self._token)
+        registry.observe(self.name, duration, self.labels)
+        if exc_type is not None:
+            registry.increment("span_errors", 1, {"span": self.name})
+        if settings.metrics_log_path:
+            _write_log({
+                "ts": time.time(),
+                "trace_id": self.trace_id,
+                "span": self.name,
+                "parent": self.parent,
+                "duration_ms": round(duration * 1000, 3),
+                "error": exc_type.__name__ if exc_type is not None else None,
+                **self.labels,
+                **self.attributes,
+            })
+
+
+class _NoopSpan:
+    """計測が無効な場合のスパン（何もしない）"""
+    __slots__ = ()
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str, **labels: Any):
+    """処理段階の所要時間を計測するコンテキストマネージャー"""
+    if not settings.metrics_enabled:
+        return _NOOP_SPAN
+    return Span(name, labels)
+
+
+def increment(name: str, value: float = 1, **labels: Any) -> None:
+    """カウンターを増やす"""
+    if not settings.metrics_enabled:
+        return
+    registry.increment(name, value, labels)
+
+
+def observe(name: str, seconds: float, **labels: Any) -> None:
+    """コンテキストマネージャーで囲めない処理（ジェネレーターなど）の所要時間を記録"""
+    if not settings.metrics_enabled:
+        return
+    registry.observe(name, seconds, labels)
+    if settings.metrics_log_path:
+        _write_log({"ts": time.time(), "span": name, "duration_ms": round(seconds * 1000, 3), **labels})
+
+
+def _write_log(record: Dict[str, Any]) -> None:
+    """JSONログを1行出力（"-" の場合は標準出力）"""
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    with _log_lock:
+        if settings.metrics_log_path == "-":
+            print(line, file=sys.stdout, flush=True)
+            return
+        with open(settings.metrics_log_path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """/metrics で Prometheus 形式、/metrics.json で JSON を返す"""
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = registry.prometheus_text().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body = json.dumps(registry.snapshot(), ensure_ascii=False).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server: Optional[ThreadingHTTPServer] = None
+_server_lock = threading.Lock()
+
+
+def start_http_server(port: Optional[int] = None) -> Optional[ThreadingHTTPServer]:
+    """メトリクスを公開するHTTPサーバーをバックグラウンドで起動（1プロセスにつき1つ）"""
+    global _server
+    port = port if port is not None else settings.metrics_port
+    if not settings.metrics_enabled or port <= 0:
+        return None
+
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((settings.metrics_host, port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, daemon=True, name="metrics-server").start()
+            print(f"Metrics server listening on port {port}")
+        return _server
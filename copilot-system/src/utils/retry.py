@@ -0,0 +1,62 @@
+"""外部API呼び出しのリトライ処理"""
+import random
+import time
+from typing import Callable, Optional, TypeVar
+
+from .config import settings
+
+
+T = TypeVar("T")
+
+# リトライ対象とする例外のクラス名（openaiパッケージに依存しないよう名前で判定する）
+_RETRYABLE_ERROR_NAMES = {
+    "RateLimitError",
+    "APITimeoutError",
+    "APIConnectionError",
+    "InternalServerError",
+    "ServiceUnavailableError",
+    "Timeout",
+}
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """レート制限や一時的な障害によるエラーか判定"""
+    if type(error).__name__ in _RETRYABLE_ERROR_NAMES:
+        return True
+    
+    status_code = getattr(error, "status_code", None)
+    return status_code == 429 or (isinstance(status_code, int) and status_code >= 500)
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """指数バックオフの待ち時間を計算（ジッター付き）"""
+    delay = min(max_delay, base_delay * (2 ** attempt))
+    return delay * (0.5 + random.random() / 2)
+
+
+def retry_with_backoff(func: Callable[[], T],
+                       max_retries: Optional[int] = None,
+                       base_delay: Optional[float] = None,
+                       max_delay: float = 60.0,
+                       is_retryable: Callable[[Exception], bool] = is_retryable_error) -> T:
+    """一時的なエラーの場合に指数バックオフでリトライする
+    
+    OpenAIのクライアントは API_MAX_RETRIES 回まで自らリトライするため、
+    それらの呼び出しを重ねて包まないこと（試行回数が掛け算になる）
+    """
+    if max_retries is None:
+        max_retries = settings.api_max_retries
+    if base_delay is None:
+        base_delay = settings.api_retry_base_delay
+    
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            print(f"Retrying after {type(e).__name__} ({attempt + 1}/{max_retries}, {delay:.1f}s)")
+            time.sleep(delay)
+            attempt += 1
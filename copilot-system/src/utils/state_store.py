@@ -0,0 +1,178 @@
+"""件数と有効期限に上限のあるセッション状態の保存先"""
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from .config import settings
+
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = "?？!！。.、, "
+
+
+def normalize_key(text: str) -> str:
+    """表記ゆれ（全角半角・大文字小文字・空白・末尾の記号）を吸収したキー"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = _WHITESPACE_PATTERN.sub(" ", text).strip()
+    return text.rstrip(_TRAILING_PUNCTUATION)
+
+
+class BoundedStateStore:
+    """名前空間ごとの状態を保持するLRU・TTL付きのストア
+
+    件数が max_entries を超えると最後に参照された時刻が古いものから追い出す。
+    spill_path を指定した場合、追い出したエントリはSQLiteに退避し、
+    再び参照されたときにメモリへ戻す。
+    """
+
+    def __init__(self,
+                 max_entries: int = 10000,
+                 ttl_seconds: float = 0,
+                 spill_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.spill_path = spill_path
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+        if spill_path:
+            os.makedirs(os.path.dirname(spill_path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(spill_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS state (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    last_access REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )"""
+            )
+            self._conn.commit()
+            self._purge_spilled()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        """値を取得（存在しないか期限切れの場合は default）"""
+        entry_key = (namespace, key)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is None:
+                entry = self._restore(entry_key)
+                if entry is None:
+                    return default
+
+            value, last_access = entry
+            if self._is_expired(last_access, now):
+                self._entries.pop(entry_key, None)
+                return default
+
+            self._entries[entry_key] = (value, now)
+            self._entries.move_to_end(entry_key)
+            return value
+
+    def set(self, namespace: str, key: str, value: Any) -> None:
+        """値を保存"""
+        entry_key = (namespace, key)
+        with self._lock:
+            self._entries[entry_key] = (value, time.time())
+            self._entries.move_to_end(entry_key)
+            self._evict()
+
+    def pop(self, namespace: str, key: str) -> None:
+        """値を削除"""
+        with self._lock:
+            self._entries.pop((namespace, key), None)
+            if self._conn is not None:
+                self._conn.execute(
+                    "DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key)
+                )
+                self._conn.commit()
+
+    def clear(self, namespace: Optional[str] = None) -> None:
+        """名前空間（省略時は全て）の値を削除"""
+        with self._lock:
+            if namespace is None:
+                self._entries.clear()
+            else:
+                for entry_key in [k for k in self._entries if k[0] == namespace]:
+                    del self._entries[entry_key]
+
+            if self._conn is not None:
+                if namespace is None:
+                    self._conn.execute("DELETE FROM state")
+                else:
+                    self._conn.execute("DELETE FROM state WHERE namespace = ?", (namespace,))
+                self._conn.commit()
+
+    def _is_expired(self, last_access: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - last_access > self.ttl_seconds
+
+    def _evict(self) -> None:
+        """上限を超えた古いエントリを追い出す（退避先があればSQLiteへ）"""
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            entry_key, (value, last_access) = self._entries.popitem(last=False)
+            evicted.append((*entry_key, pickle.dumps(value), last_access))
+
+        if evicted and self._conn is not None:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO state (namespace, key, value, last_access) VALUES (?, ?, ?, ?)",
+                evicted
+            )
+            self._conn.commit()
+
+    def _restore(self, entry_key: Tuple[str, str]) -> Optional[Tuple[Any, float]]:
+        """SQLiteに退避したエントリをメモリへ戻す"""
+        if self._conn is None:
+            return None
+
+        row = self._conn.execute(
+            "SELECT value, last_access FROM state WHERE namespace = ? AND key = ?", entry_key
+        ).fetchone()
+        if row is None:
+            return None
+
+        self._conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", entry_key)
+        self._conn.commit()
+        entry = (pickle.loads(row[0]), row[1])
+        self._entries[entry_key] = entry
+        self._evict()
+        return entry
+
+    def _purge_spilled(self) -> None:
+        """期限切れの退避エントリを削除"""
+        if self.ttl_seconds > 0:
+            self._conn.execute(
+                "DELETE FROM state WHERE last_access < ?", (time.time() - self.ttl_seconds,)
+            )
+            self._conn.commit()
+
+
+_shared_store: Optional[BoundedStateStore] = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_state_store() -> BoundedStateStore:
+    """プロセス全体で共有するセッション状態のストアを取得"""
+    global _shared_store
+
+    with _shared_lock:
+        if _shared_store is None:
+            _shared_store = BoundedStateStore(
+                max_entries=settings.state_store_max_entries,
+                ttl_seconds=settings.state_store_ttl_seconds,
+                spill_path=settings.state_store_path if settings.state_store_spill_enabled else None
+            )
+        return _shared_store
@@ -0,0 +1,13 @@
+"""レイテンシなどの集計に使う統計処理"""
+from typing import List
+
+
+def percentile(values: List[float], p: float) -> float:
+    """線形補間によるパーセンタイル"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
@@ -0,0 +1,35 @@
+import json
+import os
+import tempfile
+
+from benchmarks import run
+
+
+class TestBenchmarks:
+    """ベンチマークのテスト"""
+    
+    def test_smoke(self):
+        """小さなシナリオを外部APIなしで最後まで実行できることのテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output = os.path.join(temp_dir, "report.json")
+            report = run.main([
+                "--corpus", "small",
+                "--scenarios", "index_documents", "qa_answer",
+                "--queries", "2",
+                "--concurrency", "1",
+                "--llm-latency", "0",
+                "--llm-token-latency", "0",
+                "--embedding-latency", "0",
+                "--embedding-text-latency", "0",
+                "--output", output
+            ])
+            
+            with open(output, encoding="utf-8") as f:
+                assert json.load(f) == json.loads(json.dumps(report, ensure_ascii=False))
+        
+        results = report["corpora"]["small"]
+        assert results["index_documents"]["chunks"] > 0
+        assert results["qa_answer"]["latency"]["count"] == 2
+        assert results["qa_answer"]["stages"]["retrieval"]["calls"] >= 2
+        assert results["qa_answer"]["peak_rss_mb"] > 0
+        assert "hint_generate" not in results
@@ -2,10 +2,34 @@ import pytest
 import tempfile
 import os
 from pathlib import Path
+from unittest.mock import Mock, patch
+from langchain.embeddings.base import Embeddings
 
 from src.knowledge_base.document_loader import DocumentLoader
 from src.knowledge_base.vector_store import VectorStore
-from src.knowledge_base.retriever import KnowledgeRetriever
+from src.knowledge_base.retriever import KnowledgeRetriever, RetrievalResult
+from src.knowledge_base import registry
+from src.knowledge_base.index_manifest import IndexManifest, chunk_ids
+from src.knowledge_base.embedding_cache import EmbeddingCache, CachedEmbeddings
+from src.knowledge_base import faiss_index
+from src.knowledge_base.embeddings import HashedNgramEmbeddings, create_embeddings
+from src.knowledge_base.lexical_index import LexicalIndex, tokenize, reciprocal_rank_fusion
+from src.knowledge_base.context_builder import build_context, merge_chunks
+
+
+class RecordingEmbeddings(Embeddings):
+    """本文から決まるベクトルを返し、埋め込んだテキストを記録する埋め込み"""
+    
+    def __init__(self, embed):
+        self.embed = embed
+        self.embedded = []
+    
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [self.embed(text) for text in texts]
+    
+    def embed_query(self, text):
+        return self.embed(text)
 
 
 class TestDocumentLoader:
@@ -56,6 +80,21 @@ class TestDocumentLoader:
             
             documents = loader.load_documents(temp_dir)
             assert len(documents) >= 3
+    
+    def test_parallel_loading(self):
+        """並列読み込みの順序とエラー記録のテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for i in range(5):
+                (Path(temp_dir) / f"test_{i}.txt").write_text(f"テストファイル{i}の内容")
+            # UTF-8として読めないファイル
+            (Path(temp_dir) / "broken.txt").write_bytes(b"\xff\xfe\xfa")
+            
+            serial = DocumentLoader(workers=1).load_documents(temp_dir)
+            parallel_loader = DocumentLoader(workers=2)
+            parallel = parallel_loader.load_documents(temp_dir)
+            
+            assert [doc.page_content for doc in parallel] == [doc.page_content for doc in serial]
+            assert list(parallel_loader.errors) == [os.path.join(temp_dir, "broken.txt")]
 
 
 class TestVectorStore:
@@ -64,16 +103,17 @@ class TestVectorStore:
     @pytest.fixture
     def vector_store(self):
         """VectorStoreのフィクスチャ"""
-        # テスト用の一時ディレクトリを使用
+        # テスト用の一時ディレクトリを使用（埋め込みキャッシュも一時ディレクトリに置く）
         with tempfile.TemporaryDirectory() as temp_dir:
             import src.utils.config as config
-            original_path = config.settings.vector_store_path
+            original_paths = (config.settings.vector_store_path, config.settings.embedding_cache_path)
             config.settings.vector_store_path = temp_dir
+            config.settings.embedding_cache_path = os.path.join(temp_dir, "embeddings.sqlite3")
             
             store = VectorStore()
             yield store
             
-            config.settings.vector_store_path = original_path
+            config.settings.vector_store_path, config.settings.embedding_cache_path = original_paths
     
     def test_add_and_search_documents(self, vector_store):
         """文書の追加と検索のテスト"""
@@ -95,6 +135,172 @@ class TestVectorStore:
         assert any("Python" in doc.page_content for doc in results)
 
 
+
+class TestDeferredPersistence:
+    """遅延永続化のテスト"""
+    
+    @pytest.fixture
+    def vector_store(self):
+        """deferred モードのVectorStoreのフィクスチャ（外部APIはモック）"""
+        import src.utils.config as config
+        overrides = {
+            "vector_store_type": "chroma",
+            "persist_mode": "deferred",
+            "persist_chunk_threshold": 3,
+            "persist_interval_seconds": 60,
+            "embedding_cache_enabled": False
+        }
+        originals = {key: getattr(config.settings, key) for key in [*overrides, "vector_store_path"]}
+        
+        with tempfile.TemporaryDirectory() as temp_dir, \
+             patch('src.knowledge_base.embeddings.OpenAIEmbeddings') as embeddings, \
+             patch('src.knowledge_base.vector_store.Chroma'):
+            for key, value in {**overrides, "vector_store_path": temp_dir}.items():
+                setattr(config.settings, key, value)
+            embeddings.return_value.embed_documents.side_effect = (
+                lambda texts: [[0.1, 0.2, 0.3] for _ in texts]
+            )
+            
+            store = VectorStore()
+            yield store
+            
+            store.persist()
+            for key, value in originals.items():
+                setattr(config.settings, key, value)
+    
+    def test_persist_on_threshold(self, vector_store):
+        """閾値に達するまで永続化がまとめられることのテスト"""
+        from langchain.schema import Document
+        
+        saved = []
+        vector_store.add_documents([Document(page_content=f"文書{i}") for i in range(2)])
+        vector_store.after_persist(lambda: saved.append(True))
+        
+        vector_store.vector_store.persist.assert_not_called()
+        assert saved == []
+        
+        vector_store.add_documents([Document(page_content="文書2")])
+        
+        vector_store.vector_store.persist.assert_called_once()
+        assert saved == [True]
+    
+    def test_flush(self, vector_store):
+        """明示的な flush で永続化されることのテスト"""
+        from langchain.schema import Document
+        
+        vector_store.add_documents([Document(page_content="文書")])
+        vector_store.flush()
+        vector_store.flush()
+        
+        vector_store.vector_store.persist.assert_called_once()
+    
+    def test_scores_are_distances_on_both_paths(self, vector_store):
+        """テキスト検索とベクトル検索が同じ距離スコアを返すことのテスト"""
+        from langchain.schema import Document
+        
+        chroma = vector_store.vector_store
+        hits = [(Document(page_content="近い"), 0.1), (Document(page_content="遠い"), 0.8)]
+        chroma.similarity_search_by_vector_with_relevance_scores.return_value = hits
+        vector_store.embeddings.embed_query = lambda text: [0.1, 0.2, 0.3]
+        
+        assert vector_store.search_with_score("質問", k=2) == hits
+        assert vector_store.search_with_score_by_vector([0.1, 0.2, 0.3], k=2) == hits
+        chroma.similarity_search_with_score.assert_not_called()
+
+
+class TestBatchedIndexing:
+    """バッチ埋め込みとチェックポイントのテスト"""
+    
+    @pytest.fixture
+    def indexing(self):
+        """Chroma をメモリ上の辞書で模したVectorStoreのフィクスチャ"""
+        import src.utils.config as config
+        overrides = {
+            "vector_store_type": "chroma",
+            "persist_mode": "immediate",
+            "embedding_batch_size": 2,
+            "embedding_concurrency": 3,
+            "embedding_checkpoint_batches": 2,
+            "embedding_cache_enabled": False
+        }
+        originals = {key: getattr(config.settings, key) for key in [*overrides, "vector_store_path"]}
+        
+        with tempfile.TemporaryDirectory() as temp_dir, \
+             patch('src.knowledge_base.embeddings.OpenAIEmbeddings') as embeddings, \
+             patch('src.knowledge_base.vector_store.Chroma') as chroma_class:
+            for key, value in {**overrides, "vector_store_path": temp_dir}.items():
+                setattr(config.settings, key, value)
+            embedded = []
+            
+            def embed_documents(texts):
+                embedded.extend(texts)
+                return [[float(len(text)), 0.0, 1.0] for text in texts]
+            
+            embeddings.return_value.embed_documents.side_effect = embed_documents
+            
+            store = VectorStore()
+            stored = {}
+            
+            def add_texts(texts, metadatas, ids):
+                # 公開APIの add_texts と同様に embedding_function で埋め込みを得る
+                function = chroma_class.call_args.kwargs["embedding_function"]
+                for doc_id, vector in zip(ids, function.embed_documents(texts)):
+                    stored[doc_id] = vector
+            
+            store.vector_store.add_texts.side_effect = add_texts
+            store.vector_store.get.side_effect = (
+                lambda ids, include: {"ids": [doc_id for doc_id in ids if doc_id in stored]}
+            )
+            yield store, stored, embedded
+            
+            for key, value in originals.items():
+                setattr(config.settings, key, value)
+    
+    def test_batches_are_added_in_order(self, indexing):
+        """並列に埋め込んだバッチが投入順に計算済みベクトルで追加されることのテスト"""
+        from langchain.schema import Document
+        
+        store, stored, embedded = indexing
+        texts = [f"文書{'あ' * i}" for i in range(5)]
+        ids = [f"chunk-{i}" for i in range(5)]
+        store.add_documents([Document(page_content=text) for text in texts], ids=ids)
+        
+        assert list(stored) == ids
+        assert [vector[0] for vector in stored.values()] == [float(len(text)) for text in texts]
+        # 埋め込みは各文書につき1回だけ（add_texts 内で再計算しない）
+        assert sorted(embedded) == sorted(texts)
+        store.vector_store._collection.upsert.assert_not_called()
+    
+    def test_resume_skips_checkpointed_chunks(self, indexing):
+        """中断後の再実行で保存済みのチャンクを埋め込まずに再開できることのテスト"""
+        from langchain.schema import Document
+        
+        store, stored, embedded = indexing
+        documents = [Document(page_content=f"文書{i}") for i in range(6)]
+        ids = [f"chunk-{i}" for i in range(6)]
+        embed_documents = store.embeddings.embed_documents.side_effect
+        
+        def interrupted(texts):
+            if "文書4" in texts:
+                raise ValueError("中断")
+            return embed_documents(texts)
+        
+        store.embeddings.embed_documents.side_effect = interrupted
+        with pytest.raises(ValueError):
+            store.add_documents(documents, ids=ids)
+        
+        # 2バッチごとのチェックポイントで中断前のバッチは永続化済み
+        store.vector_store.persist.assert_called_once()
+        assert list(stored) == ids[:4]
+        
+        store.embeddings.embed_documents.side_effect = embed_documents
+        embedded.clear()
+        store.add_documents(documents, ids=ids)
+        
+        assert embedded == ["文書4", "文書5"]
+        assert list(stored) == ids
+
+
 class TestKnowledgeRetriever:
     """KnowledgeRetrieverのテスト"""
     
@@ -103,13 +309,14 @@ class TestKnowledgeRetriever:
         """KnowledgeRetrieverのフィクスチャ"""
         with tempfile.TemporaryDirectory() as temp_dir:
             import src.utils.config as config
-            original_path = config.settings.vector_store_path
+            original_paths = (config.settings.vector_store_path, config.settings.embedding_cache_path)
             config.settings.vector_store_path = temp_dir
+            config.settings.embedding_cache_path = os.path.join(temp_dir, "embeddings.sqlite3")
             
             retriever = KnowledgeRetriever()
             yield retriever
             
-            config.settings.vector_store_path = original_path
+            config.settings.vector_store_path, config.settings.embedding_cache_path = original_paths
     
     def test_get_context(self, retriever):
         """コンテキスト生成のテスト"""
@@ -125,4 +332,612 @@ class TestKnowledgeRetriever:
         # コンテキストの取得
         context = retriever.get_context("リスト内包表記", k=1)
         assert "リスト内包表記" in context
-        assert "python_tips.txt" in context
\ No newline at end of file
+        assert "python_tips.txt" in context
+
+
+class TestRetrievalResult:
+    """RetrievalResultのテスト"""
+    
+    def test_context_and_sources(self):
+        """コンテキストと参照文書一覧の生成テスト"""
+        from langchain.schema import Document
+        
+        result = RetrievalResult(
+            query="テスト",
+            documents=[
+                Document(page_content=f"内容{i}", metadata={"source": f"file{i}.txt"})
+                for i in range(5)
+            ]
+        )
+        
+        assert "[文書1 - file0.txt]" in result.context
+        assert "[文書5 - file4.txt]" in result.context
+        assert len(result.sources(k=3)) == 3
+        assert result.sources(k=3)[0]["metadata"]["source"] == "file0.txt"
+        assert result.to_dict()["sources"][4] == {"source": "file4.txt", "chunk_id": None, "score": None}
+    
+    def test_empty_result(self):
+        """空の検索結果のテスト"""
+        result = RetrievalResult(query="テスト")
+        assert not result
+        assert result.context == ""
+        assert result.sources() == []
+
+
+class TestContextBuilder:
+    """トークン数の上限付きコンテキスト生成のテスト"""
+    
+    def test_merge_adjacent_chunks(self):
+        """同じ文書の重複するチャンクが結合されることのテスト"""
+        from langchain.schema import Document
+        
+        text = "".join(chr(ord("ぁ") + i) for i in range(50))
+        documents = [
+            Document(page_content=text[20:40], metadata={"source": "a.txt", "start_index": 20}),
+            Document(page_content="別の文書", metadata={"source": "b.txt", "start_index": 0}),
+            Document(page_content=text[0:25], metadata={"source": "a.txt", "start_index": 0}),
+            Document(page_content=text[35:50], metadata={"source": "a.txt", "start_index": 35})
+        ]
+        
+        pieces = merge_chunks(documents)
+        
+        assert [piece.source for piece in pieces] == ["a.txt", "b.txt"]
+        assert pieces[0].text == text
+    
+    def test_merge_by_text_overlap(self):
+        """位置情報がない場合に重なった文字列で結合されることのテスト"""
+        from langchain.schema import Document
+        
+        head = "Pythonのリスト内包表記は、for文によるループを簡潔に書くための構文です。"
+        tail = "for文によるループを簡潔に書くための構文です。条件式も追加できます。"
+        pieces = merge_chunks([
+            Document(page_content=head, metadata={"source": "a.txt"}),
+            Document(page_content=tail, metadata={"source": "a.txt"})
+        ])
+        
+        assert len(pieces) == 1
+        assert pieces[0].text == head + "条件式も追加できます。"
+    
+    def test_token_budget(self):
+        """上限に収まる断片だけが順位順に含まれることのテスト"""
+        from langchain.schema import Document
+        
+        documents = [
+            Document(page_content="あ" * 50, metadata={"source": "first.txt"}),
+            Document(page_content="い" * 500, metadata={"source": "large.txt"}),
+            Document(page_content="う" * 50, metadata={"source": "small.txt"})
+        ]
+        
+        context = build_context(documents, max_tokens=200, count_tokens=len)
+        
+        assert len(context) <= 200 + 2
+        assert "[文書1 - first.txt]" in context
+        assert "[文書2 - small.txt]" in context
+        assert "large.txt" not in context
+        
+        truncated = build_context(documents[1:2], max_tokens=100, count_tokens=len)
+        assert 0 < len(truncated) <= 100
+
+
+class TestRegistry:
+    """共有レジストリのテスト"""
+    
+    @pytest.fixture(autouse=True)
+    def reset(self):
+        """テストごとにレジストリをクリア"""
+        registry.reset_registry()
+        yield
+        registry.reset_registry()
+    
+    def test_shared_instances(self):
+        """同じ設定では同じインスタンスが返されることのテスト"""
+        with patch('src.knowledge_base.registry.VectorStore') as mock_store:
+            store1 = registry.get_shared_vector_store()
+            store2 = registry.get_shared_vector_store()
+            retriever1 = registry.get_shared_retriever()
+            retriever2 = registry.get_shared_retriever()
+        
+        assert store1 is store2
+        assert retriever1 is retriever2
+        assert retriever1.vector_store is store1
+        assert mock_store.call_count == 1
+    
+    def test_separate_instances_per_path(self):
+        """保存先が異なる場合は別のインスタンスになることのテスト"""
+        import src.utils.config as config
+        original_path = config.settings.vector_store_path
+        
+        # 呼び出しごとに別のモックを返し、インスタンスの違いを確認できるようにする
+        with patch('src.knowledge_base.registry.VectorStore', side_effect=lambda: Mock()) as mock_store, \
+             tempfile.TemporaryDirectory() as temp_dir:
+            store1 = registry.get_shared_vector_store()
+            config.settings.vector_store_path = temp_dir
+            try:
+                store2 = registry.get_shared_vector_store()
+            finally:
+                config.settings.vector_store_path = original_path
+        
+        assert store1 is not store2
+        assert mock_store.call_count == 2
+
+
+class TestIncrementalIndexing:
+    """差分インデックス化のテスト"""
+    
+    @pytest.fixture
+    def retriever(self):
+        """モックのVectorStoreを使うKnowledgeRetrieverのフィクスチャ"""
+        with tempfile.TemporaryDirectory() as store_dir:
+            import src.utils.config as config
+            original_path = config.settings.vector_store_path
+            config.settings.vector_store_path = store_dir
+            
+            vector_store = Mock()
+            vector_store.after_persist.side_effect = lambda callback: callback()
+            retriever = KnowledgeRetriever(vector_store=vector_store)
+            yield retriever
+            
+            config.settings.vector_store_path = original_path
+    
+    def test_unchanged_files_are_skipped(self, retriever):
+        """変更のないファイルが再埋め込みされないことのテスト"""
+        with tempfile.TemporaryDirectory() as data_dir:
+            for i in range(3):
+                (Path(data_dir) / f"test_{i}.txt").write_text(f"テストファイル{i}の内容")
+            
+            assert retriever.index_documents(data_dir) == 3
+            assert retriever.index_documents(data_dir) == 0
+    
+    def test_changed_and_removed_files(self, retriever):
+        """変更・削除されたファイルのチャンクが入れ替わることのテスト"""
+        with tempfile.TemporaryDirectory() as data_dir:
+            changed = Path(data_dir) / "changed.txt"
+            removed = Path(data_dir) / "removed.txt"
+            changed.write_text("変更前の内容")
+            removed.write_text("削除される内容")
+            retriever.index_documents(data_dir)
+            
+            manifest = IndexManifest(retriever.manifest_path())
+            old_ids = manifest.get(str(changed.resolve()))["chunk_ids"]
+            removed_ids = manifest.get(str(removed.resolve()))["chunk_ids"]
+            
+            changed.write_text("変更後の内容です")
+            removed.unlink()
+            retriever.vector_store.delete.reset_mock()
+            
+            assert retriever.index_documents(data_dir) == 1
+            deleted = [
+                doc_id
+                for call in retriever.vector_store.delete.call_args_list
+                for doc_id in call.args[0]
+            ]
+            assert set(old_ids) <= set(deleted)
+            assert set(removed_ids) <= set(deleted)
+            assert IndexManifest(retriever.manifest_path()).get(str(removed.resolve())) is None
+    
+    def test_store_without_manifest_is_rebuilt(self, retriever):
+        """マニフェストのない既存のストアが一度だけ作り直されることのテスト"""
+        retriever.vector_store.is_empty.return_value = False
+        with tempfile.TemporaryDirectory() as data_dir:
+            (Path(data_dir) / "test.txt").write_text("テストファイルの内容")
+            
+            assert retriever.index_documents(data_dir) == 1
+            retriever.vector_store.delete_all.assert_called_once()
+            
+            (Path(data_dir) / "new.txt").write_text("追加したファイルの内容")
+            assert retriever.index_documents(data_dir) == 1
+            retriever.vector_store.delete_all.assert_called_once()
+    
+    def test_indexing_in_windows(self, retriever):
+        """チャンクが一定数ごとにまとめて書き込まれることのテスト"""
+        import src.utils.config as config
+        original_size = config.settings.index_window_size
+        config.settings.index_window_size = 2
+        
+        try:
+            with tempfile.TemporaryDirectory() as data_dir:
+                for i in range(5):
+                    (Path(data_dir) / f"test_{i}.txt").write_text(f"テストファイル{i}の内容")
+                
+                assert retriever.index_documents(data_dir) == 5
+        finally:
+            config.settings.index_window_size = original_size
+        
+        sizes = [len(call.args[0]) for call in retriever.vector_store.add_documents.call_args_list]
+        assert sizes == [2, 2, 1]
+    
+    def test_chunk_ids_are_deterministic(self):
+        """チャンクIDが内容から決定的に生成されることのテスト"""
+        ids1 = chunk_ids("a.txt", ["同じ内容", "同じ内容", "別の内容"])
+        ids2 = chunk_ids("a.txt", ["同じ内容", "同じ内容", "別の内容"])
+        
+        assert ids1 == ids2
+        assert len(set(ids1)) == 3
+        assert chunk_ids("b.txt", ["同じ内容"])[0] != ids1[0]
+
+
+class TestEmbeddingCache:
+    """埋め込みキャッシュのテスト"""
+    
+    @pytest.fixture
+    def cache(self):
+        """一時ディレクトリのEmbeddingCacheのフィクスチャ"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            yield EmbeddingCache(os.path.join(temp_dir, "embeddings.sqlite3"), max_entries=10)
+    
+    def test_cached_embeddings_skip_api(self, cache):
+        """キャッシュ済みのテキストで埋め込みAPIが呼ばれないことのテスト"""
+        base = Mock()
+        base.embed_documents = Mock(side_effect=lambda texts: [[float(len(t)), 0.5] for t in texts])
+        base.embed_query = Mock(return_value=[3.0, 0.5])
+        embeddings = CachedEmbeddings(base, cache, model="test-model")
+        
+        first = embeddings.embed_documents(["abc", "de", "abc"])
+        second = embeddings.embed_documents(["abc", "de"])
+        query = embeddings.embed_query("abc")
+        
+        assert first == [[3.0, 0.5], [2.0, 0.5], [3.0, 0.5]]
+        assert second == [[3.0, 0.5], [2.0, 0.5]]
+        assert query == [3.0, 0.5]
+        base.embed_documents.assert_called_once_with(["abc", "de"])
+        base.embed_query.assert_not_called()
+    
+    def test_models_are_separated(self, cache):
+        """モデルごとにキャッシュが分かれることのテスト"""
+        cache.put_many("model-a", ["text"], [[1.0]])
+        
+        assert cache.get_many("model-a", ["text"]) == [[1.0]]
+        assert cache.get_many("model-b", ["text"]) == [None]
+    
+    def test_size_bound(self, cache):
+        """上限を超えた場合に古いエントリが削除されることのテスト"""
+        for i in range(15):
+            cache.put_many("model", [f"text{i}"], [[float(i)]])
+        
+        assert len(cache) <= 10
+        assert cache.get_many("model", ["text14"]) == [[14.0]]
+
+
+class TestFaissIndex:
+    """FAISSインデックスの種類選択のテスト"""
+    
+    def test_factory_string(self):
+        """件数と種類に応じた index_factory 文字列のテスト"""
+        import src.utils.config as config
+        original_nlist = config.settings.faiss_nlist
+        config.settings.faiss_nlist = 100
+        
+        try:
+            assert faiss_index.factory_string("flat", 1536, 100000) is None
+            assert faiss_index.factory_string("hnsw", 1536, 10) == f"HNSW{config.settings.faiss_hnsw_m}"
+            # 学習に十分な件数がない場合はフラットのまま
+            assert faiss_index.factory_string("ivf", 1536, 20) is None
+            assert faiss_index.factory_string("ivf", 1536, 390) == "IVF10,Flat"
+            assert faiss_index.factory_string("ivf", 1536, 100000) == "IVF100,Flat"
+            assert faiss_index.factory_string("pq", 1536, 100000) == f"IVF100,PQ{config.settings.faiss_pq_m}np"
+        finally:
+            config.settings.faiss_nlist = original_nlist
+    
+    def test_build_and_reconstruct(self):
+        """学習済みインデックスの構築とベクトルの取り出しのテスト"""
+        import numpy as np
+        
+        vectors = np.random.RandomState(0).rand(500, 8).astype(np.float32)
+        index = faiss_index.build_index(vectors, "ivf")
+        
+        assert faiss_index.index_matches(index, "ivf")
+        assert index.ntotal == 500
+        assert np.allclose(faiss_index.reconstruct_vectors(index), vectors, atol=1e-5)
+    
+    def test_needs_training(self):
+        """件数の増加に応じて再学習が必要と判定されることのテスト"""
+        import numpy as np
+        import src.utils.config as config
+        originals = (config.settings.faiss_nlist, config.settings.faiss_retrain_factor)
+        config.settings.faiss_nlist, config.settings.faiss_retrain_factor = 100, 4
+        
+        try:
+            rng = np.random.RandomState(0)
+            flat = faiss_index.build_index(rng.rand(100, 8).astype(np.float32), "flat")
+            assert faiss_index.needs_training(flat, "ivf")
+            assert not faiss_index.needs_training(flat, "flat")
+            
+            # 80件で学習すると nlist=2
+            index = faiss_index.build_index(rng.rand(80, 8).astype(np.float32), "ivf")
+            assert not faiss_index.needs_training(index, "ivf")
+            index.add(rng.rand(160, 8).astype(np.float32))
+            assert not faiss_index.needs_training(index, "ivf")
+            # 件数に見合う nlist が 4 倍（8）に達したら再学習する
+            index.add(rng.rand(80, 8).astype(np.float32))
+            assert faiss_index.needs_training(index, "ivf")
+        finally:
+            config.settings.faiss_nlist, config.settings.faiss_retrain_factor = originals
+
+
+class TestFaissTraining:
+    """IVF/PQ インデックスの学習と再構築のテスト"""
+    
+    @pytest.fixture
+    def faiss_store(self):
+        """ivf モードのVectorStoreのフィクスチャ（埋め込みは本文から決まる乱数）"""
+        import zlib
+        import numpy as np
+        import src.utils.config as config
+        overrides = {
+            "vector_store_type": "faiss",
+            "faiss_index_type": "ivf",
+            "faiss_nlist": 100,
+            "faiss_retrain_factor": 4,
+            "faiss_pq_m": 2,
+            "embedding_dimension": 8,
+            "embedding_cache_enabled": False
+        }
+        originals = {key: getattr(config.settings, key) for key in [*overrides, "vector_store_path"]}
+        
+        embeddings = RecordingEmbeddings(
+            lambda text: np.random.RandomState(zlib.crc32(text.encode())).rand(8).tolist()
+        )
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for key, value in {**overrides, "vector_store_path": temp_dir}.items():
+                setattr(config.settings, key, value)
+            
+            store = VectorStore(embeddings=embeddings)
+            yield store, embeddings
+            
+            for key, value in originals.items():
+                setattr(config.settings, key, value)
+    
+    @staticmethod
+    def _documents(start, stop):
+        from langchain.schema import Document
+        return [Document(page_content=f"文書{i}") for i in range(start, stop)], \
+            [f"chunk-{i}" for i in range(start, stop)]
+    
+    def test_retrain_on_add(self, faiss_store):
+        """件数の増加に合わせて nlist を増やして再学習されることのテスト"""
+        import faiss
+        
+        store, _ = faiss_store
+        store.add_documents(*self._documents(0, 80))
+        assert faiss.extract_index_ivf(store.vector_store.index).nlist == 2
+        
+        store.add_documents(*self._documents(80, 320))
+        
+        index = store.vector_store.index
+        assert faiss.extract_index_ivf(index).nlist == 8
+        assert index.ntotal == 320
+        assert store.search("文書100", k=1)[0].page_content == "文書100"
+    
+    def test_pq_rebuild_uses_original_embeddings(self, faiss_store):
+        """PQ の再構築で近似値ではなく保存しておいた元のベクトルを使うことのテスト"""
+        import numpy as np
+        import src.utils.config as config
+        
+        store, embeddings = faiss_store
+        config.settings.faiss_index_type = "pq"
+        documents, ids = self._documents(0, 300)
+        store.add_documents(documents, ids=ids)
+        assert faiss_index.is_lossy(store.vector_store.index)
+        
+        embeddings.embedded.clear()
+        store.rebuild_faiss_index(exclude_ids=set(ids[:10]))
+        
+        # 埋め込みAPIは呼ばれず、量子化前のベクトルがそのまま使われる
+        assert embeddings.embedded == []
+        assert np.allclose(
+            store._original_vectors([(0, "chunk-20")])[0], embeddings.embed("文書20"), atol=1e-6
+        )
+        assert store.vector_store.index.ntotal == 290
+        assert store.existing_ids(ids[:10]) == set()
+        assert store.existing_ids(ids[10:]) == set(ids[10:])
+
+
+class TestEmptyFaissStore:
+    """ダミー文書を使わない空のFAISSストアのテスト"""
+    
+    @pytest.fixture
+    def faiss_store(self):
+        """faiss モードのVectorStoreのフィクスチャ（埋め込みは本文の長さから決まる）"""
+        import src.utils.config as config
+        overrides = {
+            "vector_store_type": "faiss",
+            "faiss_index_type": "flat",
+            "embedding_dimension": 3,
+            "embedding_cache_enabled": False
+        }
+        originals = {key: getattr(config.settings, key) for key in [*overrides, "vector_store_path"]}
+        embeddings = RecordingEmbeddings(lambda text: [float(len(text)), 1.0, 0.0])
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for key, value in {**overrides, "vector_store_path": temp_dir}.items():
+                setattr(config.settings, key, value)
+            
+            store = VectorStore(embeddings=embeddings)
+            yield store, embeddings
+            
+            for key, value in originals.items():
+                setattr(config.settings, key, value)
+    
+    def test_no_embedding_call_on_init(self, faiss_store):
+        """初期化時に埋め込みAPIが呼ばれず、検索結果が空であることのテスト"""
+        store, embeddings = faiss_store
+        
+        assert embeddings.embedded == []
+        assert store.search("init", k=5) == []
+    
+    def test_only_real_documents_are_returned(self, faiss_store):
+        """追加した文書だけが検索結果に含まれることのテスト"""
+        from langchain.schema import Document
+        
+        store, _ = faiss_store
+        store.add_documents([Document(page_content="Python"), Document(page_content="JavaScript")])
+        
+        results = store.search("Python", k=5)
+        assert [doc.page_content for doc in results] == ["Python", "JavaScript"]
+        
+        store.delete_all()
+        assert store.search("Python", k=5) == []
+
+
+class TestHybridRetrieval:
+    """語彙検索とハイブリッド検索のテスト"""
+    
+    @pytest.fixture
+    def documents(self):
+        """テスト用の文書"""
+        from langchain.schema import Document
+        return [
+            Document(page_content="ZeroDivisionError は0で割ったときに発生します", metadata={"source": "a.txt"}),
+            Document(page_content="リスト内包表記でループを簡潔に書けます", metadata={"source": "b.txt"}),
+            Document(page_content="KeyError は辞書に存在しないキーを参照したときに発生します", metadata={"source": "c.txt"})
+        ]
+    
+    def test_tokenize(self):
+        """識別子と日本語のトークン分割のテスト"""
+        tokens = tokenize("ZeroDivisionError が read_csv で発生")
+        
+        assert "zerodivisionerror" in tokens
+        assert "division" in tokens
+        assert "read_csv" in tokens and "csv" in tokens
+        assert "発生" in tokens
+    
+    def test_bm25_ranking(self, documents):
+        """完全一致する識別子を含む文書が上位になることのテスト"""
+        index = LexicalIndex()
+        index.add(["a", "b", "c"], documents)
+        
+        results = index.search("ZeroDivisionError", k=3)
+        assert results[0][0].metadata["source"] == "a.txt"
+        assert results[0][1] > results[1][1] * 2
+        
+        index.remove(["a"])
+        assert "a.txt" not in [doc.metadata["source"] for doc, _ in index.search("ZeroDivisionError", k=3)]
+        assert len(index) == 2
+    
+    def test_save_and_load(self, documents):
+        """インデックスの保存と読み込みのテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "lexical.pkl")
+            index = LexicalIndex()
+            index.add(["a", "b", "c"], documents)
+            index.save(path)
+            
+            loaded = LexicalIndex.load(path)
+            assert [doc.metadata["source"] for doc, _ in loaded.search("KeyError", k=1)] == ["c.txt"]
+            assert LexicalIndex.load(os.path.join(temp_dir, "missing.pkl")) is None
+    
+    def test_incremental_save(self, documents):
+        """2回目以降の保存では変更だけをログに追記し、読み込み時に適用されることのテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "lexical.pkl")
+            index = LexicalIndex()
+            index.add(["a", "b"], documents[:2])
+            index.save(path)
+            snapshot_mtime = os.stat(path).st_mtime_ns
+            
+            index.remove(["a"])
+            index.save(path)
+            
+            # 本体は書き直されず、変更ログだけが追記される
+            assert os.stat(path).st_mtime_ns == snapshot_mtime
+            assert os.path.exists(f"{path}.log")
+            assert set(LexicalIndex.load(path).documents) == {"b"}
+            
+            # ログが本体より大きくなると全体を書き直してログを消す
+            index.add(["a", "b", "c"], documents)
+            index.save(path)
+            assert not os.path.exists(f"{path}.log")
+            assert set(LexicalIndex.load(path).documents) == {"a", "b", "c"}
+            
+            index.clear()
+            index.save(path)
+            assert len(LexicalIndex.load(path)) == 0
+    
+    def test_reciprocal_rank_fusion(self, documents):
+        """両方のランキングで上位の文書が先頭になることのテスト"""
+        a, b, c = documents
+        fused = reciprocal_rank_fusion([[b, a, c], [a, c]])
+        
+        assert [doc.metadata["source"] for doc, _ in fused] == ["a.txt", "c.txt", "b.txt"]
+    
+    def test_decisive_lexical_match_skips_embedding(self, documents):
+        """語彙検索で決定的に一致した場合に埋め込みを省略することのテスト"""
+        vector_store = Mock()
+        vector_store.lexical_search.return_value = [(documents[0], 8.0), (documents[2], 1.0)]
+        retriever = KnowledgeRetriever(vector_store=vector_store)
+        
+        result = retriever.retrieve_result("ZeroDivisionError", k=2, mode="hybrid")
+        
+        assert result.mode == "lexical"
+        assert result.documents[0].metadata["source"] == "a.txt"
+        vector_store.search_with_score.assert_not_called()
+        vector_store.embed_query.assert_not_called()
+        
+        # キャッシュ参照のために埋め込み済みでも同じ結果になる
+        with_embedding = retriever.retrieve_result("ZeroDivisionError", k=2, embedding=[0.1], mode="hybrid")
+        assert with_embedding.mode == "lexical"
+        vector_store.search_with_score_by_vector.assert_not_called()
+        assert retriever.lexical_result("ZeroDivisionError", k=2, mode="hybrid").mode == "lexical"
+    
+    def test_ambiguous_match_is_fused(self, documents):
+        """決定的でない場合はベクトル検索と統合されることのテスト"""
+        vector_store = Mock()
+        vector_store.lexical_search.return_value = [(documents[0], 3.0), (documents[2], 2.5)]
+        vector_store.search_with_score.return_value = [(documents[2], 0.1), (documents[1], 0.2)]
+        retriever = KnowledgeRetriever(vector_store=vector_store)
+        
+        result = retriever.retrieve_result("エラーが発生します", k=2, mode="hybrid")
+        
+        assert result.mode == "hybrid"
+        assert result.documents[0].metadata["source"] == "c.txt"
+        assert len(result.documents) == 2
+
+
+class TestLocalEmbeddings:
+    """ローカル埋め込みのテスト"""
+    
+    def test_vectors(self):
+        """次元・正規化・類似度のテスト"""
+        import numpy as np
+        
+        embeddings = HashedNgramEmbeddings(dimension=256)
+        vectors = np.array(embeddings.embed_documents([
+            "リスト内包表記の書き方",
+            "リスト内包表記の使い方",
+            "ZeroDivisionError の原因"
+        ]))
+        
+        assert vectors.shape == (3, 256)
+        assert np.allclose(np.linalg.norm(vectors, axis=1), 1.0)
+        assert vectors[0] @ vectors[1] > vectors[0] @ vectors[2]
+        assert np.allclose(embeddings.embed_query("リスト内包表記の書き方"), vectors[0])
+    
+    def test_local_faiss_store(self):
+        """外部APIなしでインデックス化と検索ができることのテスト"""
+        import src.utils.config as config
+        from langchain.schema import Document
+        
+        overrides = {
+            "embedding_provider": "local",
+            "local_embedding_dimension": 256,
+            "vector_store_type": "faiss"
+        }
+        originals = {key: getattr(config.settings, key) for key in [*overrides, "vector_store_path"]}
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for key, value in {**overrides, "vector_store_path": temp_dir}.items():
+                setattr(config.settings, key, value)
+            try:
+                assert isinstance(create_embeddings(), HashedNgramEmbeddings)
+                
+                store = VectorStore()
+                store.add_documents([
+                    Document(page_content="Pythonのリスト内包表記", metadata={"source": "a.txt"}),
+                    Document(page_content="JavaScriptの非同期処理", metadata={"source": "b.txt"})
+                ])
+                
+                assert store.search("リスト内包表記", k=1)[0].metadata["source"] == "a.txt"
+            finally:
+                for key, value in originals.items():
+                    setattr(config.settings, key, value)
@@ -0,0 +1,51 @@
+import pytest
+from unittest.mock import patch
+
+from src.llm import tokenizer
+
+
+class TestTokenizer:
+    """キャッシュ付きトークン数カウントのテスト"""
+    
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        """テストごとにキャッシュをクリア"""
+        tokenizer.clear_cache()
+        yield
+        tokenizer.clear_cache()
+    
+    def test_count_tokens_many(self):
+        """まとめて数えた結果が個別に数えた結果と一致することのテスト"""
+        texts = ["Pythonのリスト内包表記", "hello world", "Pythonのリスト内包表記", ""]
+        
+        counts = tokenizer.count_tokens_many(texts)
+        
+        assert counts == [tokenizer.count_tokens(text) for text in texts]
+        assert counts[0] == counts[2]
+        assert counts[3] == 0
+        assert len(tokenizer._cache) == 3
+    
+    def test_special_tokens_are_counted_as_text(self):
+        """特殊トークンの文字列を含むテキストでもエラーにならないことのテスト"""
+        assert tokenizer.count_tokens("<|endoftext|>") > 0
+    
+    def test_approximate_count_without_encoding(self):
+        """エンコーダーを取得できない場合は文字数から概算することのテスト"""
+        tokenizer.get_encoding.cache_clear()
+        try:
+            with patch('src.llm.tokenizer.tiktoken.encoding_for_model', side_effect=OSError("offline")):
+                counts = tokenizer.count_tokens_many(["hello world!", "リスト内包表記"], model="offline-model")
+        finally:
+            tokenizer.get_encoding.cache_clear()
+        
+        assert counts == [3, 7]
+    
+    def test_cache_is_bounded(self):
+        """キャッシュの件数が上限を超えないことのテスト"""
+        cache = tokenizer.TokenCountCache(max_entries=2)
+        for i in range(3):
+            cache.put(("model", str(i)), i)
+        
+        assert len(cache) == 2
+        assert cache.get(("model", "0")) is None
+        assert cache.get(("model", "2")) == 2
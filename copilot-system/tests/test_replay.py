@@ -0,0 +1,103 @@
+import json
+import os
+import tempfile
+import pytest
+from unittest.mock import Mock, patch
+from langchain.schema import Document
+
+from src import replay
+from src.knowledge_base.retriever import RetrievalResult
+from src.utils import config
+
+
+class TestReplay:
+    """データセット再生のテスト"""
+    
+    def test_load_dataset(self):
+        """JSONL の読み込みと不正な行の検出のテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "questions.jsonl")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"query": "IndexErrorとは", "mode": "hint"}, ensure_ascii=False) + "\n\n")
+                f.write(json.dumps({"query": "for文の書き方"}, ensure_ascii=False) + "\n")
+            assert [item["query"] for item in replay.load_dataset(path)] == ["IndexErrorとは", "for文の書き方"]
+            
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"query": "質問", "mode": "unknown"}, ensure_ascii=False) + "\n")
+            with pytest.raises(ValueError):
+                replay.load_dataset(path)
+    
+    def test_apply_overrides(self):
+        """設定の型に合わせて上書きされることのテスト"""
+        original = (config.settings.retrieval_k, config.settings.history_summary_enabled)
+        try:
+            overrides = replay.apply_overrides(["retrieval_k=3", "history_summary_enabled=false"])
+            assert overrides == {"retrieval_k": 3, "history_summary_enabled": False}
+            assert config.settings.retrieval_k == 3
+            
+            with pytest.raises(ValueError):
+                replay.apply_overrides(["unknown_setting=1"])
+        finally:
+            config.settings.retrieval_k, config.settings.history_summary_enabled = original
+    
+    def test_index_overrides_require_rebuild(self):
+        """インデックスに関わる設定は --index なしでは上書きできないことのテスト"""
+        with pytest.raises(ValueError):
+            replay.check_index_overrides(["retrieval_k=3", "chunk_size=500"], None)
+        with pytest.raises(ValueError):
+            replay.check_index_overrides(["embedding_model=text-embedding-3-large"], None)
+        
+        replay.check_index_overrides(["retrieval_k=3"], None)
+        replay.check_index_overrides(["chunk_size=500"], "data/exercises")
+    
+    def test_replay_one_and_summarize(self):
+        """再生した行に回答・参照文書・トークン数が入り、対象ごとに集計されることのテスト"""
+        usage = iter([{}, {"llm_calls": 1, "tokens_in": 120, "tokens_out": 30}])
+        session = Mock()
+        session.llm_client.take_usage.side_effect = lambda: next(usage)
+        retrieval = RetrievalResult(
+            query="質問",
+            documents=[Document(page_content="内容", metadata={"source": "ex1.md", "chunk_id": "c1"})],
+            scores=[0.9]
+        )
+        engine = Mock()
+        engine.answer.return_value = {
+            "response": "回答", "context": "内容", "retrieval": retrieval.to_dict(), "cached": False
+        }
+        session.qa_engines = {"normal": engine}
+        
+        row, context = replay.replay_one(session, 0, {"query": "質問"}, "normal")
+        
+        assert row["response"] == "回答" and context == "内容"
+        assert row["sources"] == [{"source": "ex1.md", "chunk_id": "c1", "score": 0.9}]
+        assert row["tokens_in"] == 120 and row["llm_calls"] == 1
+        
+        summary = replay.summarize([row], wall_seconds=1.0, workers=1)
+        assert summary["targets"]["normal"]["count"] == 1
+        assert summary["targets"]["normal"]["tokens_out"] == 30
+        assert summary["settings"]["retrieval_k"] == config.settings.retrieval_k
+    
+    def test_rows_are_independent(self):
+        """同じ質問の行でもヒントレベルと一括生成したヒントを持ち越さないことのテスト"""
+        batch = json.dumps({"hints": {"1": "ヒント1", "2": "ヒント2", "3": "ヒント3"}, "keywords": []})
+        retriever = Mock()
+        retriever.lexical_result.return_value = None
+        retriever.retrieve_result.return_value = RetrievalResult(query="質問")
+        overrides = {"answer_cache_enabled": False, "hint_generation_mode": "batch"}
+        originals = {key: getattr(config.settings, key) for key in overrides}
+        
+        for key, value in overrides.items():
+            setattr(config.settings, key, value)
+        try:
+            with patch('src.llm.client.ChatOpenAI') as chat:
+                chat.return_value.return_value = Mock(content=batch)
+                rows, _, _ = replay.replay(
+                    [{"query": "質問", "mode": "hint_generator"}] * 2, retriever, replay.TARGETS, workers=1
+                )
+        finally:
+            for key, value in originals.items():
+                setattr(config.settings, key, value)
+        
+        assert [row["level"] for row in rows] == [1, 1]
+        assert [row["cached"] for row in rows] == [False, False]
+        assert [row["llm_calls"] for row in rows] == [1, 1]
@@ -1,8 +1,13 @@
+import json
 import pytest
-from unittest.mock import Mock, patch
+from unittest.mock import Mock, AsyncMock, patch
+from langchain.schema import Document
 
 from src.response_engine.qa_engine import QAEngine, ResponseMode
-from src.response_engine.hint_generator import HintGenerator, HintLevel
+from src.response_engine.hint_generator import HintGenerator, HintLevel, parse_hint_batch
+from src.response_engine.answer_cache import SemanticAnswerCache
+from src.response_engine.memory import ConversationMemory
+from src.knowledge_base.retriever import RetrievalResult
 
 
 class TestQAEngine:
@@ -12,8 +17,10 @@ class TestQAEngine:
     def qa_engine(self):
         """QAEngineのフィクスチャ"""
         with patch('src.response_engine.qa_engine.KnowledgeRetriever'), \
-             patch('src.response_engine.qa_engine.LLMClient'):
+             patch('src.response_engine.qa_engine.LLMClient'), \
+             patch('src.response_engine.qa_engine.get_shared_answer_cache', return_value=None):
             engine = QAEngine()
+            engine.llm_client.count_tokens.side_effect = len
             yield engine
     
     def test_set_mode(self, qa_engine):
@@ -31,8 +38,10 @@ class TestQAEngine:
         qa_engine.set_mode(ResponseMode.NORMAL)
         
         # モックの設定
-        qa_engine.retriever.get_context = Mock(return_value="テストコンテキスト")
-        qa_engine.retriever.retrieve = Mock(return_value=[])
+        qa_engine.retriever.retrieve_result = Mock(return_value=RetrievalResult(
+            query="テスト質問",
+            documents=[Document(page_content="テストコンテキスト", metadata={"source": "test.txt"})]
+        ))
         qa_engine.llm_client.generate_with_context = Mock(return_value="テスト回答")
         
         # 回答の生成
@@ -42,11 +51,33 @@ class TestQAEngine:
         assert result["mode"] == "normal"
         assert result["context_used"] == True
     
+    def test_answer_retrieves_once(self, qa_engine):
+        """検索が1リクエストにつき1回だけ行われることのテスト"""
+        documents = [
+            Document(page_content=f"文書{i}の内容", metadata={"source": f"doc{i}.txt"})
+            for i in range(5)
+        ]
+        qa_engine.retriever.retrieve_result = Mock(return_value=RetrievalResult(
+            query="テスト質問", documents=documents
+        ))
+        qa_engine.llm_client.generate_with_context = Mock(return_value="テスト回答")
+        
+        result = qa_engine.answer("テスト質問")
+        
+        qa_engine.retriever.retrieve_result.assert_called_once()
+        qa_engine.retriever.get_context.assert_not_called()
+        qa_engine.retriever.retrieve.assert_not_called()
+        # コンテキストは5件、参照文書は上位3件
+        assert "doc4.txt" in result["context"]
+        assert len(result["retrieved_documents"]) == 3
+        assert len(result["retrieval"]["sources"]) == 5
+        # 回答はキャッシュ・レポートに保存できるようJSONに変換できる
+        json.dumps(result, ensure_ascii=False)
+    
     def test_conversation_history(self, qa_engine):
         """会話履歴のテスト"""
         qa_engine.llm_client.generate_with_context = Mock(return_value="回答1")
-        qa_engine.retriever.get_context = Mock(return_value="")
-        qa_engine.retriever.retrieve = Mock(return_value=[])
+        qa_engine.retriever.retrieve_result = Mock(return_value=RetrievalResult(query=""))
         
         # 最初の質問
         qa_engine.answer("質問1")
@@ -61,6 +92,216 @@ class TestQAEngine:
         assert len(qa_engine.conversation_history) == 0
 
 
+    def test_answer_cache_hit(self, qa_engine):
+        """類似の質問にキャッシュから回答するテスト"""
+        qa_engine.answer_cache = SemanticAnswerCache(similarity_threshold=0.95)
+        qa_engine.retriever.index_version = 1
+        qa_engine.retriever.lexical_result = Mock(return_value=None)
+        qa_engine.retriever.embed_query = Mock(side_effect=[[1.0, 0.0], [0.99, 0.01], [0.0, 1.0]])
+        qa_engine.retriever.retrieve_result = Mock(return_value=RetrievalResult(query=""))
+        qa_engine.llm_client.generate_with_context = Mock(side_effect=["回答A", "回答B"])
+        
+        first = qa_engine.answer("IndexError の意味は?")
+        second = qa_engine.answer("IndexErrorの意味は？")
+        third = qa_engine.answer("全く別の質問")
+        
+        assert first["cached"] == False
+        assert second["cached"] == True
+        assert second["response"] == "回答A"
+        assert third["response"] == "回答B"
+        assert qa_engine.llm_client.generate_with_context.call_count == 2
+        assert len(qa_engine.conversation_history) == 6
+    
+    def test_lexical_match_skips_cache_embedding(self, qa_engine):
+        """語彙検索で決まる質問ではキャッシュ参照のための埋め込みを行わないことのテスト"""
+        qa_engine.answer_cache = SemanticAnswerCache(similarity_threshold=0.95)
+        qa_engine.retriever.lexical_result = Mock(return_value=RetrievalResult(
+            query="ZeroDivisionError",
+            documents=[Document(page_content="ゼロ除算の説明", metadata={"source": "a.txt"})],
+            scores=[8.0],
+            mode="lexical"
+        ))
+        qa_engine.llm_client.generate_with_context = Mock(return_value="回答")
+        
+        result = qa_engine.answer("ZeroDivisionError")
+        
+        assert result["retrieval"]["mode"] == "lexical"
+        assert "ゼロ除算の説明" in result["context"]
+        qa_engine.retriever.embed_query.assert_not_called()
+        qa_engine.retriever.retrieve_result.assert_not_called()
+    
+    def test_lexical_match_uses_exact_cache(self, qa_engine):
+        """語彙検索で決まる質問を繰り返すと、埋め込みなしでキャッシュから回答するテスト"""
+        qa_engine.answer_cache = SemanticAnswerCache(similarity_threshold=0.95)
+        qa_engine.retriever.index_version = 1
+        qa_engine.retriever.lexical_result = Mock(return_value=RetrievalResult(
+            query="ZeroDivisionError",
+            documents=[Document(page_content="ゼロ除算の説明", metadata={"source": "a.txt"})],
+            scores=[8.0],
+            mode="lexical"
+        ))
+        qa_engine.llm_client.generate_with_context = Mock(side_effect=["回答", "別の回答"])
+        
+        first = qa_engine.answer("ZeroDivisionError")
+        second = qa_engine.answer("zerodivisionerror ")
+        
+        assert first["cached"] == False
+        assert second["cached"] == True
+        assert second["response"] == "回答"
+        qa_engine.llm_client.generate_with_context.assert_called_once()
+        qa_engine.retriever.embed_query.assert_not_called()
+        
+        # インデックスが更新されると完全一致のエントリも破棄される
+        qa_engine.retriever.index_version = 2
+        assert qa_engine.answer("ZeroDivisionError")["response"] == "別の回答"
+
+    
+    def test_stream_answer(self, qa_engine):
+        """ストリーミング回答のテスト"""
+        qa_engine.retriever.retrieve_result = Mock(return_value=RetrievalResult(query=""))
+        qa_engine.llm_client.stream_with_context = Mock(return_value=iter(["テスト", "回答"]))
+        
+        result = qa_engine.stream_answer("テスト質問")
+        # 読み進める前は履歴に記録されない
+        assert len(qa_engine.conversation_history) == 0
+        
+        tokens = list(result["stream"])
+        
+        assert tokens == ["テスト", "回答"]
+        assert result["response"] == "テスト回答"
+        assert qa_engine.conversation_history[-1]["content"] == "テスト回答"
+
+    
+    @pytest.mark.asyncio
+    async def test_aanswer(self, qa_engine):
+        """非同期での回答テスト"""
+        qa_engine.retriever.aretrieve_result = AsyncMock(return_value=RetrievalResult(
+            query="テスト質問",
+            documents=[Document(page_content="テストコンテキスト", metadata={"source": "test.txt"})]
+        ))
+        qa_engine.llm_client.agenerate_with_context = AsyncMock(return_value="テスト回答")
+        
+        result = await qa_engine.aanswer("テスト質問")
+        
+        assert result["response"] == "テスト回答"
+        assert "テストコンテキスト" in result["context"]
+        qa_engine.retriever.aretrieve_result.assert_awaited_once()
+        assert len(qa_engine.conversation_history) == 2
+
+
+class TestSemanticAnswerCache:
+    """SemanticAnswerCacheのテスト"""
+    
+    def test_namespace_and_threshold(self):
+        """名前空間と類似度の閾値のテスト"""
+        cache = SemanticAnswerCache(similarity_threshold=0.9)
+        cache.store("qa:normal", [1.0, 0.0], {"response": "回答"})
+        
+        assert cache.lookup("qa:normal", [1.0, 0.05])["response"] == "回答"
+        assert cache.lookup("qa:hint", [1.0, 0.0]) is None
+        assert cache.lookup("qa:normal", [0.5, 0.5]) is None
+    
+    def test_invalidated_by_index_version(self):
+        """インデックス更新でキャッシュが破棄されることのテスト"""
+        cache = SemanticAnswerCache()
+        cache.store("qa", [1.0, 0.0], {"response": "回答"}, index_version=1)
+        
+        assert cache.lookup("qa", [1.0, 0.0], index_version=1) is not None
+        assert cache.lookup("qa", [1.0, 0.0], index_version=2) is None
+    
+    def test_ttl_and_lru(self):
+        """TTLと件数上限による削除のテスト"""
+        cache = SemanticAnswerCache(max_entries=2)
+        cache.store("qa", [1.0, 0.0, 0.0], {"response": "1"})
+        cache.store("qa", [0.0, 1.0, 0.0], {"response": "2"})
+        # 1件目を参照してから3件目を追加すると2件目が削除される
+        cache.lookup("qa", [1.0, 0.0, 0.0])
+        cache.store("qa", [0.0, 0.0, 1.0], {"response": "3"})
+        
+        assert cache.lookup("qa", [0.0, 1.0, 0.0]) is None
+        assert cache.lookup("qa", [1.0, 0.0, 0.0]) is not None
+        
+        cache.ttl_seconds = -1
+        assert cache.lookup("qa", [1.0, 0.0, 0.0]) is None
+
+
+class TestConversationMemory:
+    """ConversationMemoryのテスト"""
+    
+    @pytest.fixture
+    def llm_client(self):
+        """要約を返すモックのLLMクライアント"""
+        client = Mock()
+        client.count_tokens.side_effect = len
+        client.create_chat_history.side_effect = lambda messages: messages
+        client.generate.return_value = "要約"
+        return client
+    
+    def test_old_messages_are_summarized(self, llm_client):
+        """上限を超えた古いメッセージが要約にまとめられることのテスト"""
+        memory = ConversationMemory(llm_client, max_tokens=20)
+        for i in range(4):
+            memory.append({"role": "user", "content": f"質問{i}の内容です"})
+        # 履歴を使うまでは要約しない
+        llm_client.generate.assert_not_called()
+        
+        memory.context_messages()
+        memory.wait(timeout=5)
+        context = memory.context_messages()
+        
+        llm_client.generate.assert_called_once()
+        assert context[0] == {"role": "system", "content": "これまでの会話の要約:\n要約"}
+        assert context[-1]["content"] == "質問3の内容です"
+        assert sum(len(message["content"]) for message in context[1:]) <= 20 - len("要約")
+        assert len(memory) < 4
+    
+    def test_folded_messages_are_kept_until_summarized(self, llm_client):
+        """要約ができるまでは、要約に回したメッセージもプロンプトに含まれることのテスト"""
+        import threading
+        release = threading.Event()
+        llm_client.generate.side_effect = lambda messages: release.wait(5) and "要約"
+        memory = ConversationMemory(llm_client, max_tokens=20)
+        for i in range(4):
+            memory.append({"role": "user", "content": f"質問{i}の内容です"})
+        
+        pending = memory.context_messages()
+        release.set()
+        memory.wait(timeout=5)
+        
+        assert [message["content"] for message in pending] == [f"質問{i}の内容です" for i in range(4)]
+        assert memory.context_messages()[0]["content"] == "これまでの会話の要約:\n要約"
+    
+    def test_long_summary_is_truncated(self, llm_client):
+        """上限を超える要約は切り詰められ、直近のメッセージの枠が残ることのテスト"""
+        llm_client.generate.return_value = "長" * 100
+        memory = ConversationMemory(llm_client, max_tokens=20)
+        for i in range(4):
+            memory.append({"role": "user", "content": f"質問{i}の内容です"})
+        
+        memory.context_messages()
+        memory.wait(timeout=5)
+        context = memory.context_messages()
+        
+        assert memory.summary == "長" * 10
+        assert context[-1]["content"] == "質問3の内容です"
+    
+    def test_list_compatibility(self, llm_client):
+        """リストと同様に参照でき、長い本文も元に戻せることのテスト"""
+        memory = ConversationMemory(llm_client, max_tokens=100000, summarize=False)
+        long_code = "print('hello')\n" * 1000
+        memory.append({"role": "user", "content": long_code})
+        memory.append({"role": "assistant", "content": "回答"})
+        
+        assert len(memory) == 2
+        assert memory[0]["content"] == long_code
+        assert memory[-1] == {"role": "assistant", "content": "回答"}
+        assert [message["role"] for message in memory] == ["user", "assistant"]
+        
+        memory.clear()
+        assert len(memory) == 0
+        assert memory.context_messages() == []
+
+
 class TestHintGenerator:
     """HintGeneratorのテスト"""
     
@@ -68,14 +309,19 @@ class TestHintGenerator:
     def hint_generator(self):
         """HintGeneratorのフィクスチャ"""
         with patch('src.response_engine.hint_generator.LLMClient'), \
-             patch('src.response_engine.hint_generator.KnowledgeRetriever'):
+             patch('src.response_engine.hint_generator.KnowledgeRetriever'), \
+             patch('src.response_engine.hint_generator.get_shared_answer_cache', return_value=None):
             generator = HintGenerator()
+            generator.llm_client.count_tokens.side_effect = len
             yield generator
     
     def test_generate_hint_levels(self, hint_generator):
         """段階的ヒント生成のテスト"""
         hint_generator.llm_client.generate_with_context = Mock(return_value="ヒント内容")
-        hint_generator.retriever.get_context = Mock(return_value="コンテキスト")
+        hint_generator.retriever.retrieve_result = Mock(return_value=RetrievalResult(
+            query="テスト質問",
+            documents=[Document(page_content="コンテキスト", metadata={})]
+        ))
         
         # 最初のヒント（レベル1）
         result1 = hint_generator.generate_hint("テスト質問")
@@ -92,10 +338,156 @@ class TestHintGenerator:
         assert result3["level"] == 3
         assert result3["next_level_available"] == False
     
+    def test_context_is_retrieved_once_per_query(self, hint_generator):
+        """2回目以降のレベルでは検索を繰り返さないことのテスト"""
+        hint_generator.llm_client.generate_with_context = Mock(return_value="ヒント")
+        hint_generator.retriever.retrieve_result = Mock(return_value=RetrievalResult(query="質問"))
+        
+        for _ in range(3):
+            hint_generator.generate_hint("質問")
+        
+        hint_generator.retriever.retrieve_result.assert_called_once()
+    
+    def test_context_token_budget(self, hint_generator):
+        """ヒントのコンテキストもトークン数の上限に収まることのテスト"""
+        import src.utils.config as config
+        original = config.settings.context_max_tokens
+        config.settings.context_max_tokens = 100
+        try:
+            hint_generator.llm_client.generate_with_context = Mock(return_value="ヒント")
+            hint_generator.retriever.retrieve_result = Mock(return_value=RetrievalResult(
+                query="質問",
+                documents=[
+                    Document(page_content="あ" * 60, metadata={"source": "a.txt"}),
+                    Document(page_content="い" * 60, metadata={"source": "b.txt"})
+                ]
+            ))
+            
+            hint_generator.generate_hint("質問")
+        finally:
+            config.settings.context_max_tokens = original
+        
+        prompt = hint_generator.llm_client.generate_with_context.call_args.kwargs["query"]
+        assert "あ" * 60 in prompt
+        assert "い" * 60 not in prompt
+    
+    def test_context_is_not_cut_by_characters(self, hint_generator):
+        """上限内のコンテキストは文字数で切り詰められないことのテスト"""
+        import src.utils.config as config
+        original = config.settings.context_max_tokens
+        config.settings.context_max_tokens = 2000
+        try:
+            hint_generator.llm_client.generate_with_context = Mock(return_value="ヒント")
+            hint_generator.retriever.retrieve_result = Mock(return_value=RetrievalResult(
+                query="質問",
+                documents=[Document(page_content="あ" * 800, metadata={"source": "a.txt"})]
+            ))
+            
+            hint_generator.generate_hint("質問")
+        finally:
+            config.settings.context_max_tokens = original
+        
+        prompt = hint_generator.llm_client.generate_with_context.call_args.kwargs["query"]
+        assert "あ" * 800 in prompt
+    
+    def test_prefetch_next_level(self, hint_generator):
+        """次のレベルのヒントが先読みされることのテスト"""
+        import src.utils.config as config
+        originals = (config.settings.hint_prefetch_enabled, config.settings.hint_prefetch_max_per_session)
+        config.settings.hint_prefetch_enabled = True
+        config.settings.hint_prefetch_max_per_session = 1
+        try:
+            hint_generator.llm_client.generate_with_context = Mock(side_effect=["ヒント1", "ヒント2", "ヒント3"])
+            hint_generator.retriever.retrieve_result = Mock(return_value=RetrievalResult(query="質問"))
+            
+            first = hint_generator.generate_hint("質問")
+            second = hint_generator.generate_hint("質問")
+            # 先読みの回数の上限に達しているため、レベル3は通常どおり生成する
+            third = hint_generator.generate_hint("質問")
+            
+            assert (first["hint"], first["cached"]) == ("ヒント1", False)
+            assert (second["hint"], second["level"], second["cached"]) == ("ヒント2", 2, True)
+            assert (third["hint"], third["level"]) == ("ヒント3", 3)
+            assert hint_generator.llm_client.generate_with_context.call_count == 3
+        finally:
+            config.settings.hint_prefetch_enabled, config.settings.hint_prefetch_max_per_session = originals
+    
+    @pytest.mark.asyncio
+    async def test_async_prefetch_next_level(self, hint_generator):
+        """非同期版でも次のレベルのヒントが先読みされることのテスト"""
+        import src.utils.config as config
+        original = config.settings.hint_prefetch_enabled
+        config.settings.hint_prefetch_enabled = True
+        try:
+            hint_generator.llm_client.agenerate_with_context = AsyncMock(return_value="ヒント1")
+            hint_generator.llm_client.generate_with_context = Mock(return_value="ヒント2")
+            hint_generator.retriever.aretrieve_result = AsyncMock(return_value=RetrievalResult(query="質問"))
+            
+            first = await hint_generator.agenerate_hint("質問")
+            second = await hint_generator.agenerate_hint("質問")
+            
+            assert (first["hint"], first["cached"]) == ("ヒント1", False)
+            assert (second["hint"], second["level"], second["cached"]) == ("ヒント2", 2, True)
+            hint_generator.llm_client.agenerate_with_context.assert_awaited_once()
+        finally:
+            config.settings.hint_prefetch_enabled = original
+    
+    def test_context_is_retrieved_again_after_index_update(self, hint_generator):
+        """インデックスが更新されると、記録済みのコンテキストを使わずに検索し直すことのテスト"""
+        hint_generator.llm_client.generate_with_context = Mock(return_value="ヒント")
+        hint_generator.retriever.retrieve_result = Mock(return_value=RetrievalResult(query="質問"))
+        hint_generator.retriever.index_version = 1
+        
+        hint_generator.generate_hint("質問")
+        hint_generator.retriever.index_version = 2
+        hint_generator.generate_hint("質問")
+        
+        assert hint_generator.retriever.retrieve_result.call_count == 2
+    
+    def test_parse_hint_batch(self):
+        """一括生成の出力の解釈のテスト"""
+        text = '```json\n{"hints": {"1": "a", "2": "b", "3": "c"}, "keywords": "for文、range"}\n```'
+        
+        assert parse_hint_batch(text) == {"hints": {1: "a", 2: "b", 3: "c"}, "keywords": ["for文", "range"]}
+        assert parse_hint_batch('{"hints": ["a", "b", "c"]}')["hints"][3] == "c"
+        assert parse_hint_batch('{"hints": {"1": "a"}}') is None
+        assert parse_hint_batch("JSONではない応答") is None
+    
+    def test_batch_mode(self, hint_generator):
+        """1回の呼び出しで全レベルとキーワードが提供されることのテスト"""
+        import src.utils.config as config
+        original = config.settings.hint_generation_mode
+        config.settings.hint_generation_mode = "batch"
+        try:
+            hint_generator.llm_client.generate_with_context = Mock(return_value=(
+                '{"hints": {"1": "ヒント1", "2": "ヒント2", "3": "ヒント3"}, "keywords": ["for文"]}'
+            ))
+            hint_generator.retriever.retrieve_result = Mock(return_value=RetrievalResult(query="質問"))
+            
+            hints = [hint_generator.generate_hint("質問")["hint"] for _ in range(3)]
+            keywords = hint_generator.get_hint_keywords("質問？")
+            
+            assert hints == ["ヒント1", "ヒント2", "ヒント3"]
+            assert keywords["keywords"] == "for文"
+            hint_generator.llm_client.generate_with_context.assert_called_once()
+        finally:
+            config.settings.hint_generation_mode = original
+    
+    def test_stream_hint(self, hint_generator):
+        """ストリーミングでのヒント生成のテスト"""
+        hint_generator.retriever.retrieve_result = Mock(return_value=RetrievalResult(query=""))
+        hint_generator.llm_client.stream_with_context = Mock(return_value=iter(["ヒ", "ント"]))
+        
+        result = hint_generator.stream_hint("テスト質問")
+        
+        assert "".join(result["stream"]) == "ヒント"
+        assert result["hint"] == "ヒント"
+        assert result["level"] == 1
+    
     def test_reset_hint_level(self, hint_generator):
         """ヒントレベルのリセットテスト"""
         hint_generator.llm_client.generate_with_context = Mock(return_value="ヒント")
-        hint_generator.retriever.get_context = Mock(return_value="")
+        hint_generator.retriever.retrieve_result = Mock(return_value=RetrievalResult(query="質問1"))
         
         # ヒントを生成
         hint_generator.generate_hint("質問1")
@@ -108,6 +500,27 @@ class TestHintGenerator:
         result = hint_generator.generate_hint("質問1")
         assert result["level"] == 1
     
+    def test_lexical_match_uses_exact_cache(self, hint_generator):
+        """語彙検索で決まる質問のヒントも、埋め込みなしでキャッシュから返すテスト"""
+        hint_generator.answer_cache = SemanticAnswerCache()
+        hint_generator.retriever.index_version = 1
+        hint_generator.retriever.lexical_result = Mock(return_value=RetrievalResult(
+            query="ZeroDivisionError",
+            documents=[Document(page_content="ゼロ除算の説明", metadata={})],
+            mode="lexical"
+        ))
+        hint_generator.llm_client.generate_with_context = Mock(return_value="ヒント")
+        
+        first = hint_generator.generate_hint("ZeroDivisionError")
+        hint_generator.reset_hint_level("ZeroDivisionError")
+        second = hint_generator.generate_hint("ZeroDivisionError")
+        
+        assert first["cached"] == False
+        assert second["cached"] == True
+        assert second["hint"] == "ヒント"
+        hint_generator.llm_client.generate_with_context.assert_called_once()
+        hint_generator.retriever.embed_query.assert_not_called()
+    
     def test_get_hint_keywords(self, hint_generator):
         """キーワード提供のテスト"""
         from langchain.schema import Document
@@ -0,0 +1,286 @@
+import asyncio
+import os
+import tempfile
+import time
+import json
+import threading
+import pytest
+from unittest.mock import Mock
+
+from src.utils import config, metrics
+from src.utils.concurrency import AsyncLimiter
+from src.utils.evaluation_cache import EvaluationCache
+from src.utils.evaluator import ResponseEvaluator
+from src.utils.retry import retry_with_backoff
+from src.utils.state_store import BoundedStateStore, normalize_key
+from src.utils.stats import percentile
+
+
+class TestAsyncLimiter:
+    """AsyncLimiterのテスト"""
+    
+    @pytest.mark.asyncio
+    async def test_limits_concurrency(self):
+        """同時実行数が上限を超えないことのテスト"""
+        limiter = AsyncLimiter(max_concurrency=2)
+        running = 0
+        max_running = 0
+        
+        async def task():
+            nonlocal running, max_running
+            async with limiter:
+                running += 1
+                max_running = max(max_running, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+        
+        await asyncio.gather(*[task() for _ in range(10)])
+        
+        assert max_running == 2
+
+
+class TestRetry:
+    """リトライ処理のテスト"""
+    
+    def test_retries_rate_limit_errors(self):
+        """レート制限エラーがリトライされることのテスト"""
+        class RateLimitError(Exception):
+            pass
+        
+        calls = []
+        
+        def func():
+            calls.append(1)
+            if len(calls) < 3:
+                raise RateLimitError("rate limited")
+            return "ok"
+        
+        assert retry_with_backoff(func, max_retries=5, base_delay=0) == "ok"
+        assert len(calls) == 3
+    
+    def test_does_not_retry_other_errors(self):
+        """一時的でないエラーはリトライしないことのテスト"""
+        calls = []
+        
+        def func():
+            calls.append(1)
+            raise ValueError("bad request")
+        
+        with pytest.raises(ValueError):
+            retry_with_backoff(func, max_retries=5, base_delay=0)
+        assert len(calls) == 1
+
+
+class TestStats:
+    """統計処理のテスト"""
+    
+    def test_percentile(self):
+        """パーセンタイルの計算のテスト"""
+        assert percentile([], 95) == 0.0
+        assert percentile([1.0, 2.0, 3.0, 4.0, 5.0], 50) == 3.0
+        assert percentile([1.0, 2.0], 50) == 1.5
+
+
+class TestBoundedStateStore:
+    """BoundedStateStoreのテスト"""
+    
+    def test_normalize_key(self):
+        """表記ゆれが同じキーになることのテスト"""
+        assert normalize_key("ＩｎｄｅｘＥｒｒｏｒ  とは？") == normalize_key("indexerror とは")
+    
+    def test_lru_and_namespaces(self):
+        """上限を超えると古いものから追い出され、名前空間が分離されることのテスト"""
+        store = BoundedStateStore(max_entries=2)
+        store.set("a", "q1", 1)
+        store.set("b", "q1", 2)
+        store.get("a", "q1")
+        store.set("a", "q2", 3)
+        
+        assert len(store) == 2
+        assert store.get("a", "q1") == 1
+        assert store.get("b", "q1") is None
+        
+        store.clear("a")
+        assert store.get("a", "q2") is None
+    
+    def test_ttl(self):
+        """有効期限を過ぎた値が取得できないことのテスト"""
+        store = BoundedStateStore(ttl_seconds=0.01)
+        store.set("a", "q", 1)
+        time.sleep(0.02)
+        
+        assert store.get("a", "q", 0) == 0
+    
+    def test_spill_to_disk(self):
+        """追い出した値がSQLiteから復元されることのテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = BoundedStateStore(max_entries=1, spill_path=os.path.join(temp_dir, "state.sqlite3"))
+            store.set("a", "q1", {"level": 1})
+            store.set("a", "q2", {"level": 2})
+            
+            assert len(store) == 1
+            assert store.get("a", "q1") == {"level": 1}
+            assert store.get("a", "q2") == {"level": 2}
+            
+            store.pop("a", "q1")
+            assert store.get("a", "q1") is None
+
+
+class TestMetrics:
+    """スパン・カウンターの計測のテスト"""
+    
+    @pytest.fixture(autouse=True)
+    def enable_metrics(self):
+        original = (config.settings.metrics_enabled, config.settings.metrics_log_path)
+        config.settings.metrics_enabled = True
+        config.settings.metrics_log_path = ""
+        metrics.registry.reset()
+        yield
+        config.settings.metrics_enabled, config.settings.metrics_log_path = original
+        metrics.registry.reset()
+    
+    def test_disabled_is_noop(self):
+        """無効な場合は何も記録しないことのテスト"""
+        config.settings.metrics_enabled = False
+        with metrics.span("stage") as span:
+            span.set(tokens=1)
+        metrics.increment("hits")
+        
+        assert metrics.registry.snapshot() == {"counters": {}, "spans": {}}
+    
+    def test_counters_and_spans(self):
+        """カウンターとスパンがラベルごとに集計されることのテスト"""
+        metrics.increment("hits", mode="hint")
+        metrics.increment("hits", 2, mode="hint")
+        with metrics.span("outer"):
+            with metrics.span("inner", store="faiss"):
+                pass
+        
+        snapshot = metrics.registry.snapshot()
+        assert snapshot["counters"]["hits"] == [{"labels": {"mode": "hint"}, "value": 3}]
+        assert snapshot["spans"]["inner"][0]["labels"] == {"store": "faiss"}
+        assert snapshot["spans"]["outer"][0]["count"] == 1
+    
+    def test_span_error_and_json_log(self):
+        """例外がエラーとして数えられ、親子関係がJSONログに出力されることのテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config.settings.metrics_log_path = os.path.join(temp_dir, "metrics.jsonl")
+            with pytest.raises(ValueError):
+                with metrics.span("outer"):
+                    with metrics.span("inner") as span:
+                        span.set(tokens_in=10)
+                        raise ValueError("boom")
+            
+            with open(config.settings.metrics_log_path, encoding="utf-8") as f:
+                inner, outer = [json.loads(line) for line in f]
+        
+        assert inner["parent"] == "outer" and inner["trace_id"] == outer["trace_id"]
+        assert inner["tokens_in"] == 10 and inner["error"] == "ValueError"
+        errors = metrics.registry.snapshot()["counters"]["span_errors"]
+        assert sorted(error["labels"]["span"] for error in errors) == ["inner", "outer"]
+    
+    def test_prometheus_text(self):
+        """Prometheus のテキスト形式で出力されることのテスト"""
+        metrics.increment("llm_tokens_in", 5, model="gpt")
+        with metrics.span("llm.generate"):
+            pass
+        
+        text = metrics.registry.prometheus_text()
+        assert "# TYPE copilot_llm_tokens_in_total counter" in text
+        assert 'copilot_llm_tokens_in_total{model="gpt"} 5' in text
+        assert 'copilot_span_duration_seconds_count{span="llm.generate"} 1' in text
+        assert 'copilot_span_duration_seconds_bucket{span="llm.generate",le="+Inf"} 1' in text
+
+
+class TestResponseEvaluator:
+    """ResponseEvaluatorの一括評価のテスト"""
+    
+    EVALUATION = "accuracy: 8\nclarity: 7\nrelevance: 9\neducational value: 6\nhint appropriateness: 5"
+    
+    @pytest.fixture
+    def cache_path(self):
+        """評価キャッシュのパス（一時ディレクトリ）"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            yield os.path.join(temp_dir, "evaluations.sqlite3")
+    
+    @pytest.fixture
+    def evaluator(self, cache_path):
+        """ResponseEvaluatorのフィクスチャ"""
+        llm_client = Mock()
+        llm_client.generate_with_context.return_value = self.EVALUATION
+        return ResponseEvaluator(llm_client=llm_client, cache=EvaluationCache(cache_path))
+    
+    def test_evaluate_batch_streams_jsonl(self, evaluator):
+        """並列に評価した結果が1行ずつ書き出され、累計に加算されることのテスト"""
+        items = [{"query": f"質問{i}", "response": f"回答{i}", "mode": "normal"} for i in range(10)]
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = os.path.join(temp_dir, "evaluations.jsonl")
+            result = evaluator.evaluate_batch(items, output_path=output_path, concurrency=4)
+            with open(output_path, encoding="utf-8") as f:
+                records = [json.loads(line) for line in f]
+        
+        assert result["evaluated"] == 10 and result["errors"] == 0
+        assert sorted(record["index"] for record in records) == list(range(10))
+        assert records[0]["total_score"] == 35
+        assert result["summary"]["total_evaluations"] == 10
+        assert result["summary"]["mode_breakdown"]["counts"]["normal"] == 10
+    
+    def test_cache_is_opened_lazily(self, evaluator, cache_path):
+        """1件ずつの評価ではキャッシュのファイルを作らず、一括評価で初めて開くことのテスト"""
+        evaluator.evaluate_response("質問", "回答", "normal")
+        assert not os.path.exists(cache_path)
+        
+        evaluator.evaluate_batch([{"query": "質問", "response": "回答", "mode": "normal"}])
+        assert os.path.exists(cache_path)
+    
+    def test_evaluate_batch_uses_cache(self, evaluator):
+        """同じ質問・回答・モードの評価がキャッシュから返されることのテスト"""
+        items = [{"query": "質問", "response": "回答", "mode": "hint"}]
+        evaluator.evaluate_batch(items)
+        result = evaluator.evaluate_batch(items + [{"query": "質問", "response": "回答", "mode": "normal"}])
+        
+        assert result["cached"] == 1
+        assert evaluator.llm_client.generate_with_context.call_count == 2
+    
+    def test_evaluation_cache_persists(self, evaluator, cache_path, monkeypatch):
+        """評価キャッシュがプロセスをまたいで再利用され、評価プロンプトの変更で無効になることのテスト"""
+        import src.utils.evaluator as evaluator_module
+        
+        items = [{"query": "質問", "response": "回答", "mode": "hint"}]
+        evaluator.evaluate_batch(items)
+        
+        reopened = ResponseEvaluator(llm_client=Mock(), cache=EvaluationCache(cache_path))
+        assert reopened.evaluate_batch(items)["cached"] == 1
+        reopened.llm_client.generate_with_context.assert_not_called()
+        
+        monkeypatch.setattr(
+            evaluator_module, "EVALUATION_REQUEST_TEMPLATE",
+            evaluator_module.EVALUATION_REQUEST_TEMPLATE + "\n採点の根拠も書いてください。"
+        )
+        reopened.llm_client.generate_with_context.return_value = self.EVALUATION
+        assert reopened.evaluate_batch(items)["cached"] == 0
+    
+    def test_evaluate_batch_bounded_concurrency_and_errors(self, evaluator):
+        """同時実行数が制限され、失敗した評価が集計から除かれることのテスト"""
+        lock = threading.Lock()
+        running = {"current": 0, "max": 0}
+        
+        def generate(query, context, system_prompt):
+            with lock:
+                running["current"] += 1
+                running["max"] = max(running["max"], running["current"])
+            time.sleep(0.01)
+            with lock:
+                running["current"] -= 1
+            if "質問3" in query:
+                raise ValueError("bad request")
+            return self.EVALUATION
+        
+        evaluator.llm_client.generate_with_context.side_effect = generate
+        items = [{"query": f"質問{i}", "response": "回答", "mode": "normal"} for i in range(8)]
+        result = evaluator.evaluate_batch(items, concurrency=2)
+        
+        assert running["max"] <= 2
+        assert result["errors"] == 1 and result["evaluated"] == 7
+        assert result["summary"]["total_evaluations"] == 7